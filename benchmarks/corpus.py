@@ -0,0 +1,257 @@
+"""
+A deterministic corpus of realistic inputs for the microbenchmarks: long roleplay
+replies, messy tool call JSON produced by LLMs, tag heavy prompts and large rule sets.
+"""
+
+import json
+import random
+
+SEED = 1337
+
+CHARACTERS = [f"Character{x}" for x in range(100)] + ["Assistant", "Example"]
+
+_ACTIONS = [
+    "*smiles warmly and leans against the doorframe*",
+    "*tilts her head, eyes sparkling with curiosity*",
+    "*gestures towards the window, where rain streaks down the glass*",
+    "*laughs softly, brushing a strand of hair behind his ear*",
+    "*pulls out a worn leather notebook and flips through the pages*",
+]
+
+_SENTENCES = [
+    "The tavern was crowded tonight, full of travelers seeking shelter from the storm.",
+    '"You really came all this way just to see me?" she asked, surprised.',
+    "Lanterns flickered along the cobblestone street, casting long golden shadows.",
+    "I haven't seen a sunset like this since we left the northern mountains!",
+    "He wore a detailed silver armor, engraved with runes that glowed faintly blue.",
+    "What do you think we should do next? The forest path looks dangerous...",
+    "The smell of fresh bread &amp; cinnamon drifted from the bakery next door.",
+    "Somewhere in the distance, a bell rang twelve times; midnight had arrived.",
+    "My sword is ready, my heart is steady, and my boots are soaked through.",
+    "She wore a red dress, long black hair, green eyes and a silver necklace.",
+]
+
+_TAGS = [
+    "masterpiece",
+    "best quality",
+    "1girl",
+    "long hair",
+    "red dress",
+    "smiling",
+    "looking at viewer",
+    "outdoors",
+    "sunset",
+    "cinematic lighting",
+    "detailed background",
+    "depth of field",
+    "8k",
+    "(high resolution:1.2)",
+    "<lora:add_details:1>",
+]
+
+_TAG_PREFIXES = ["", "*", "#", '"']
+
+_TRIGGERS = [
+    "Can you send me a picture of you at the beach?",
+    "Please show me a photo of your new apartment!",
+    "Generate an image of a dragon sleeping on a pile of gold.",
+    "send a selfie",
+    "Could you attach a snapshot of what you're doing right now?",
+]
+
+_WORDS = [
+    "detailed",
+    "night",
+    "rain",
+    "forest",
+    "castle",
+    "smile",
+    "armor",
+    "ocean",
+    "tavern",
+    "sunset",
+    "snow",
+    "dragon",
+]
+
+
+def get_roleplay_outputs(count: int = 50) -> list[str]:
+    """
+    Returns long roleplay replies made of narration, actions and dialogue.
+    """
+
+    rng = random.Random(SEED)
+
+    return [
+        "\n\n".join(
+            " ".join(
+                rng.choice(_ACTIONS) if rng.random() < 0.2 else rng.choice(_SENTENCES)
+                for _ in range(rng.randint(3, 8))
+            )
+            for _ in range(rng.randint(4, 12))
+        )
+        for _ in range(count)
+    ]
+
+
+def get_user_inputs(count: int = 200) -> list[str]:
+    """
+    Returns chat inputs, about a quarter of them asking for an image.
+    """
+
+    rng = random.Random(SEED + 1)
+
+    return [
+        (
+            rng.choice(_TRIGGERS)
+            if rng.random() < 0.25
+            else " ".join(rng.choice(_SENTENCES) for _ in range(rng.randint(1, 6)))
+        )
+        for _ in range(count)
+    ]
+
+
+def get_prompts(count: int = 200) -> list[str]:
+    """
+    Returns prompts with duplicate tags, stray punctuation and line breaks.
+    """
+
+    rng = random.Random(SEED + 2)
+    separators = [", ", ",", ". ", "!\n", "; ", ",, ", " ,", "\r\n"]
+
+    return [
+        "".join(
+            f"{rng.choice(_TAG_PREFIXES)}{rng.choice(_TAGS)}"
+            f"{rng.choice(separators)}"
+            for _ in range(rng.randint(5, 40))
+        )
+        for _ in range(count)
+    ]
+
+
+def get_regexes() -> list[str]:
+    """
+    Returns rule regexes in all the forms users write them.
+    """
+
+    return [
+        r"\b(detailed)\b",
+        r".*\b(detailed)\b",
+        r"^Assistant$",
+        r"(night|evening|dark)",
+        r".*\b(rain|storm)\b.*",
+        r"^.*(sword|armor)",
+        r"(ocean|sea|beach)$",
+        r"^\s*send (a|me) (selfie|picture)",
+    ] * 25
+
+
+def get_tool_outputs(count: int = 100) -> list[str]:
+    """
+    Returns tool call outputs the way LLMs tend to produce them, including
+    smart quotes, surrounding text, truncated and double braced JSON.
+    """
+
+    rng = random.Random(SEED + 3)
+    outputs = []
+
+    for index in range(count):
+        tools = [
+            {
+                "tool_name": rng.choice(["generate_image", "generate image"]),
+                "parameters": {
+                    "prompt": ", ".join(rng.sample(_TAGS, rng.randint(3, 10)))
+                },
+            }
+            for _ in range(rng.randint(1, 3))
+        ]
+
+        if rng.random() < 0.5:
+            tools.insert(
+                0,
+                {
+                    "tool": "add_text",
+                    "tool_parameters": {"text": rng.choice(_SENTENCES)},
+                },
+            )
+
+        text = json.dumps(tools if len(tools) > 1 else tools[0], indent=2)
+
+        match index % 6:
+            case 0:
+                text = f"Action: ```json\n{text}\n```"
+            case 1:
+                text = text.replace('"', "“", 2).replace('"', "”", 2)
+            case 2:
+                text = f"{rng.choice(_SENTENCES)}\n{text}"
+            case 3:
+                # the reply got cut off by the token limit
+                text = text[: int(len(text) * 0.8)]
+            case 4:
+                text = text.replace("{", "{{", 1).replace("}", "}}", 1)
+            case 5:
+                text = f"Action:\n```json\n{text}\n```\n{rng.choice(_SENTENCES)}"
+
+        outputs.append(text)
+
+    return outputs
+
+
+def get_generation_rules(count: int = 300) -> list[dict]:
+    """
+    Returns a large rule set: per character rules, keyword rules on inputs and
+    outputs, sentence rules and rules with negative regexes.
+    """
+
+    rng = random.Random(SEED + 4)
+    rules: list[dict] = []
+
+    for index in range(count):
+        kind = index % 5
+        word = rng.choice(_WORDS)
+
+        match kind:
+            case 0:
+                rule = {
+                    "regex": f"^{rng.choice(CHARACTERS)}$",
+                    "match": ["character_name"],
+                }
+            case 1:
+                rule = {"regex": rf".*\b({word})\b", "match": ["input", "output"]}
+            case 2:
+                rule = {"regex": rf"\b({word}s?)\b", "match": ["output_sentence"]}
+            case 3:
+                rule = {
+                    "regex": rf"\b({word})\b",
+                    "negative_regex": r"\b(no|not|never)\b",
+                    "match": ["input_sentence", "output_sentence"],
+                }
+            case _:
+                rule = {
+                    "regex": f"^(Character{rng.randint(0, 9)}.*|Assistant)$",
+                    "match": ["character_name"],
+                }
+
+        rule["actions"] = [
+            {"name": "prompt_append", "args": ", ".join(rng.sample(_TAGS, 3))},
+            {"name": "negative_prompt_append", "args": "blurry, lowres"},
+        ]
+
+        rules.append(rule)
+
+    return rules
+
+
+def get_rule_contexts(count: int = 50) -> list[tuple[str, str, str]]:
+    """
+    Returns (input, output, character name) triples to evaluate rules against.
+    """
+
+    rng = random.Random(SEED + 5)
+
+    return [
+        (user_input, output, rng.choice(CHARACTERS[:10] + CHARACTERS[-2:]))
+        for user_input, output in zip(
+            get_user_inputs(count), get_roleplay_outputs(count)
+        )
+    ]
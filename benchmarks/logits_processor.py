@@ -0,0 +1,165 @@
+"""
+Compares the per-token overhead of FsmLogitsProcessor with the previous
+implementation, which built a new -inf mask row by row on every decoding step.
+Uses a synthetic guide and CPU tensors, so neither a model nor a GPU is needed.
+
+Usage: python benchmarks/logits_processor.py --vocab-size 128256 --batch-size 1,4
+"""
+
+import argparse
+import random
+import time
+from typing import Any
+import torch
+from simulated_host import install_simulated_modules, load_extension
+
+
+class SyntheticGuide(object):
+    """
+    A guide cycling through a fixed number of states, each allowing a random set
+    of tokens. Like JSON guides, some states allow a few structural tokens while
+    others (e.g. inside strings) allow most of the vocabulary.
+    """
+
+    def __init__(self, vocab_size: int, states: int, seed: int = 0) -> None:
+        rng = random.Random(seed)
+        self.states = states
+        self.tokens = [
+            rng.sample(
+                range(vocab_size),
+                (
+                    rng.randint(1, 16)
+                    if rng.random() < 0.6
+                    else int(vocab_size * rng.uniform(0.5, 0.95))
+                ),
+            )
+            for _ in range(states)
+        ]
+
+    def get_next_instruction(self, state: int) -> Any:
+        class Instruction(object):
+            tokens = self.tokens[state]
+
+        return Instruction()
+
+    def get_next_state(self, state: int, token_id: int) -> int:
+        return (state + 1) % self.states
+
+    def copy(self) -> "SyntheticGuide":
+        return self
+
+
+class ReferenceFsmLogitsProcessor(object):
+    """
+    The previous implementation of FsmLogitsProcessor.__call__.
+    """
+
+    def __init__(self, fsm: Any) -> None:
+        self.fsm = fsm
+        self._fsm_state = 0
+        self._is_first_token = True
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        is_first_token = self._is_first_token
+        if self._is_first_token:
+            self._is_first_token = False
+
+        mask = torch.full_like(scores, -float("inf"))
+
+        for i in range(len(input_ids)):
+            if not is_first_token:
+                last_token = int(input_ids[i][-1].item())
+                self._fsm_state = self.fsm.get_next_state(self._fsm_state, last_token)
+
+            allowed_tokens = self.fsm.get_next_instruction(self._fsm_state).tokens
+            mask[i][allowed_tokens] = 0
+
+        biased_scores = scores + mask
+        return biased_scores  # type: ignore
+
+
+def _run(
+    processor: Any, batch_size: int, vocab_size: int, steps: int
+) -> tuple[float, list[torch.Tensor]]:
+    generator = torch.Generator().manual_seed(0)
+    base_scores = torch.randn(batch_size, vocab_size, generator=generator)
+    scores = torch.empty_like(base_scores)
+    input_ids = torch.zeros(batch_size, 1, dtype=torch.long)
+    outputs = []
+    elapsed = 0.0
+
+    for step in range(steps):
+        # the processors may modify the scores in place
+        scores.copy_(base_scores)
+        input_ids = torch.cat(
+            [input_ids, torch.full((batch_size, 1), step, dtype=torch.long)], dim=1
+        )
+
+        start_time = time.perf_counter()
+        result = processor(input_ids, scores)
+        elapsed += time.perf_counter() - start_time
+
+        if step < 8:
+            outputs.append(result.clone())
+
+    return elapsed / steps * 1e6, outputs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks FsmLogitsProcessor.")
+    parser.add_argument(
+        "--vocab-size",
+        type=lambda x: [int(y) for y in x.split(",")],
+        default=[32000, 128256],
+    )
+    parser.add_argument(
+        "--batch-size", type=lambda x: [int(y) for y in x.split(",")], default=[1, 4]
+    )
+    parser.add_argument("--states", type=int, default=64)
+    parser.add_argument("--steps", type=int, default=256)
+    cli_args = parser.parse_args()
+
+    install_simulated_modules()
+    extension = load_extension()
+    __import__(f"{extension.__name__}.transformers_logits")
+    transformers_logits = extension.transformers_logits
+
+    torch.set_num_threads(1)
+
+    print(
+        f"{'vocab':>8} {'batch':>6} {'before us/token':>16} "
+        f"{'after us/token':>15} {'speedup':>8}"
+    )
+
+    for vocab_size in cli_args.vocab_size:
+        guide = SyntheticGuide(vocab_size, cli_args.states)
+
+        for batch_size in cli_args.batch_size:
+            before, expected = _run(
+                ReferenceFsmLogitsProcessor(guide),
+                batch_size,
+                vocab_size,
+                cli_args.steps,
+            )
+
+            after, actual = _run(
+                transformers_logits.FsmLogitsProcessor(tokenizer=None, fsm=guide),
+                batch_size,
+                vocab_size,
+                cli_args.steps,
+            )
+
+            # the previous implementation advanced a single state for all rows
+            if batch_size == 1:
+                assert all(torch.equal(x, y) for x, y in zip(expected, actual))
+
+            print(
+                f"{vocab_size:>8} {batch_size:>6} {before:>16.1f} "
+                f"{after:>15.1f} {before / after:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
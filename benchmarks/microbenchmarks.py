@@ -0,0 +1,233 @@
+"""
+Times the functions which run on every chat message against the corpus in corpus.py
+and compares the results with the committed baseline.
+
+Usage:
+  python benchmarks/microbenchmarks.py                    compares with the baseline
+  python benchmarks/microbenchmarks.py --update-baseline  stores a new baseline
+  python benchmarks/microbenchmarks.py --max-regression 0.25
+                                   fails if any benchmark got more than 25% slower
+"""
+
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import timeit
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable
+import corpus
+from simulated_host import install_simulated_modules, load_extension
+
+BASELINE_FILE = Path(__file__).resolve().parent / "baseline.json"
+
+# each repeat runs for at least 0.2s, the fastest of all repeats is the least noisy
+REPEATS = 5
+
+
+@dataclass
+class MicrobenchmarkResult:
+    """
+    The time it takes to process a single corpus item.
+    """
+
+    items: int
+    min_us: float
+    median_us: float
+
+
+def _create_benchmarks(extension: Any) -> dict[str, tuple[int, Callable[[], None]]]:
+    """
+    Returns the number of corpus items and a function processing all of them
+    for every benchmark.
+    """
+
+    from importlib import import_module
+
+    context_module = import_module(f"{extension.__name__}.context")
+    generation_rules = import_module(
+        f"{extension.__name__}.ext_modules.generation_rules"
+    )
+    image_generator = import_module(f"{extension.__name__}.ext_modules.image_generator")
+    text_analyzer = import_module(f"{extension.__name__}.ext_modules.text_analyzer")
+    params_module = import_module(f"{extension.__name__}.params")
+
+    def create_context(
+        params: Any, input_text: str, output_text: str, character: str
+    ) -> Any:
+        return context_module.GenerationContext(
+            params=params,
+            sd_client=None,
+            input_text=input_text,
+            output_text=output_text,
+            state={"character_menu": character},
+        )
+
+    prompts = corpus.get_prompts()
+    regexes = corpus.get_regexes()
+    user_inputs = corpus.get_user_inputs()
+    rules = corpus.get_generation_rules()
+
+    default_params = params_module.StableDiffusionWebUiExtensionParams()
+    default_params.normalize()
+
+    rule_contexts = [
+        create_context(default_params, *x) for x in corpus.get_rule_contexts()
+    ]
+
+    tool_params = params_module.StableDiffusionWebUiExtensionParams(
+        trigger_mode=params_module.TriggerMode.TOOL
+    )
+    tool_params.normalize()
+
+    tool_contexts = [
+        create_context(tool_params, "", x, "Assistant")
+        for x in corpus.get_tool_outputs()
+    ]
+
+    # rules are compiled once and then evaluated for every message
+    compiled_rules = generation_rules.CompiledGenerationRules(rules)
+
+    def normalize_prompts() -> None:
+        for x in prompts:
+            image_generator.normalize_prompt(x)
+
+    def normalize_regexes() -> None:
+        for x in regexes:
+            generation_rules.normalize_regex(x)
+
+    def evaluate_rules() -> None:
+        for x in rule_contexts:
+            compiled_rules.evaluate(x)
+
+    def compile_rules() -> None:
+        generation_rules.CompiledGenerationRules(rules)
+
+    def get_description_prompts() -> None:
+        for x in user_inputs:
+            text_analyzer.try_get_description_prompt(x, default_params)
+
+    def extract_tool_calls() -> None:
+        for x in tool_contexts:
+            image_generator.create_generation_request(x)
+
+    return {
+        "normalize_prompt": (len(prompts), normalize_prompts),
+        "normalize_regex": (len(regexes), normalize_regexes),
+        "evaluate_generation_rules": (len(rule_contexts), evaluate_rules),
+        "compile_generation_rules": (1, compile_rules),
+        "try_get_description_prompt": (len(user_inputs), get_description_prompts),
+        "extract_tool_calls": (len(tool_contexts), extract_tool_calls),
+    }
+
+
+def _measure(items: int, function: Callable[[], None]) -> MicrobenchmarkResult:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    times = [x / number / items * 1e6 for x in timer.repeat(REPEATS, number)]
+
+    return MicrobenchmarkResult(
+        items=items,
+        min_us=round(min(times), 3),
+        median_us=round(statistics.median(times), 3),
+    )
+
+
+def _print_results(
+    results: dict[str, MicrobenchmarkResult], baseline: dict[str, Any] | None
+) -> dict[str, float]:
+    changes: dict[str, float] = {}
+
+    print(
+        f"{'benchmark':<30} {'items':>6} {'min us':>10} {'median us':>10} {'change':>8}"
+    )
+
+    for name, result in results.items():
+        previous = (baseline or {}).get("results", {}).get(name, None)
+        change = ""
+
+        if previous:
+            changes[name] = result.min_us / previous["min_us"] - 1
+            change = f"{changes[name]:+.1%}"
+
+        print(
+            f"{name:<30} {result.items:>6} {result.min_us:>10.2f} "
+            f"{result.median_us:>10.2f} {change:>8}"
+        )
+
+    return changes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Runs the microbenchmarks.")
+    parser.add_argument("--filter", default="", help="only runs matching benchmarks")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=None,
+        help="fails if a benchmark is slower than the baseline by this fraction",
+    )
+    cli_args = parser.parse_args()
+
+    # the messy corpus triggers warnings, which would measure the terminal instead
+    logging.disable(logging.CRITICAL)
+
+    install_simulated_modules()
+    extension = load_extension()
+
+    benchmarks = {
+        name: benchmark
+        for name, benchmark in _create_benchmarks(extension).items()
+        if cli_args.filter in name
+    }
+
+    results = {name: _measure(*benchmark) for name, benchmark in benchmarks.items()}
+
+    baseline = (
+        json.loads(cli_args.baseline.read_text(encoding="utf-8"))
+        if cli_args.baseline.is_file()
+        else None
+    )
+
+    changes = _print_results(results, baseline)
+
+    if cli_args.update_baseline:
+        # benchmarks which have not been run keep their previous results
+        stored_results = dict((baseline or {}).get("results", {}))
+        stored_results.update({name: asdict(x) for name, x in results.items()})
+
+        cli_args.baseline.write_text(
+            json.dumps(
+                {
+                    "machine": {
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "processor": platform.processor() or platform.machine(),
+                    },
+                    "results": stored_results,
+                },
+                indent=2,
+            )
+            + "\n",
+            encoding="utf-8",
+        )
+
+        print(f"Stored the baseline in {cli_args.baseline}.")
+
+    if cli_args.max_regression is not None:
+        regressions = [
+            name for name, x in changes.items() if x > cli_args.max_regression
+        ]
+
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+"""
+A stand-in for the parts of the stable-diffusion-webui API used by this extension.
+Returns generated placeholder images after a configurable latency, so the extension
+can be measured without a GPU.
+
+Usage: python benchmarks/mock_server.py --port 7860 --latency 0.5 --error-rate 0.05
+"""
+
+import argparse
+import base64
+import io
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+from PIL import Image
+
+# number of distinct images generated per image size
+IMAGE_VARIANTS = 8
+
+
+@dataclass
+class MockServerConfig:
+    """
+    Defines how the mock server behaves.
+    """
+
+    # seconds each txt2img call takes per image, face swaps take a quarter of it
+    latency: float = 0.1
+    # random deviation added to every latency, in seconds
+    latency_jitter: float = 0
+    # the size of the returned images, uses the requested size if not set
+    image_width: int | None = None
+    image_height: int | None = None
+    # the share of txt2img and face swap requests which fail with a 500 error
+    error_rate: float = 0
+    checkpoint: str = "mock.safetensors [0000000000]"
+
+
+@dataclass
+class MockServerStats:
+    """
+    Counts the requests handled by the mock server.
+    """
+
+    requests: dict[str, int] = field(default_factory=dict)
+    errors: int = 0
+    interrupted_jobs: int = 0
+    received_bytes: int = 0
+    sent_bytes: int = 0
+
+
+class MockSdWebUiServer(object):
+    """
+    Serves the mock API on a background thread.
+    """
+
+    def __init__(
+        self,
+        config: MockServerConfig | None = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.config = config or MockServerConfig()
+        self.stats = MockServerStats()
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        self._images: dict[tuple[int, int], list[str]] = {}
+        # the start time, duration and interruption event of every running job
+        self._jobs: dict[int, tuple[float, float, threading.Event]] = {}
+        self._job_counter = 0
+        self._server = ThreadingHTTPServer((host, port), _create_handler(self))
+        self._server.daemon_threads = True
+        self._thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/sdapi/v1"
+
+    def start(self) -> "MockSdWebUiServer":
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="sd_mock_server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockSdWebUiServer":
+        return self.start()
+
+    def __exit__(self, *args: Any) -> None:
+        self.stop()
+
+    def txt2img(self, payload: dict[str, Any]) -> dict[str, Any]:
+        count = int(payload.get("batch_size", 1)) * int(payload.get("n_iter", 1))
+        seed = int(payload.get("seed", -1))
+
+        if seed == -1:
+            with self._lock:
+                seed = self._random.randrange(2**32)
+
+        width = self.config.image_width or int(payload.get("width", 512))
+        height = self.config.image_height or int(payload.get("height", 512))
+        seeds = [seed + x for x in range(count)]
+
+        self._run_job(self.config.latency * count)
+
+        return {
+            "images": [self._get_image(width, height, x) for x in seeds],
+            "parameters": payload,
+            "info": json.dumps({"seed": seed, "all_seeds": seeds}),
+        }
+
+    def swap_face(self) -> None:
+        self._run_job(self.config.latency / 4)
+
+    def get_progress(self) -> dict[str, Any]:
+        now = time.perf_counter()
+
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        if not jobs:
+            return {
+                "progress": 0,
+                "eta_relative": 0,
+                "state": {"job_count": 0, "sampling_step": 0, "sampling_steps": 0},
+                "current_image": None,
+            }
+
+        start_time, duration, _ = min(jobs, key=lambda x: x[0])
+        progress = min(1, (now - start_time) / duration) if duration > 0 else 1
+
+        return {
+            "progress": progress,
+            "eta_relative": max(0, start_time + duration - now),
+            "state": {
+                "job_count": len(jobs),
+                "sampling_step": int(progress * 20),
+                "sampling_steps": 20,
+            },
+            "current_image": None,
+        }
+
+    def interrupt(self) -> None:
+        """
+        Finishes all running jobs right away, like stable-diffusion-webui returns
+        the images generated so far when interrupted.
+        """
+
+        with self._lock:
+            for _, _, interrupted in self._jobs.values():
+                if not interrupted.is_set():
+                    interrupted.set()
+                    self.stats.interrupted_jobs += 1
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.config.error_rate
+
+    def _run_job(self, duration: float) -> None:
+        if self.config.latency_jitter > 0:
+            with self._lock:
+                duration += self._random.uniform(0, self.config.latency_jitter)
+
+        with self._lock:
+            self._job_counter += 1
+            job_id = self._job_counter
+            interrupted = threading.Event()
+            self._jobs[job_id] = (time.perf_counter(), duration, interrupted)
+
+        try:
+            interrupted.wait(duration)
+        finally:
+            with self._lock:
+                del self._jobs[job_id]
+
+    def _get_image(self, width: int, height: int, seed: int) -> str:
+        with self._lock:
+            images = self._images.get((width, height), None)
+
+        if images is None:
+            # encoded once per size, so the server adds no load during benchmarks
+            images = [_create_image(width, height, x) for x in range(IMAGE_VARIANTS)]
+
+            with self._lock:
+                self._images[(width, height)] = images
+
+        return images[seed % IMAGE_VARIANTS]
+
+
+def _create_image(width: int, height: int, variant: int) -> str:
+    noise = Image.effect_noise((width, height), 64).convert("RGB")
+    color = Image.new("RGB", (width, height), _get_color(variant))
+    image = Image.blend(noise, color, 0.5)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
+def _get_color(variant: int) -> tuple[int, int, int]:
+    return ((variant * 97) % 256, (variant * 57) % 256, (variant * 131) % 256)
+
+
+def _create_handler(server: MockSdWebUiServer) -> type[BaseHTTPRequestHandler]:
+    class MockRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self) -> None:  # noqa: N802
+            path = self._count_request()
+
+            match path:
+                case "/sdapi/v1/progress":
+                    self._send(server.get_progress())
+                case "/sdapi/v1/options":
+                    self._send({"sd_model_checkpoint": server.config.checkpoint})
+                case "/sdapi/v1/scripts":
+                    self._send({"txt2img": [], "img2img": []})
+                case _:
+                    self._send({"detail": "Not Found"}, 404)
+
+        def do_POST(self) -> None:  # noqa: N802
+            path = self._count_request()
+            payload = self._read_payload()
+
+            match path:
+                case "/sdapi/v1/txt2img":
+                    if server.should_fail():
+                        return self._send_error()
+
+                    self._send(server.txt2img(payload))
+                case "/reactor/image":
+                    if server.should_fail():
+                        return self._send_error()
+
+                    server.swap_face()
+                    self._send({"image": payload.get("target_image", "")})
+                case "/faceswaplab/swap_face":
+                    if server.should_fail():
+                        return self._send_error()
+
+                    server.swap_face()
+                    self._send({"images": [payload.get("image", "")], "infos": [""]})
+                case "/sdapi/v1/interrupt":
+                    server.interrupt()
+                    self._send({})
+                case (
+                    "/sdapi/v1/options"
+                    | "/sdapi/v1/unload-checkpoint"
+                    | "/sdapi/v1/reload-checkpoint"
+                    | "/sdapi/v1/refresh-vae"
+                ):
+                    self._send({})
+                case _:
+                    self._send({"detail": "Not Found"}, 404)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+        def _count_request(self) -> str:
+            path = self.path.split("?")[0]
+
+            with server._lock:
+                server.stats.requests[path] = server.stats.requests.get(path, 0) + 1
+
+            return path
+
+        def _read_payload(self) -> dict[str, Any]:
+            length = int(self.headers.get("Content-Length", 0) or 0)
+            body = self.rfile.read(length) if length else b""
+
+            with server._lock:
+                server.stats.received_bytes += len(body)
+
+            try:
+                return json.loads(body) if body else {}
+            except ValueError:
+                return {}
+
+        def _send_error(self) -> None:
+            with server._lock:
+                server.stats.errors += 1
+
+            self._send({"error": "RuntimeError", "detail": "Simulated failure"}, 500)
+
+        def _send(self, response: dict[str, Any], status: int = 200) -> None:
+            body = json.dumps(response).encode("utf-8")
+
+            with server._lock:
+                server.stats.sent_bytes += len(body)
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return MockRequestHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs a mock stable-diffusion-webui.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--latency-jitter", type=float, default=0)
+    parser.add_argument("--image-width", type=int, default=None)
+    parser.add_argument("--image-height", type=int, default=None)
+    parser.add_argument("--error-rate", type=float, default=0)
+    cli_args = parser.parse_args()
+
+    mock_server = MockSdWebUiServer(
+        MockServerConfig(
+            latency=cli_args.latency,
+            latency_jitter=cli_args.latency_jitter,
+            image_width=cli_args.image_width,
+            image_height=cli_args.image_height,
+            error_rate=cli_args.error_rate,
+        ),
+        host=cli_args.host,
+        port=cli_args.port,
+    )
+
+    print(f"Serving a mock stable-diffusion-webui API at {mock_server.url}", flush=True)
+
+    try:
+        mock_server.start()._thread.join()  # type: ignore
+    except KeyboardInterrupt:
+        mock_server.stop()
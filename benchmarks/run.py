@@ -0,0 +1,328 @@
+"""
+Measures the latency and throughput of the image generation against the mock
+stable-diffusion-webui at different concurrency levels. Runs on CPU-only machines.
+
+Usage: python benchmarks/run.py --concurrency 1,4,8 --requests 32 --json results.json
+
+Scenarios:
+  generate  calls generate_html_images_for_context directly
+  hooks     runs state_modifier, custom_generate_chat_prompt and output_modifier
+            like text-generation-webui does for a chat reply
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable
+from simulated_host import SimulatedHost, install_simulated_modules, load_extension
+
+MOCK_SERVER = Path(__file__).resolve().parent / "mock_server.py"
+
+TOOL_MESSAGE = (
+    "Here you go!\n"
+    "Action: ```json\n"
+    '[{"tool_name": "generate_image", "parameters": {"prompt": "a red fox"}}]\n'
+    "```"
+)
+
+# a 1x1 PNG used as the source face for face swaps
+SOURCE_FACE = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4"
+    "nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC"
+)
+
+
+@dataclass
+class BenchmarkResult:
+    """
+    The measurements of a scenario at a single concurrency level.
+    """
+
+    scenario: str
+    concurrency: int
+    requests: int
+    errors: int
+    p50: float
+    p95: float
+    p99: float
+    mean: float
+    throughput: float
+    peak_rss_mb: float | None
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """
+    Returns the nearest-rank percentile of the given values.
+    """
+
+    if not values:
+        return float("nan")
+
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * percent // 100))
+    return ordered[int(rank) - 1]
+
+
+def _get_peak_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # reported in bytes on macOS and in kilobytes everywhere else
+    return peak / 2**20 if platform.system() == "Darwin" else peak / 2**10
+
+
+def _start_mock_server(cli_args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    """
+    Starts the mock server in its own process, so it neither competes for the GIL
+    nor shows up in the measured memory usage.
+    """
+
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(MOCK_SERVER),
+            "--port",
+            "0",
+            "--latency",
+            str(cli_args.latency),
+            "--latency-jitter",
+            str(cli_args.latency_jitter),
+            "--error-rate",
+            str(cli_args.error_rate),
+        ],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+
+    assert process.stdout is not None
+    line = process.stdout.readline()
+
+    if not line:
+        process.kill()
+        raise RuntimeError("The mock server failed to start")
+
+    return process, line.strip().split(" ")[-1]
+
+
+def _configure(extension: Any, cli_args: argparse.Namespace, url: str) -> None:
+    ui_params = extension.script.ui_params
+    ui_params.api_endpoint = url
+    ui_params.trigger_mode = "tool"
+    ui_params.width = cli_args.width
+    ui_params.height = cli_args.height
+    ui_params.batch_size = cli_args.batch_size
+    ui_params.save_images = cli_args.save_images
+    ui_params.progress_polling_enabled = not cli_args.no_progress_polling
+    ui_params.dynamic_vram_reallocation_enabled = cli_args.dynamic_vram
+    ui_params.reactor_enabled = cli_args.face_swap
+    ui_params.reactor_source_face = SOURCE_FACE
+    ui_params.api_connection_pool_size = max(4, max(cli_args.concurrency))
+
+    SimulatedHost.model_load_time = cli_args.model_load_time
+
+
+def _run_generate(extension: Any, session_id: str) -> bool:
+    script = extension.script
+    state = {"unique_id": session_id, "character_menu": "Assistant", "mode": "chat"}
+
+    try:
+        context = script.get_or_create_context(state)
+        context.output_text = TOOL_MESSAGE
+
+        _, images_html, *_ = (
+            extension.ext_modules.image_generator.generate_html_images_for_context(
+                context
+            )
+        )
+
+        return images_html is not None
+    finally:
+        script.cleanup_context(state)
+
+
+def _run_hooks(extension: Any, session_id: str) -> bool:
+    script = extension.script
+    state = {
+        "unique_id": session_id,
+        "character_menu": "Assistant",
+        "mode": "chat",
+        "stream": True,
+    }
+
+    script.state_modifier(state)
+    script.custom_generate_chat_prompt("Send me a picture of a fox.", state)
+    return "<img " in script.output_modifier(TOOL_MESSAGE, state, is_chat=True)
+
+
+SCENARIOS: dict[str, Callable[[Any, str], bool]] = {
+    "generate": _run_generate,
+    "hooks": _run_hooks,
+}
+
+
+def _run_benchmark(
+    extension: Any, scenario: str, concurrency: int, requests: int
+) -> BenchmarkResult:
+    run = SCENARIOS[scenario]
+    latencies: list[float] = []
+    errors = 0
+
+    def measure(index: int) -> float | None:
+        start_time = time.perf_counter()
+
+        try:
+            if not run(extension, f"bench-{scenario}-{concurrency}-{index}"):
+                return None
+        except Exception as e:
+            logging.debug("Request failed: %s", e, exc_info=True)
+            return None
+
+        return time.perf_counter() - start_time
+
+    # warms up the connection pools and the image cache of the mock server
+    measure(-1)
+
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency in executor.map(measure, range(requests)):
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+
+    duration = time.perf_counter() - start_time
+
+    # images are saved in the background, which is not part of the measured latency
+    extension.ext_modules.output_writer.output_writer.flush()
+
+    return BenchmarkResult(
+        scenario=scenario,
+        concurrency=concurrency,
+        requests=requests,
+        errors=errors,
+        p50=_percentile(latencies, 50),
+        p95=_percentile(latencies, 95),
+        p99=_percentile(latencies, 99),
+        mean=sum(latencies) / len(latencies) if latencies else float("nan"),
+        throughput=len(latencies) / duration if duration > 0 else 0,
+        peak_rss_mb=_get_peak_rss_mb(),
+    )
+
+
+def _print_results(results: list[BenchmarkResult]) -> None:
+    print(
+        f"{'scenario':<10} {'conc':>5} {'reqs':>5} {'errs':>5} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'rss MB':>8}"
+    )
+
+    for x in results:
+        print(
+            f"{x.scenario:<10} {x.concurrency:>5} {x.requests:>5} {x.errors:>5} "
+            f"{x.p50 * 1000:>9.1f} {x.p95 * 1000:>9.1f} {x.p99 * 1000:>9.1f} "
+            f"{x.throughput:>8.2f} "
+            f"{x.peak_rss_mb if x.peak_rss_mb is not None else float('nan'):>8.1f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the image generation.")
+    parser.add_argument(
+        "--scenario", choices=[*SCENARIOS, "all"], default="all", help="what to run"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=lambda x: [int(y) for y in x.split(",")],
+        default=[1, 4, 8],
+        help="comma separated concurrency levels",
+    )
+    parser.add_argument("--requests", type=int, default=32, help="per level")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds/image")
+    parser.add_argument("--latency-jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--save-images", action="store_true")
+    parser.add_argument("--face-swap", action="store_true", help="enables ReActor")
+    parser.add_argument("--dynamic-vram", action="store_true")
+    parser.add_argument("--model-load-time", type=float, default=0)
+    parser.add_argument("--no-progress-polling", action="store_true")
+    parser.add_argument("--api-endpoint", default=None, help="uses a running server")
+    parser.add_argument("--json", type=Path, default=None, help="writes the results")
+    parser.add_argument("--verbose", action="store_true")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if cli_args.verbose else logging.WARNING)
+
+    install_simulated_modules()
+    extension = load_extension()
+
+    # imports the submodules so they are reachable as attributes of the package
+    __import__(f"{extension.__name__}.script")
+    __import__(f"{extension.__name__}.ext_modules.image_generator")
+
+    server, url = (
+        (None, cli_args.api_endpoint)
+        if cli_args.api_endpoint
+        else _start_mock_server(cli_args)
+    )
+
+    scenarios = list(SCENARIOS) if cli_args.scenario == "all" else [cli_args.scenario]
+    results: list[BenchmarkResult] = []
+
+    # the extension saves images relative to the working directory
+    working_directory = os.getcwd()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix="sd_benchmark_") as directory:
+            os.chdir(directory)
+            _configure(extension, cli_args, url)
+
+            for scenario in scenarios:
+                for concurrency in cli_args.concurrency:
+                    results.append(
+                        _run_benchmark(
+                            extension, scenario, concurrency, cli_args.requests
+                        )
+                    )
+    finally:
+        os.chdir(working_directory)
+
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    _print_results(results)
+
+    if cli_args.json is not None:
+        cli_args.json.write_text(
+            json.dumps(
+                {
+                    "arguments": {
+                        key: str(value) if isinstance(value, Path) else value
+                        for key, value in vars(cli_args).items()
+                    },
+                    "results": [asdict(x) for x in results],
+                },
+                indent=2,
+            ),
+            encoding="utf-8",
+        )
+
+
+if __name__ == "__main__":
+    main()
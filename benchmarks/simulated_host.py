@@ -0,0 +1,140 @@
+"""
+Minimal stand-ins for the text-generation-webui modules imported by this extension,
+so it can be loaded and benchmarked outside of text-generation-webui.
+"""
+
+import copy
+import importlib.util
+import logging
+import sys
+import time
+from pathlib import Path
+from types import ModuleType, SimpleNamespace
+from typing import Any
+
+EXTENSION_DIRECTORY = Path(__file__).resolve().parent.parent
+
+
+class SimulatedHost(object):
+    """
+    Controls the behaviour of the simulated text-generation-webui.
+    """
+
+    # seconds it takes to load the LLM, e.g. after a VRAM reallocation
+    model_load_time: float = 0
+    model_loads: int = 0
+    model_unloads: int = 0
+
+
+def install_simulated_modules() -> None:
+    """
+    Registers the simulated modules package unless text-generation-webui's modules
+    have already been imported.
+    """
+
+    if "modules" in sys.modules:
+        return
+
+    package = ModuleType("modules")
+    package.__path__ = []  # type: ignore
+
+    shared = _create_module(
+        "modules.shared",
+        model=None,
+        tokenizer=None,
+        model_name="None",
+        processing_message="*Is typing...*",
+        args=SimpleNamespace(),
+        settings={},
+    )
+
+    histories: dict[str, dict[str, list]] = {}
+
+    def generate_chat_prompt(text: str, state: dict, **kwargs: Any) -> str:
+        return text
+
+    def load_history(unique_id: str, character: str, mode: str) -> dict:
+        return copy.deepcopy(histories.get(unique_id, {"internal": [], "visible": []}))
+
+    def save_history(history: dict, unique_id: str, character: str, mode: str) -> None:
+        histories[unique_id] = copy.deepcopy(history)
+
+    chat = _create_module(
+        "modules.chat",
+        generate_chat_prompt=generate_chat_prompt,
+        load_history=load_history,
+        save_history=save_history,
+    )
+
+    def load_model(model_name: str) -> tuple[Any, Any]:
+        time.sleep(SimulatedHost.model_load_time)
+        SimulatedHost.model_loads += 1
+        shared.model_name = model_name  # type: ignore
+        return object(), object()
+
+    def unload_model(*args: Any, **kwargs: Any) -> None:
+        SimulatedHost.model_unloads += 1
+        shared.model = None  # type: ignore
+        shared.tokenizer = None  # type: ignore
+
+    def reload_model() -> None:
+        unload_model()
+        shared.model, shared.tokenizer = load_model(shared.model_name)  # type: ignore
+
+    models = _create_module(
+        "modules.models",
+        load_model=load_model,
+        unload_model=unload_model,
+        reload_model=reload_model,
+    )
+
+    logging_colors = _create_module(
+        "modules.logging_colors", logger=logging.getLogger("text-generation-webui")
+    )
+
+    ui = _create_module("modules.ui", refresh_symbol="🔄")
+
+    for name, module in [
+        ("shared", shared),
+        ("chat", chat),
+        ("models", models),
+        ("logging_colors", logging_colors),
+        ("ui", ui),
+    ]:
+        setattr(package, name, module)
+
+    sys.modules["modules"] = package
+    shared.model, shared.tokenizer = object(), object()  # type: ignore
+
+
+def load_extension(name: str = "stable_diffusion") -> ModuleType:
+    """
+    Imports the extension as a package with the given name, regardless of the name
+    of the folder it has been checked out to.
+    """
+
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.spec_from_file_location(
+        name,
+        EXTENSION_DIRECTORY / "__init__.py",
+        submodule_search_locations=[str(EXTENSION_DIRECTORY)],
+    )
+
+    assert spec is not None and spec.loader is not None
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def _create_module(name: str, **attributes: Any) -> ModuleType:
+    module = ModuleType(name)
+
+    for key, value in attributes.items():
+        setattr(module, key, value)
+
+    sys.modules[name] = module
+    return module
@@ -1,6 +1,12 @@
+import threading
+import time
+from contextvars import ContextVar
 from dataclasses import dataclass
+from typing import Any
 from .params import StableDiffusionWebUiExtensionParams
-from .sd_client import SdWebUIApi
+from .sd_client import SdWebUIApi, SdWebUIApiBalancer
+
+CONTEXT_TTL_SECONDS = 30 * 60
 
 
 @dataclass
@@ -11,9 +17,66 @@ class GenerationContext(object):
     output_text: str | None = None
     is_completed: bool = False
     state: dict | None = None
+    sd_balancer: SdWebUIApiBalancer | None = None
+    # the EarlyGeneration started while the reply was still being generated
+    early_generation: Any = None
+
+
+_contexts: dict[str, tuple[GenerationContext, float]] = {}
+_contexts_lock = threading.Lock()
+_current_session_id: ContextVar[str | None] = ContextVar(
+    "sd_current_session_id", default=None
+)
+
 
+def get_session_id(state: dict | None) -> str:
+    """
+    Gets the id of the session (i.e. chat or API request) the given state belongs to.
+    """
 
-_current_context: GenerationContext | None = None
+    if state and state.get("unique_id", None):
+        return f"chat-{state['unique_id']}"
+
+    # API requests do not have a chat id but keep the same state object
+    return f"state-{id(state)}"
+
+
+def get_context(session_id: str) -> GenerationContext | None:
+    """
+    Gets the generation context of the given session.
+    """
+
+    with _contexts_lock:
+        _remove_expired_contexts()
+        entry = _contexts.get(session_id, None)
+
+        if entry is None:
+            return None
+
+        _contexts[session_id] = (entry[0], time.monotonic())
+        return entry[0]
+
+
+def set_context(session_id: str, context: GenerationContext | None) -> None:
+    """
+    Sets the generation context of the given session and makes it the current one.
+    """
+
+    with _contexts_lock:
+        if context is None:
+            _contexts.pop(session_id, None)
+        else:
+            _contexts[session_id] = (context, time.monotonic())
+
+    _current_session_id.set(session_id if context is not None else None)
+
+
+def activate_session(session_id: str) -> None:
+    """
+    Makes the given session the current one for the running generation request.
+    """
+
+    _current_session_id.set(session_id)
 
 
 def get_current_context() -> GenerationContext | None:
@@ -21,7 +84,8 @@ def get_current_context() -> GenerationContext | None:
     Gets the current generation context. Must be called inside a generation request.
     """
 
-    return _current_context
+    session_id = _current_session_id.get()
+    return get_context(session_id) if session_id is not None else None
 
 
 def set_current_context(context: GenerationContext | None) -> None:
@@ -29,5 +93,19 @@ def set_current_context(context: GenerationContext | None) -> None:
     Sets the current generation context. Must be called inside a generation request.
     """
 
-    global _current_context
-    _current_context = context
+    session_id = _current_session_id.get() or get_session_id(
+        context.state if context is not None else None
+    )
+
+    set_context(session_id, context)
+
+
+def _remove_expired_contexts() -> None:
+    now = time.monotonic()
+
+    for session_id in [
+        x
+        for x, (_, accessed) in _contexts.items()
+        if now - accessed > CONTEXT_TTL_SECONDS
+    ]:
+        del _contexts[session_id]
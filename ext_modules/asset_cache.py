@@ -0,0 +1,174 @@
+import base64
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+import requests
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_REVALIDATE_AFTER_SECONDS = 60.0
+DEFAULT_REQUEST_TIMEOUT_SECONDS = (5.0, 30.0)
+
+
+@dataclass
+class ReferenceAsset:
+    """
+    A cached reference image together with the data used to validate it.
+    """
+
+    source: str
+    base64: str
+    etag: str | None = None
+    last_modified: str | None = None
+    mtime_ns: int | None = None
+    size: int | None = None
+    validated_at: float = 0
+
+    @property
+    def byte_size(self) -> int:
+        return len(self.base64)
+
+
+class ReferenceAssetCache(object):
+    """
+    Caches reference images (e.g. source faces) as base64 encoded payloads.
+
+    Remote images are revalidated using ETag / Last-Modified headers,
+    local files are revalidated using their modification time and size.
+    Least recently used entries are evicted once the byte budget is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        revalidate_after: float = DEFAULT_REVALIDATE_AFTER_SECONDS,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, ReferenceAsset] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get_base64(self, source: str) -> str:
+        """
+        Returns the base64 encoded content of the given http(s):// or file:/// source.
+        """
+
+        if source.startswith("http://") or source.startswith("https://"):
+            return self._get_url(source)
+
+        if source.startswith("file:///"):
+            return self._get_file(source)
+
+        raise ValueError(f"Unsupported reference image source: {source}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _get_url(self, url: str) -> str:
+        cached = self._get_entry(url)
+
+        if cached is not None and time.monotonic() - cached.validated_at < (
+            self.revalidate_after
+        ):
+            self.hits += 1
+            return cached.base64
+
+        headers = {}
+
+        if cached is not None:
+            if cached.etag:
+                headers["If-None-Match"] = cached.etag
+            if cached.last_modified:
+                headers["If-Modified-Since"] = cached.last_modified
+
+        response = self._session.get(
+            url, headers=headers, timeout=DEFAULT_REQUEST_TIMEOUT_SECONDS
+        )
+
+        if cached is not None and response.status_code == 304:
+            cached.validated_at = time.monotonic()
+            self.hits += 1
+            return cached.base64
+
+        response.raise_for_status()
+        self.misses += 1
+
+        asset = ReferenceAsset(
+            source=url,
+            base64=base64.b64encode(response.content).decode(),
+            etag=response.headers.get("ETag", None),
+            last_modified=response.headers.get("Last-Modified", None),
+            validated_at=time.monotonic(),
+        )
+
+        self._put_entry(asset)
+        return asset.base64
+
+    def _get_file(self, source: str) -> str:
+        path = source.replace("file:///", "")
+        stat = os.stat(path)
+        cached = self._get_entry(source)
+
+        if (
+            cached is not None
+            and cached.mtime_ns == stat.st_mtime_ns
+            and cached.size == stat.st_size
+        ):
+            self.hits += 1
+            return cached.base64
+
+        self.misses += 1
+
+        with open(path, "rb") as f:
+            content = f.read()
+
+        asset = ReferenceAsset(
+            source=source,
+            base64=base64.b64encode(content).decode(),
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            validated_at=time.monotonic(),
+        )
+
+        self._put_entry(asset)
+        return asset.base64
+
+    def _get_entry(self, source: str) -> ReferenceAsset | None:
+        with self._lock:
+            entry = self._entries.get(source, None)
+
+            if entry is not None:
+                self._entries.move_to_end(source)
+
+            return entry
+
+    def _put_entry(self, asset: ReferenceAsset) -> None:
+        if asset.byte_size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(asset.source, None)
+
+            if previous is not None:
+                self._size -= previous.byte_size
+
+            self._entries[asset.source] = asset
+            self._size += asset.byte_size
+
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.byte_size
+
+
+reference_asset_cache = ReferenceAssetCache()
@@ -0,0 +1,130 @@
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from modules import chat
+from modules.logging_colors import logger
+from ..context import GenerationContext
+from .image_generator import ImageGenerationRequest, generate_html_images
+
+PENDING_IMAGE_MESSAGE = "Generating image..."
+FAILED_IMAGE_MESSAGE = "*Image generation has failed. Check logs for errors.*"
+
+MAX_FINISHED_JOBS = 256
+HISTORY_PATCH_ATTEMPTS = 10
+HISTORY_PATCH_INTERVAL_SECONDS = 1.0
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd_background")
+_finished_jobs: OrderedDict[str, str] = OrderedDict()
+_finished_jobs_lock = threading.Lock()
+
+
+def submit_background_generation(
+    context: GenerationContext, request: ImageGenerationRequest
+) -> str:
+    """
+    Queues the image generation for the given request and returns a placeholder
+    which gets replaced with the generated images in the chat history once done.
+    """
+
+    placeholder = (
+        f'<span class="sd-pending-image" id="sd-job-{uuid.uuid4().hex}">'
+        f"<em>{PENDING_IMAGE_MESSAGE}</em></span>"
+    )
+
+    future = _executor.submit(generate_html_images, context, request)
+    future.add_done_callback(
+        lambda x: _on_generation_finished(x, placeholder, context.state or {})
+    )
+
+    return placeholder
+
+
+def apply_finished_generations(history: dict) -> dict:
+    """
+    Replaces the placeholders of finished background generations in the history.
+    """
+
+    with _finished_jobs_lock:
+        finished_jobs = list(_finished_jobs.items())
+
+    if not finished_jobs or not isinstance(history, dict) or "visible" not in history:
+        return history
+
+    for entry in history["visible"]:
+        if len(entry) < 2 or not isinstance(entry[1], str):
+            continue
+
+        for placeholder, images_html in finished_jobs:
+            if placeholder in entry[1]:
+                entry[1] = entry[1].replace(placeholder, images_html)
+
+    return history
+
+
+def _on_generation_finished(future: Future, placeholder: str, state: dict) -> None:
+    try:
+        images_html = future.result() or FAILED_IMAGE_MESSAGE
+    except Exception as e:
+        logger.error(
+            "[SD WebUI Integration] Background image generation has failed: %s",
+            e,
+            exc_info=True,
+        )
+        images_html = FAILED_IMAGE_MESSAGE
+
+    with _finished_jobs_lock:
+        _finished_jobs[placeholder] = images_html
+
+        if len(_finished_jobs) > MAX_FINISHED_JOBS:
+            _finished_jobs.popitem(last=False)
+
+    threading.Thread(
+        target=_patch_saved_history,
+        args=(placeholder, images_html, state),
+        name="sd_background_history",
+        daemon=True,
+    ).start()
+
+
+def _patch_saved_history(placeholder: str, images_html: str, state: dict) -> None:
+    unique_id = state.get("unique_id", None)
+    character = state.get("character_menu", None)
+    mode = state.get("mode", None)
+
+    if not unique_id or not mode:
+        return
+
+    # the reply might not have been saved yet if the images finished quickly
+    for _ in range(HISTORY_PATCH_ATTEMPTS):
+        try:
+            history = chat.load_history(unique_id, character, mode)
+
+            if any(
+                len(entry) > 1 and placeholder in (entry[1] or "")
+                for entry in history.get("visible", [])
+            ):
+                patched_history = apply_finished_generations(copy.deepcopy(history))
+
+                # do not overwrite the chat if it has been saved in the meantime,
+                # history_modifier replaces the placeholder on the next reply anyway
+                if chat.load_history(unique_id, character, mode) == history:
+                    chat.save_history(patched_history, unique_id, character, mode)
+                    return
+        except Exception as e:
+            logger.error(
+                "[SD WebUI Integration] Failed to update chat history: %s",
+                e,
+                exc_info=True,
+            )
+            return
+
+        time.sleep(HISTORY_PATCH_INTERVAL_SECONDS)
+
+    logger.warning(
+        "[SD WebUI Integration] Could not replace the image placeholder in the saved "
+        "chat history after %d attempts, it will be replaced on the next reply.",
+        HISTORY_PATCH_ATTEMPTS,
+    )
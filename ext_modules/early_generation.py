@@ -0,0 +1,336 @@
+import dataclasses
+import re
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import torch
+from transformers import LogitsProcessor
+from modules.logging_colors import logger
+from ..context import GenerationContext
+from ..params import ContinuousModePromptGenerationMode, TriggerMode
+from .generation_rules import GenerationRulesResult
+from .image_generator import (
+    GenerationJob,
+    ImageGenerationRequest,
+    create_generation_request,
+    generate_html_images,
+)
+from .metrics import early_generations
+from .tool_call_parser import ToolCallStreamParser
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd_early")
+
+# speculative generations only start at the end of a sentence
+SENTENCE_END = re.compile(r"[.!?*\"”)\]]\s*$|\n\s*$")
+
+
+@dataclass
+class EarlyGeneration:
+    """
+    Image generations started while the reply was still being generated. Their
+    images are only saved once they are used.
+    """
+
+    mode: str
+    # the prompts started so far, in the order of the futures generating them
+    request: ImageGenerationRequest
+    futures: list[Future] = field(default_factory=list)
+    # tracks the backends generating the images, so that only those are interrupted
+    job: GenerationJob = field(
+        default_factory=lambda: GenerationJob(defer_outputs=True)
+    )
+    start_time: float = field(default_factory=time.perf_counter)
+    # the similarity of the prompts required for using the images
+    similarity_threshold: float = 1.0
+
+
+class StreamedTextObserver(LogitsProcessor):
+    """
+    Decodes the first sequence of the batch while it is being generated and passes
+    the text generated so far to the callback whenever it changed. Leaves the
+    scores untouched.
+    """
+
+    def __init__(self, tokenizer: Any, on_text: Callable[[str], None]) -> None:
+        self._tokenizer = tokenizer
+        self._on_text = on_text
+        self._prompt_length: int | None = None
+        # tokens up to the last line break are decoded only once
+        self._stable_tokens = 0
+        self._stable_text = ""
+        self._text = ""
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        if self._prompt_length is None:
+            self._prompt_length = input_ids.shape[1]
+
+        tokens = input_ids[0, self._prompt_length + self._stable_tokens :].tolist()
+        text = self._tokenizer.decode(tokens, skip_special_tokens=True)
+
+        # an incomplete multi-byte character is decoded once its last token arrived
+        if not tokens or text.endswith("\ufffd"):
+            return scores
+
+        if text.endswith("\n"):
+            self._stable_tokens += len(tokens)
+            self._stable_text += text
+            text = self._stable_text
+        else:
+            text = self._stable_text + text
+
+        if text != self._text:
+            self._text = text
+
+            try:
+                self._on_text(text)
+            except Exception as e:
+                logger.error(
+                    "[SD WebUI Integration] Failed to process the streamed reply: %s",
+                    e,
+                    exc_info=True,
+                )
+
+        return scores
+
+
+def create_tool_call_observer(
+    context: GenerationContext, tokenizer: Any
+) -> StreamedTextObserver:
+    """
+    Returns a logits processor which starts generating the images of every
+    generate_image tool call as soon as its prompt has been streamed.
+    """
+
+    parser = ToolCallStreamParser()
+
+    def on_text(text: str) -> None:
+        if context.is_completed:
+            return
+
+        # the decoded text only grows, unless the tokenizer cleaned up earlier text
+        if not text.startswith(parser.text):
+            return
+
+        for partial_text in parser.feed(text[len(parser.text) :]):
+            request = create_generation_request(
+                dataclasses.replace(context, output_text=partial_text)
+            )
+
+            if not request.should_generate:
+                continue
+
+            if context.early_generation is None:
+                context.early_generation = submit_early_generation(
+                    context, request, mode="tool"
+                )
+            else:
+                extend_early_generation(context, context.early_generation, request)
+
+    return StreamedTextObserver(tokenizer, on_text)
+
+
+def is_speculative_generation_supported(context: GenerationContext) -> bool:
+    """
+    Whether the image prompt is derived from the generated reply.
+    """
+
+    return context.params.trigger_mode == TriggerMode.INTERACTIVE or (
+        context.params.trigger_mode == TriggerMode.CONTINUOUS
+        and context.params.continuous_mode_prompt_generation_mode
+        == ContinuousModePromptGenerationMode.GENERATED_TEXT
+    )
+
+
+def create_speculative_observer(
+    context: GenerationContext, tokenizer: Any
+) -> StreamedTextObserver:
+    """
+    Returns a logits processor which starts generating images from the reply once it
+    is long enough, assuming that its remainder changes the prompt only slightly.
+    """
+
+    def on_text(text: str) -> None:
+        if context.is_completed or context.early_generation is not None:
+            return
+
+        is_long_enough = len(text) >= context.params.speculative_generation_min_length
+
+        if not is_long_enough or not SENTENCE_END.search(text):
+            return
+
+        request = create_generation_request(
+            dataclasses.replace(context, output_text=text)
+        )
+
+        if request.should_generate:
+            context.early_generation = submit_early_generation(
+                context,
+                request,
+                mode="speculative",
+                similarity_threshold=(
+                    context.params.speculative_generation_similarity_threshold
+                ),
+            )
+
+    return StreamedTextObserver(tokenizer, on_text)
+
+
+def submit_early_generation(
+    context: GenerationContext,
+    request: ImageGenerationRequest,
+    mode: str,
+    similarity_threshold: float = 1.0,
+) -> EarlyGeneration:
+    """
+    Starts generating the images of the request in the background.
+    """
+
+    logger.info(
+        "[SD WebUI Integration] Starting image generation before the reply is done."
+    )
+
+    early_generation = EarlyGeneration(
+        mode=mode,
+        request=dataclasses.replace(request, prompts=[]),
+        similarity_threshold=similarity_threshold,
+    )
+
+    extend_early_generation(context, early_generation, request)
+    return early_generation
+
+
+def extend_early_generation(
+    context: GenerationContext,
+    early_generation: EarlyGeneration,
+    request: ImageGenerationRequest,
+) -> None:
+    """
+    Starts generating the prompts of the request which follow the prompts that have
+    been started already, e.g. once another tool call has been streamed.
+    """
+
+    started = len(early_generation.request.prompts)
+
+    if len(request.prompts) <= started:
+        return
+
+    early_generation.futures.append(
+        _executor.submit(
+            generate_html_images,
+            context,
+            dataclasses.replace(request, prompts=request.prompts[started:]),
+            early_generation.job,
+        )
+    )
+
+    early_generation.request = request
+
+
+def get_prompt_similarity(prompt: str, other_prompt: str) -> float:
+    """
+    Returns how similar two prompts are, from 0 (nothing in common) to 1 (equal).
+    Compares the words regardless of their order, as tags may be reordered.
+    """
+
+    if prompt == other_prompt:
+        return 1.0
+
+    words = Counter(prompt.lower().replace(",", " ").split())
+    other_words = Counter(other_prompt.lower().replace(",", " ").split())
+    total = words.total() + other_words.total()
+
+    return 2 * (words & other_words).total() / total if total > 0 else 1.0
+
+
+def take_early_generation(
+    context: GenerationContext, request: ImageGenerationRequest
+) -> EarlyGeneration | None:
+    """
+    Returns the early generation of the context if it generates the same images as
+    the first prompts of the given request of the completed reply, and saves its
+    images. Otherwise it is discarded.
+    """
+
+    early_generation = context.early_generation
+    context.early_generation = None
+
+    if early_generation is None:
+        return None
+
+    if _is_similar_request(early_generation, request):
+        early_generations.inc(mode=early_generation.mode, result="used")
+        early_generation.job.accept()
+        return early_generation
+
+    early_generations.inc(mode=early_generation.mode, result="discarded")
+
+    logger.info(
+        "[SD WebUI Integration] Discarding the image generation started before the "
+        "reply was done, the final prompts differ."
+    )
+
+    _interrupt(early_generation)
+    return None
+
+
+def get_early_generation_images(
+    context: GenerationContext,
+    request: ImageGenerationRequest,
+    early_generation: EarlyGeneration,
+) -> str | None:
+    """
+    Waits for the images of the early generation and generates the prompts of the
+    request it has not started, e.g. if the last tool call was still incomplete.
+    """
+
+    images_html = [x.result() for x in early_generation.futures]
+    remaining_prompts = request.prompts[len(early_generation.request.prompts) :]
+
+    if remaining_prompts:
+        images_html.append(
+            generate_html_images(
+                context, dataclasses.replace(request, prompts=remaining_prompts)
+            )
+        )
+
+    return "\n".join(x for x in images_html if x) or None
+
+
+def _is_similar_request(
+    early_generation: EarlyGeneration, request: ImageGenerationRequest
+) -> bool:
+    early_request = early_generation.request
+
+    if (
+        not request.should_generate
+        or len(early_request.prompts) == 0
+        or len(early_request.prompts) > len(request.prompts)
+        or _without_prompts(early_request.rules) != _without_prompts(request.rules)
+    ):
+        return False
+
+    # the final reply may contain prompts that have not been started yet
+    return all(
+        x.count == y.count
+        and x.full_negative_prompt == y.full_negative_prompt
+        and get_prompt_similarity(x.full_prompt, y.full_prompt)
+        >= early_generation.similarity_threshold
+        for x, y in zip(early_request.prompts, request.prompts)
+    )
+
+
+def _without_prompts(rules: GenerationRulesResult) -> GenerationRulesResult:
+    # prompts added by rules are part of the compared full prompts
+    return dataclasses.replace(rules, prompt="", negative_prompt="")
+
+
+def _interrupt(early_generation: EarlyGeneration) -> None:
+    # prompts which have not been started yet are simply dropped from the queue
+    for future in early_generation.futures:
+        future.cancel()
+
+    early_generation.job.interrupt()
@@ -0,0 +1,341 @@
+import copy
+import html
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import cached_property
+from modules.logging_colors import logger
+from ..context import GenerationContext
+from ..params import (
+    RegexGenerationAction,
+    RegexGenerationRule,
+    RegexGenerationRuleMatch,
+)
+
+SENTENCE_DELIMITERS = ".", ",", "!", "?", "\n", "*", '"'
+SENTENCE_DELIMITERS_PATTERN = re.compile("|".join(map(re.escape, SENTENCE_DELIMITERS)))
+
+CHARACTER_RULE_CACHE_SIZE = 256
+
+_REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+
+
+def normalize_regex(regex: str) -> str:
+    if not regex.startswith("^") and not regex.startswith(".*"):
+        regex = f".*{regex}"
+
+    if not regex.endswith("$") and not regex.endswith(".*"):
+        regex = f"{regex}.*"
+
+    return regex
+
+
+def combine_prompts(prompt1: str, prompt2: str) -> str:
+    if prompt1 is None and prompt2 is None:
+        return ""
+
+    if prompt1 is None or prompt1 == "":
+        return prompt2.strip(",").strip()
+
+    if prompt2 is None or prompt2 == "":
+        return prompt1.strip(",").strip()
+
+    return prompt1.strip(",").strip() + ", " + prompt2.strip(",").strip()
+
+
+@dataclass
+class GenerationRulesResult:
+    """
+    The combined outcome of all generation rules matching a context.
+    """
+
+    prompt: str = ""
+    negative_prompt: str = ""
+    skip_generation: bool = False
+    faceswaplab_force_enabled: bool | None = None
+    faceswaplab_overwrite_source_face: str | None = None
+    reactor_force_enabled: bool | None = None
+    reactor_overwrite_source_face: str | None = None
+
+
+@dataclass
+class CompiledGenerationRule:
+    """
+    A generation rule with its regex patterns compiled ahead of time.
+    """
+
+    index: int
+    rule: RegexGenerationRule
+    regex: re.Pattern | None
+    negative_regex: re.Pattern | None
+    match: frozenset[RegexGenerationRuleMatch] = field(default_factory=frozenset)
+
+    @property
+    def depends_on_character_only(self) -> bool:
+        return self.match <= {RegexGenerationRuleMatch.CHARACTER_NAME}
+
+    @property
+    def exact_character_name(self) -> str | None:
+        """
+        The character name if this rule is a plain `^Name$` character rule.
+        """
+
+        if (
+            self.rule.regex is None
+            or self.negative_regex is not None
+            or self.match != {RegexGenerationRuleMatch.CHARACTER_NAME}
+            or not self.rule.regex.startswith("^")
+            or not self.rule.regex.endswith("$")
+        ):
+            return None
+
+        name = self.rule.regex[1:-1]
+
+        if not name or any(x in _REGEX_METACHARACTERS for x in name):
+            return None
+
+        return name.casefold()
+
+    def is_match(self, targets: "RuleMatchTargets") -> bool:
+        if self.rule.match is None:
+            return True
+
+        match_against = targets.get(self.match)
+
+        if self.negative_regex is not None and any(
+            self.negative_regex.match(x) for x in match_against
+        ):
+            return False
+
+        if self.regex is not None and not any(
+            self.regex.match(x) for x in match_against
+        ):
+            return False
+
+        return True
+
+
+class RuleMatchTargets(object):
+    """
+    Lazily computes the texts rules are matched against, so that all rules
+    share a single sentence split per context.
+    """
+
+    def __init__(self, context: GenerationContext) -> None:
+        self._input_text = context.input_text or ""
+        self._output_text = context.output_text or ""
+        self._character_name = (
+            context.state.get("character_menu", None) if context.state else None
+        )
+
+    @cached_property
+    def character_name(self) -> str | None:
+        return self._character_name or None
+
+    @cached_property
+    def input(self) -> list[str]:
+        return [self._input_text.strip()] if self._input_text else []
+
+    @cached_property
+    def input_sentences(self) -> list[str]:
+        return _split_sentences(self._input_text)
+
+    @cached_property
+    def output(self) -> list[str]:
+        return [html.unescape(self._output_text).strip()] if self._output_text else []
+
+    @cached_property
+    def output_sentences(self) -> list[str]:
+        return _split_sentences(self._output_text)
+
+    def get(self, match: frozenset[RegexGenerationRuleMatch]) -> list[str]:
+        result: list[str] = []
+
+        if RegexGenerationRuleMatch.INPUT in match:
+            result += self.input
+
+        if RegexGenerationRuleMatch.INPUT_SENTENCE in match:
+            result += self.input_sentences
+
+        if RegexGenerationRuleMatch.OUTPUT in match:
+            result += self.output
+
+        if RegexGenerationRuleMatch.OUTPUT_SENTENCE in match:
+            result += self.output_sentences
+
+        if RegexGenerationRuleMatch.CHARACTER_NAME in match and self.character_name:
+            result.append(self.character_name)
+
+        return result
+
+
+class CompiledGenerationRules(object):
+    """
+    Generation rules compiled once per change of the generation_rules parameter.
+    """
+
+    def __init__(self, rules: list[dict] | None) -> None:
+        self.rules: list[CompiledGenerationRule] = []
+
+        # rules that depend only on the character name are indexed by name
+        # (exact `^Name$` rules) or evaluated once per character and memoized
+        self._character_rules_by_name: dict[str, list[CompiledGenerationRule]] = {}
+        self._character_rules: list[CompiledGenerationRule] = []
+        self._other_rules: list[CompiledGenerationRule] = []
+        self._character_matches: OrderedDict[str | None, list[int]] = OrderedDict()
+        self._rules_by_index: dict[int, CompiledGenerationRule] = {}
+
+        for index, rule in enumerate(rules or []):
+            try:
+                compiled_rule = _compile_rule(index, rule)
+            except Exception as e:
+                logger.error(
+                    "[SD WebUI Integration] Failed to compile rule: %s: %s",
+                    rule.get("regex", None) if isinstance(rule, dict) else rule,
+                    e,
+                    exc_info=True,
+                )
+                continue
+
+            self.rules.append(compiled_rule)
+            self._rules_by_index[index] = compiled_rule
+
+            if not compiled_rule.depends_on_character_only:
+                self._other_rules.append(compiled_rule)
+                continue
+
+            name = compiled_rule.exact_character_name
+
+            if name is not None:
+                self._character_rules_by_name.setdefault(name, []).append(compiled_rule)
+            else:
+                self._character_rules.append(compiled_rule)
+
+    def get_matching_rules(
+        self, context: GenerationContext
+    ) -> list[CompiledGenerationRule]:
+        """
+        Returns all rules matching the given context in their original order.
+        """
+
+        targets = RuleMatchTargets(context)
+
+        matches = self._get_character_matches(targets) + [
+            rule.index for rule in self._other_rules if rule.is_match(targets)
+        ]
+
+        return [self._rules_by_index[x] for x in sorted(matches)]
+
+    def evaluate(self, context: GenerationContext) -> GenerationRulesResult:
+        """
+        Applies the actions of all rules matching the given context.
+        """
+
+        result = GenerationRulesResult()
+
+        for rule in self.get_matching_rules(context):
+            for action in rule.rule.actions:
+                _apply_action(action, result)
+
+                if result.skip_generation:
+                    return result
+
+        return result
+
+    def _get_character_matches(self, targets: RuleMatchTargets) -> list[int]:
+        character_name = targets.character_name
+
+        if character_name in self._character_matches:
+            self._character_matches.move_to_end(character_name)
+            return self._character_matches[character_name]
+
+        candidates = list(self._character_rules)
+
+        if character_name:
+            # "$" also matches right before a trailing newline
+            candidates += self._character_rules_by_name.get(
+                character_name.removesuffix("\n").casefold(), []
+            )
+
+        matches = [rule.index for rule in candidates if rule.is_match(targets)]
+
+        self._character_matches[character_name] = matches
+
+        if len(self._character_matches) > CHARACTER_RULE_CACHE_SIZE:
+            self._character_matches.popitem(last=False)
+
+        return matches
+
+
+_compiled_rules: CompiledGenerationRules | None = None
+_compiled_rules_source: list[dict] | None = None
+
+
+def get_compiled_generation_rules(
+    rules: list[dict] | None,
+) -> CompiledGenerationRules:
+    """
+    Returns the compiled form of the given generation rules.
+    Rules are only recompiled if they have changed since the last call.
+    """
+
+    global _compiled_rules, _compiled_rules_source
+
+    if _compiled_rules is None or _compiled_rules_source != rules:
+        _compiled_rules = CompiledGenerationRules(rules)
+        _compiled_rules_source = copy.deepcopy(rules)
+
+    return _compiled_rules
+
+
+def _compile_rule(index: int, rule: dict) -> CompiledGenerationRule:
+    typed_rule = RegexGenerationRule.from_dict(rule)
+
+    return CompiledGenerationRule(
+        index=index,
+        rule=typed_rule,
+        regex=(
+            re.compile(normalize_regex(typed_rule.regex), re.IGNORECASE)
+            if typed_rule.regex is not None
+            else None
+        ),
+        negative_regex=(
+            re.compile(normalize_regex(typed_rule.negative_regex), re.IGNORECASE)
+            if typed_rule.negative_regex is not None
+            else None
+        ),
+        match=frozenset(typed_rule.match or []),
+    )
+
+
+def _apply_action(action: RegexGenerationAction, result: GenerationRulesResult) -> None:
+    match action.name:
+        case "skip_generation":
+            result.skip_generation = True
+        case "prompt_append" if action.args is not None:
+            result.prompt = combine_prompts(result.prompt, action.args)
+        case "negative_prompt_append" if action.args is not None:
+            result.negative_prompt = combine_prompts(
+                result.negative_prompt, action.args
+            )
+        case "faceswaplab_enable":
+            result.faceswaplab_force_enabled = True
+        case "faceswaplab_disable":
+            result.faceswaplab_force_enabled = False
+        case "faceswaplab_set_source_face" if action.args is not None:
+            result.faceswaplab_overwrite_source_face = action.args
+        case "reactor_enable":
+            result.reactor_force_enabled = True
+        case "reactor_disable":
+            result.reactor_force_enabled = False
+        case "reactor_set_source_face" if action.args is not None:
+            result.reactor_overwrite_source_face = action.args
+
+
+def _split_sentences(text: str) -> list[str]:
+    if not text:
+        return []
+
+    return [
+        x.strip() for x in SENTENCE_DELIMITERS_PATTERN.split(text) if x.strip() != ""
+    ]
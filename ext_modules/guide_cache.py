@@ -0,0 +1,285 @@
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Any
+import numpy as np
+from outlines.fsm.guide import RegexGuide
+from modules.logging_colors import logger
+from .metrics import guide_cache_lookups, measure_stage
+from .result_cache import create_cache_key
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# compiled guides kept in memory, e.g. for switching between a few schemas
+MEMORY_CACHE_SIZE = 4
+
+# increased whenever the layout of the stored arrays changes
+FORMAT_VERSION = 1
+
+try:
+    OUTLINES_VERSION = version("outlines")
+except PackageNotFoundError:
+    OUTLINES_VERSION = "unknown"
+
+_fingerprint: tuple[weakref.ref, str] | None = None
+_fingerprint_lock = threading.Lock()
+
+
+def get_tokenizer_fingerprint(tokenizer: Any) -> str:
+    """
+    Returns a hash of everything the compiled guides depend on: the tokenizer class,
+    its vocabulary and its special tokens. Only computed once per tokenizer.
+    """
+
+    global _fingerprint
+
+    with _fingerprint_lock:
+        if _fingerprint is not None and _fingerprint[0]() is tokenizer:
+            return _fingerprint[1]
+
+        digest = hashlib.sha256()
+        digest.update(type(tokenizer).__qualname__.encode())
+        digest.update(repr(tokenizer.eos_token_id).encode())
+        digest.update(repr(sorted(tokenizer.all_special_tokens)).encode())
+
+        for token, token_id in sorted(
+            tokenizer.get_vocab().items(), key=lambda x: x[1]
+        ):
+            digest.update(f"{token_id}\0{token}\0".encode(errors="surrogatepass"))
+
+        fingerprint = digest.hexdigest()
+
+        try:
+            _fingerprint = (weakref.ref(tokenizer), fingerprint)
+        except TypeError:
+            _fingerprint = None
+
+        return fingerprint
+
+
+class GuideCache(object):
+    """
+    Caches compiled regex guides in memory and on disk, so that they do not have to
+    be rebuilt from the whole vocabulary after a restart or a schema change.
+    Every guide is stored as "<key>.npz" holding flat integer arrays, which load
+    without unpickling, and least recently used guides are evicted once the byte
+    budget is exceeded.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        memory_entries: int = MEMORY_CACHE_SIZE,
+    ) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._guides: OrderedDict[str, RegexGuide] = OrderedDict()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_entries()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get_or_compile(self, regex_string: str, tokenizer: Any) -> RegexGuide:
+        """
+        Returns the guide for the given regex and tokenizer, compiling and storing
+        it if it has not been cached yet.
+        """
+
+        key = create_cache_key(
+            FORMAT_VERSION,
+            OUTLINES_VERSION,
+            hashlib.sha256(regex_string.encode()).hexdigest(),
+            get_tokenizer_fingerprint(tokenizer),
+        )
+
+        with self._lock:
+            guide = self._guides.get(key, None)
+
+            if guide is not None:
+                self._guides.move_to_end(key)
+                guide_cache_lookups.inc(result="memory")
+                return guide
+
+            is_stored = key in self._entries
+
+            if is_stored:
+                self._entries.move_to_end(key)
+
+        guide = self._load(key) if is_stored else None
+
+        if guide is not None:
+            guide_cache_lookups.inc(result="disk")
+        else:
+            guide_cache_lookups.inc(result="miss")
+
+            with measure_stage("guide_compile"):
+                guide = RegexGuide(regex_string, tokenizer)
+
+            self._store(key, guide)
+
+        with self._lock:
+            self._guides[key] = guide
+
+            while len(self._guides) > self.memory_entries:
+                self._guides.popitem(last=False)
+
+        return guide
+
+    def clear(self) -> None:
+        with self._lock:
+            self._guides.clear()
+
+            for key in list(self._entries):
+                self._remove_entry(key)
+
+    def _get_path(self, key: str) -> Path:
+        return self.directory / f"{key}.npz"
+
+    def _load(self, key: str) -> RegexGuide | None:
+        path = self._get_path(key)
+
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                guide = _deserialize_guide(data)
+
+            # keeps the order of recently used guides across restarts
+            os.utime(path)
+            return guide
+        except Exception as e:
+            logger.warning(
+                "[SD WebUI Integration] Failed to read cached guide %s: %s", key, e
+            )
+
+            with self._lock:
+                self._remove_entry(key)
+
+            return None
+
+    def _store(self, key: str, guide: RegexGuide) -> None:
+        path = self._get_path(key)
+        temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+            # a file object keeps numpy from appending another ".npz"
+            with open(temp_path, "wb") as file:
+                np.savez(file, **_serialize_guide(guide))
+
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(
+                "[SD WebUI Integration] Failed to cache guide %s: %s", key, e
+            )
+            temp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            self._remove_entry(key, delete_file=False)
+            self._entries[key] = path.stat().st_size
+            self._size += self._entries[key]
+
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove_entry(next(iter(self._entries)))
+
+    def _load_entries(self) -> None:
+        if not self.directory.is_dir():
+            return
+
+        files = sorted(
+            (x for x in self.directory.glob("*.npz") if x.is_file()),
+            key=lambda x: x.stat().st_mtime_ns,
+        )
+
+        for file in files:
+            self._entries[file.stem] = file.stat().st_size
+            self._size += self._entries[file.stem]
+
+        while self._size > self.max_bytes and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    def _remove_entry(self, key: str, delete_file: bool = True) -> None:
+        size = self._entries.pop(key, None)
+
+        if size is None:
+            return
+
+        self._size -= size
+
+        if delete_file:
+            self._get_path(key).unlink(missing_ok=True)
+
+
+def _serialize_guide(guide: RegexGuide) -> dict[str, np.ndarray]:
+    """
+    Flattens the transitions of all states into parallel arrays.
+    """
+
+    transitions = guide.states_to_token_maps.values()
+
+    return {
+        "states": np.fromiter(guide.states_to_token_maps.keys(), dtype=np.int32),
+        "counts": np.fromiter((len(x) for x in transitions), dtype=np.int32),
+        "tokens": np.fromiter((y for x in transitions for y in x), dtype=np.int32),
+        "next_states": np.fromiter(
+            (y for x in transitions for y in x.values()), dtype=np.int32
+        ),
+        "empty_token_ids": np.fromiter(guide.empty_token_ids, dtype=np.int32),
+        "final_states": np.fromiter(guide.final_states, dtype=np.int32),
+        "eos_token_id": np.array(
+            [] if guide.eos_token_id is None else [guide.eos_token_id], dtype=np.int64
+        ),
+    }
+
+
+def _deserialize_guide(data: Any) -> RegexGuide:
+    tokens = data["tokens"].tolist()
+    next_states = data["next_states"].tolist()
+    states_to_token_maps: dict[int, dict[int, int]] = {}
+    offset = 0
+
+    for state, count in zip(data["states"].tolist(), data["counts"].tolist()):
+        states_to_token_maps[state] = dict(
+            zip(tokens[offset : offset + count], next_states[offset : offset + count])
+        )
+        offset += count
+
+    eos_token_id = data["eos_token_id"].tolist()
+
+    # the same attributes RegexGuide.__init__ sets after compiling
+    guide = RegexGuide.__new__(RegexGuide)
+    guide.states_to_token_maps = states_to_token_maps
+    guide.empty_token_ids = set(data["empty_token_ids"].tolist())
+    guide.eos_token_id = eos_token_id[0] if eos_token_id else None
+    guide.final_states = set(data["final_states"].tolist())
+    return guide
+
+
+_guide_caches: dict[Path, GuideCache] = {}
+_guide_caches_lock = threading.Lock()
+
+
+def get_guide_cache(directory: Path, max_bytes: int) -> GuideCache:
+    """
+    Returns the shared guide cache for the given directory.
+    """
+
+    with _guide_caches_lock:
+        cache = _guide_caches.get(directory, None)
+
+        if cache is None:
+            cache = GuideCache(directory, max_bytes)
+            _guide_caches[directory] = cache
+
+        cache.max_bytes = max_bytes
+        return cache
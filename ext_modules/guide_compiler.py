@@ -0,0 +1,183 @@
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+from transformers import PreTrainedTokenizerBase
+from modules import shared
+from modules.logging_colors import logger
+from ..params import GuideCompilationPolicy
+from ..params import StableDiffusionWebUiExtensionParams as Params
+from ..params import TriggerMode
+from ..transformers_logits import JSONLogitsProcessor
+from .guide_cache import GuideCache, get_guide_cache
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sd_guide")
+_compilation: "GuideCompilation | None" = None
+_compilation_lock = threading.Lock()
+
+
+@dataclass
+class GuideCompilation:
+    """
+    The compilation of the logits processor for a schema and a tokenizer.
+    """
+
+    schema: str
+    tokenizer: weakref.ref
+    future: Future = field(default_factory=Future)
+    start_time: float = field(default_factory=time.perf_counter)
+    end_time: float | None = None
+
+    def matches(self, schema: str, tokenizer: Any) -> bool:
+        return self.schema == schema and self.tokenizer() is tokenizer
+
+
+def compile_guide_in_background(params: Params) -> GuideCompilation | None:
+    """
+    Starts compiling the tool mode JSON schema for the current tokenizer, unless it
+    is being compiled or has been compiled already. Returns None if the output is
+    not constrained.
+    """
+
+    global _compilation
+
+    tokenizer = shared.tokenizer
+
+    if not _is_guide_required(params) or not isinstance(
+        tokenizer, PreTrainedTokenizerBase
+    ):
+        return None
+
+    schema = params.tool_mode_force_json_output_schema
+
+    with _compilation_lock:
+        if _compilation is not None and _compilation.matches(schema, tokenizer):
+            return _compilation
+
+        # e.g. while the schema is being edited, only the latest version is compiled
+        if _compilation is not None:
+            _compilation.future.cancel()
+
+        compilation = GuideCompilation(schema=schema, tokenizer=weakref.ref(tokenizer))
+        compilation.future = _executor.submit(
+            _compile, compilation, tokenizer, _get_guide_cache(params)
+        )
+        _compilation = compilation
+
+    return compilation
+
+
+def get_json_logits_processor(params: Params) -> JSONLogitsProcessor | None:
+    """
+    Returns the logits processor for the tool mode JSON schema. If it is still being
+    compiled, either waits for it or returns None, depending on the policy.
+    """
+
+    compilation = compile_guide_in_background(params)
+
+    if compilation is None:
+        return None
+
+    if not compilation.future.done():
+        if params.tool_mode_guide_compilation_policy == GuideCompilationPolicy.SKIP:
+            logger.warning(
+                "[SD WebUI Integration] JSON schema is still being compiled, "
+                "not forcing JSON output for this reply"
+            )
+            return None
+
+        logger.info(
+            "[SD WebUI Integration] Waiting for the JSON schema to be compiled..."
+        )
+
+    try:
+        return compilation.future.result(
+            timeout=params.tool_mode_guide_compilation_timeout or None
+        )
+    except FutureTimeoutError:
+        logger.warning(
+            "[SD WebUI Integration] JSON schema has not been compiled within %ss, "
+            "not forcing JSON output for this reply",
+            params.tool_mode_guide_compilation_timeout,
+        )
+    except Exception:
+        # logged when compiling
+        pass
+
+    return None
+
+
+def get_guide_compilation_status(params: Params) -> str:
+    """
+    Returns a short description of the state of the compilation. Does not start a
+    compilation, so it can be polled.
+    """
+
+    tokenizer = shared.tokenizer
+
+    if not _is_guide_required(params) or not isinstance(
+        tokenizer, PreTrainedTokenizerBase
+    ):
+        return "JSON schema: not used."
+
+    with _compilation_lock:
+        compilation = _compilation
+
+    if compilation is None or not compilation.matches(
+        params.tool_mode_force_json_output_schema, tokenizer
+    ):
+        return "JSON schema: not compiled yet."
+
+    if not compilation.future.done():
+        elapsed = time.perf_counter() - compilation.start_time
+        return f"JSON schema: compiling ({elapsed:.0f}s)..."
+
+    if compilation.future.cancelled() or compilation.future.exception() is not None:
+        return "JSON schema: compilation failed, check logs for errors."
+
+    assert compilation.end_time is not None
+    elapsed = compilation.end_time - compilation.start_time
+    return f"JSON schema: ready (took {elapsed:.1f}s)."
+
+
+def _compile(
+    compilation: GuideCompilation, tokenizer: Any, guide_cache: GuideCache | None
+) -> JSONLogitsProcessor:
+    try:
+        return JSONLogitsProcessor(
+            compilation.schema, tokenizer, guide_cache=guide_cache
+        )
+    except Exception as e:
+        logger.error(
+            "Failed to parse JSON schema: %s,\nSchema: %s",
+            repr(e),
+            compilation.schema,
+            exc_info=True,
+        )
+        raise
+    finally:
+        compilation.end_time = time.perf_counter()
+
+
+def _is_guide_required(params: Params) -> bool:
+    return (
+        params.trigger_mode == TriggerMode.TOOL
+        and params.tool_mode_force_json_output_enabled
+        and len((params.tool_mode_force_json_output_schema or "").strip()) > 0
+    )
+
+
+def _get_guide_cache(params: Params) -> GuideCache | None:
+    from ..script import EXTENSION_DIRECTORY_NAME
+
+    if not params.tool_mode_guide_cache_enabled:
+        return None
+
+    return get_guide_cache(
+        Path("extensions") / EXTENSION_DIRECTORY_NAME / "cache" / "guides",
+        max_bytes=params.tool_mode_guide_cache_max_size_mb * 1024 * 1024,
+    )
@@ -0,0 +1,146 @@
+import base64
+import io
+from dataclasses import dataclass
+from PIL import Image
+from ..params import ImageFormat
+from .lazy_image import LazyImage
+
+MIN_QUALITY = 30
+QUALITY_STEP = 15
+DOWNSCALE_FACTOR = 0.75
+MIN_DIMENSION = 64
+
+_MIME_TYPES = {
+    ImageFormat.WEBP: "image/webp",
+    ImageFormat.JPEG: "image/jpeg",
+    ImageFormat.PNG: "image/png",
+}
+
+
+@dataclass
+class EncodedImage:
+    """
+    An image encoded for being embedded into the chat.
+    """
+
+    data: bytes
+    image_format: ImageFormat
+    width: int
+    height: int
+
+    @property
+    def mime_type(self) -> str:
+        return _MIME_TYPES[self.image_format]
+
+    @property
+    def data_uri(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode()}"
+
+
+def encode_image(
+    image: LazyImage,
+    image_format: ImageFormat | str,
+    quality: int = 80,
+    max_dimension: int = 512,
+    max_bytes: int = 256 * 1024,
+) -> EncodedImage:
+    """
+    Downscales the image to fit into max_dimension and encodes it in the given
+    format. If the result exceeds max_bytes, the quality and then the dimensions
+    are reduced until it fits.
+    """
+
+    image_format = ImageFormat(str(image_format).lower())
+    source = _open(image)
+    width, height = _fit(source.size, max_dimension)
+
+    # images which already fit are used as received
+    if (
+        image.has_encoded_data
+        and (width, height) == source.size
+        and str(image.format).lower() == image_format.value
+        and len(image.data) <= max_bytes
+    ):
+        return EncodedImage(image.data, image_format, width, height)
+
+    pixels = _downscale(source, (width, height))
+    quality = max(MIN_QUALITY, min(100, quality))
+
+    while True:
+        data = _encode(pixels, image_format, quality)
+
+        if len(data) <= max_bytes:
+            break
+
+        if image_format != ImageFormat.PNG and quality > MIN_QUALITY:
+            quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+            continue
+
+        size = (
+            int(pixels.width * DOWNSCALE_FACTOR),
+            int(pixels.height * DOWNSCALE_FACTOR),
+        )
+
+        if min(size) < MIN_DIMENSION:
+            # the budget can not be met without making the image unrecognizable
+            break
+
+        pixels = pixels.resize(size, Image.Resampling.LANCZOS)
+
+    return EncodedImage(data, image_format, pixels.width, pixels.height)
+
+
+def _open(image: LazyImage) -> Image.Image:
+    if image.has_encoded_data:
+        # only reads the header, decoding happens when downscaling
+        return Image.open(io.BytesIO(image.data))
+
+    return image.image.copy()
+
+
+def _fit(size: tuple[int, int], max_dimension: int) -> tuple[int, int]:
+    width, height = size
+    scale = min(1, max_dimension / max(width, height)) if max_dimension > 0 else 1
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _downscale(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    if image.size == size:
+        image.load()
+        return image
+
+    # lets the JPEG decoder skip detail which would be thrown away anyway
+    image.draft(image.mode, size)
+
+    # cheap box reduction by whole factors before the final high quality resize
+    factor = min(image.width // size[0], image.height // size[1])
+
+    if factor >= 2:
+        image = image.reduce(factor)
+
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
+    return image
+
+
+def _encode(image: Image.Image, image_format: ImageFormat, quality: int) -> bytes:
+    buffer = io.BytesIO()
+
+    match image_format:
+        case ImageFormat.JPEG:
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+
+            image.save(buffer, format="JPEG", quality=quality)
+        case ImageFormat.WEBP:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA" if "A" in image.mode else "RGB")
+
+            image.save(buffer, format="WEBP", quality=quality)
+        case ImageFormat.PNG:
+            image.save(buffer, format="PNG")
+        case _:
+            raise ValueError(f"Unsupported image format: {image_format}")
+
+    return buffer.getvalue()
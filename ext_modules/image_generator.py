@@ -1,34 +1,42 @@
-import base64
 import dataclasses
+import hashlib
 import html
-import io
 import re
+import threading
 import time
-from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from datetime import date, datetime
 from pathlib import Path
-from typing import Any, cast
+from typing import Any, Callable, Iterator, cast
 from partial_json_parser import loads
-from PIL import Image
 from webuiapi import WebUIApiResult
 from modules.logging_colors import logger
-from ..context import GenerationContext
+from ..context import GenerationContext, get_session_id
 from ..params import (
     ContinuousModePromptGenerationMode,
     InteractiveModePromptGenerationMode,
-    RegexGenerationRuleMatch,
     TriggerMode,
 )
+from ..sd_client import SdBackend, SdWebUIApiBalancer
+from .generation_rules import (
+    GenerationRulesResult,
+    combine_prompts,
+    get_compiled_generation_rules,
+)
+from .image_encoder import EncodedImage, encode_image
+from .image_pipeline import ImagePipeline
+from .lazy_image import LazyImage
+from .metrics import export_metrics, measure_stage, result_cache_lookups
+from .output_index import OUTPUTS_DIRECTORY, get_output_index
+from .output_writer import output_writer
+from .progress import GenerationProgress, ProgressPoller
+from .result_cache import ResultCache, create_cache_key, get_result_cache
 from .vram_manager import VramReallocationTarget, attempt_vram_reallocation
 
-
-def normalize_regex(regex: str) -> str:
-    if not regex.startswith("^") and not regex.startswith(".*"):
-        regex = f".*{regex}"
-
-    if not regex.endswith("$") and not regex.endswith(".*"):
-        regex = f"{regex}.*"
-
-    return regex
+# options of stable-diffusion-webui which change the images besides the payload
+IMAGE_OPTIONS = ("sd_model_checkpoint", "sd_vae", "CLIP_stop_at_last_layers")
 
 
 def normalize_prompt(prompt: str) -> str:
@@ -59,166 +67,191 @@ def normalize_prompt(prompt: str) -> str:
     return ", ".join(tags)
 
 
-def generate_html_images_for_context(
-    context: GenerationContext,
-) -> tuple[str, str | None, str | None, str | None, str | None, str | None]:
+@dataclass
+class ImagePrompt:
     """
-    Generates images for the given context using Stable Diffusion
-    and returns the result as HTML output
+    The prompts for a single image generation call.
     """
 
-    attempt_vram_reallocation(VramReallocationTarget.STABLE_DIFFUSION, context)
+    prompt: str
+    negative_prompt: str
+    full_prompt: str
+    full_negative_prompt: str
+    count: int = 1
 
-    sd_client = context.sd_client
 
-    output_text = context.output_text or ""
+@dataclass
+class GeneratedImage:
+    """
+    A generated image together with the backend and cache entry it belongs to.
+    """
 
-    rules_prompt = ""
-    rules_negative_prompt = ""
+    image: LazyImage
+    backend: SdBackend | None = None
+    cache_key: str | None = None
+    index: int = 0
+    is_cached: bool = False
+    encoded: EncodedImage | None = None
+    parameters: dict[str, Any] = field(default_factory=dict)
+    seed: int | None = None
+    generation_time: float | None = None
 
-    faceswaplab_force_enabled: bool | None = None
-    faceswaplab_overwrite_source_face: str | None = None
 
-    reactor_force_enabled: bool | None = None
-    reactor_overwrite_source_face: str | None = None
+@dataclass
+class ImageGenerationRequest:
+    """
+    The prompts and rule outcomes required for generating images for a context.
+    """
 
-    if context.params.generation_rules:
-        for rule in context.params.generation_rules:
-            try:
-                match_against = []
-
-                delimiters = ".", ",", "!", "?", "\n", "*", '"'
-                delimiters_regex_pattern = "|".join(map(re.escape, delimiters))
-
-                if "match" in rule:
-                    if (
-                        context.input_text
-                        and context.input_text != ""
-                        and RegexGenerationRuleMatch.INPUT.value in rule["match"]
-                    ):
-                        match_against.append(context.input_text.strip())
-
-                    if (
-                        context.input_text
-                        and context.input_text != ""
-                        and RegexGenerationRuleMatch.INPUT_SENTENCE.value
-                        in rule["match"]
-                    ):
-                        match_against += [
-                            x.strip()
-                            for x in re.split(
-                                delimiters_regex_pattern, context.input_text
-                            )
-                            if x.strip() != ""
-                        ]
-
-                    if (
-                        output_text
-                        and output_text != ""
-                        and RegexGenerationRuleMatch.OUTPUT.value in rule["match"]
-                    ):
-                        match_against.append(html.unescape(output_text).strip())
-
-                    if (
-                        output_text
-                        and output_text != ""
-                        and RegexGenerationRuleMatch.OUTPUT_SENTENCE.value
-                        in rule["match"]
-                    ):
-                        match_against += [
-                            x.strip()
-                            for x in re.split(delimiters_regex_pattern, output_text)
-                            if x.strip() != ""
-                        ]
-
-                    if (
-                        context.state
-                        and "character_menu" in context.state
-                        and context.state["character_menu"]
-                        and context.state["character_menu"] != ""
-                        and RegexGenerationRuleMatch.CHARACTER_NAME.value
-                        in rule["match"]
-                    ):
-                        match_against.append(context.state["character_menu"])
-
-                    if "negative_regex" in rule and any(
-                        re.match(
-                            normalize_regex(rule["negative_regex"]), x, re.IGNORECASE
-                        )
-                        for x in match_against
-                    ):
-                        continue
-
-                    if "regex" in rule and not any(
-                        re.match(normalize_regex(rule["regex"]), x, re.IGNORECASE)
-                        for x in match_against
-                    ):
-                        continue
-
-                if "actions" not in rule:
-                    continue
+    output_text: str
+    rules: GenerationRulesResult
+    should_generate: bool = False
+    prompts: list[ImagePrompt] = field(default_factory=list)
 
-                for action in rule["actions"]:
-                    if action["name"] == "skip_generation":
-                        return (
-                            output_text,
-                            None,
-                            "",
-                            "",
-                            context.params.base_prompt,
-                            context.params.base_negative_prompt,
-                        )
+    @property
+    def prompt(self) -> str | None:
+        return self.prompts[0].prompt if self.prompts else None
 
-                    if action["name"] == "prompt_append" and "args" in action:
-                        rules_prompt = _combine_prompts(rules_prompt, action["args"])
+    @property
+    def negative_prompt(self) -> str | None:
+        return self.prompts[0].negative_prompt if self.prompts else None
 
-                    if action["name"] == "negative_prompt_append" "args" in action:
-                        rules_negative_prompt += _combine_prompts(
-                            rules_negative_prompt, action["args"]
-                        )
+    @property
+    def full_prompt(self) -> str | None:
+        return self.prompts[0].full_prompt if self.prompts else None
 
-                    if action["name"] == "faceswaplab_enable":
-                        faceswaplab_force_enabled = True
+    @property
+    def full_negative_prompt(self) -> str | None:
+        return self.prompts[0].full_negative_prompt if self.prompts else None
 
-                    if action["name"] == "faceswaplab_disable":
-                        faceswaplab_force_enabled = False
 
-                    if (
-                        action["name"] == "faceswaplab_set_source_face"
-                        and "args" in action
-                    ):
-                        faceswaplab_overwrite_source_face = action["args"]
+class GenerationJob(object):
+    """
+    The image generation of a request, which can be interrupted from another thread.
+    Keeps track of the backends currently generating its images, so that only those
+    are interrupted. Jobs whose images might not be used (e.g. started before the
+    reply was completed) defer saving them until they are accepted.
+    """
+
+    def __init__(self, defer_outputs: bool = False) -> None:
+        self.is_interrupted = False
+        self._is_accepted = not defer_outputs
+        self._backends: list[SdBackend] = []
+        self._outputs: list[Callable[[], Any]] = []
+        self._lock = threading.Lock()
 
-                    if action["name"] == "reactor_enable":
-                        reactor_force_enabled = True
+    @property
+    def backends(self) -> list[SdBackend]:
+        with self._lock:
+            return list(self._backends)
 
-                    if action["name"] == "reactor_disable":
-                        reactor_force_enabled = False
+    @contextmanager
+    def track(self, backend: SdBackend) -> Iterator[None]:
+        """
+        Records the backend while it generates images for the job.
+        """
 
-                    if action["name"] == "reactor_set_source_face" and "args" in action:
-                        reactor_overwrite_source_face = action["args"]
+        with self._lock:
+            self._backends.append(backend)
 
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._backends.remove(backend)
+
+    def interrupt(self) -> None:
+        """
+        Interrupts the backends generating images for the job. Images generated
+        afterwards are discarded instead of being cached or saved.
+        """
+
+        with self._lock:
+            self.is_interrupted = True
+            backends = list(self._backends)
+
+        for backend in backends:
+            try:
+                backend.client.interrupt()
             except Exception as e:
-                logger.error(
-                    f"[SD WebUI Integration] Failed to apply rule: {rule['regex']}: %s",
+                logger.warning(
+                    "[SD WebUI Integration] Failed to interrupt %s: %s",
+                    backend.endpoint,
                     e,
-                    exc_info=True,
                 )
 
-    context_prompt = None
+    def save(self, write: Callable[[], Any]) -> None:
+        """
+        Saves an output of the job right away, or once the job has been accepted.
+        """
+
+        with self._lock:
+            if not self._is_accepted:
+                self._outputs.append(write)
+                return
+
+        write()
+
+    def accept(self) -> None:
+        """
+        Saves the deferred outputs, as the images of the job are used.
+        """
+
+        with self._lock:
+            self._is_accepted = True
+            outputs = self._outputs
+            self._outputs = []
+
+        for write in outputs:
+            write()
+
+
+def create_generation_request(context: GenerationContext) -> ImageGenerationRequest:
+    """
+    Evaluates the generation rules and builds the image generation prompts
+    for the given context without generating any images yet.
+    """
+
+    with measure_stage("prompt"):
+        return _create_generation_request(context)
+
+
+def _create_generation_request(context: GenerationContext) -> ImageGenerationRequest:
+    output_text = context.output_text or ""
+
+    generation_rules = get_compiled_generation_rules(context.params.generation_rules)
+
+    with measure_stage("rules"):
+        rules = generation_rules.evaluate(context)
+
+    if rules.skip_generation:
+        return ImageGenerationRequest(
+            output_text=output_text,
+            rules=rules,
+            prompts=[
+                ImagePrompt(
+                    prompt="",
+                    negative_prompt="",
+                    full_prompt=context.params.base_prompt,
+                    full_negative_prompt=context.params.base_negative_prompt,
+                )
+            ],
+        )
+
+    context_prompts: list[str] = []
 
     if context.params.trigger_mode == TriggerMode.INTERACTIVE and (
         context.params.interactive_mode_prompt_generation_mode
         == InteractiveModePromptGenerationMode.GENERATED_TEXT
         or InteractiveModePromptGenerationMode.DYNAMIC
     ):
-        context_prompt = html.unescape(output_text or "")
+        context_prompts = [html.unescape(output_text or "")]
 
     if context.params.trigger_mode == TriggerMode.CONTINUOUS and (
         context.params.continuous_mode_prompt_generation_mode
         == ContinuousModePromptGenerationMode.GENERATED_TEXT
     ):
-        context_prompt = html.unescape(output_text or "")
+        context_prompts = [html.unescape(output_text or "")]
 
     if context.params.trigger_mode == TriggerMode.TOOL:
         output_text = html.unescape(output_text or "").strip()
@@ -328,7 +361,7 @@ def generate_html_images_for_context(
                     "generate image",
                     "generateimage",
                 ]:
-                    context_prompt = (
+                    context_prompts.append(
                         tool_params.get("text", None)
                         or tool_params.get("prompt", None)
                         or tool_params.get("query", None)
@@ -346,16 +379,31 @@ def generate_html_images_for_context(
                         "\n" + output_text if output_text else ""
                     )
 
-    if context_prompt is None:
-        return (
-            output_text,
-            None,
-            None,
-            None,
-            None,
-            None,
-        )
+    if not context_prompts:
+        return ImageGenerationRequest(output_text=output_text, rules=rules)
+
+    prompts: dict[str, ImagePrompt] = {}
+
+    for context_prompt in context_prompts:
+        image_prompt = _create_image_prompt(context, rules, context_prompt)
+
+        # identical prompts are generated in a single batch
+        if image_prompt.full_prompt in prompts:
+            prompts[image_prompt.full_prompt].count += 1
+        else:
+            prompts[image_prompt.full_prompt] = image_prompt
 
+    return ImageGenerationRequest(
+        output_text=output_text,
+        rules=rules,
+        should_generate=True,
+        prompts=list(prompts.values()),
+    )
+
+
+def _create_image_prompt(
+    context: GenerationContext, rules: GenerationRulesResult, context_prompt: str
+) -> ImagePrompt:
     if ":" in context_prompt:
         context_prompt = (
             ", ".join(context_prompt.split(":")[1:])
@@ -369,206 +417,602 @@ def generate_html_images_for_context(
             .lower()
         )
 
-    generated_prompt = _combine_prompts(rules_prompt, normalize_prompt(context_prompt))
-    generated_negative_prompt = rules_negative_prompt
+    generated_prompt = combine_prompts(rules.prompt, normalize_prompt(context_prompt))
+    generated_negative_prompt = rules.negative_prompt
 
-    full_prompt = _combine_prompts(generated_prompt, context.params.base_prompt)
+    full_prompt = combine_prompts(generated_prompt, context.params.base_prompt)
 
-    full_negative_prompt = _combine_prompts(
+    full_negative_prompt = combine_prompts(
         generated_negative_prompt, context.params.base_negative_prompt
     )
 
-    debug_info = (
-        (
-            f"\n"
-            f"  Prompt: {full_prompt}\n"
-            f"  Negative Prompt: {full_negative_prompt}"
-        )
-        if context.params.debug_mode_enabled
-        else ""
+    return ImagePrompt(
+        prompt=generated_prompt,
+        negative_prompt=generated_negative_prompt,
+        full_prompt=full_prompt,
+        full_negative_prompt=full_negative_prompt,
     )
 
-    logger.info(
-        "[SD WebUI Integration] Using stable-diffusion-webui to generate images. %s",
-        debug_info,
+
+def generate_html_images_for_context(
+    context: GenerationContext,
+) -> tuple[str, str | None, str | None, str | None, str | None, str | None]:
+    """
+    Generates images for the given context using Stable Diffusion
+    and returns the result as HTML output
+    """
+
+    request = create_generation_request(context)
+
+    images_html = (
+        generate_html_images(context, request) if request.should_generate else None
+    )
+
+    return (
+        request.output_text,
+        images_html,
+        request.prompt,
+        request.negative_prompt,
+        request.full_prompt,
+        request.full_negative_prompt,
+    )
+
+
+def generate_html_images(
+    context: GenerationContext,
+    request: ImageGenerationRequest,
+    job: GenerationJob | None = None,
+) -> str | None:
+    """
+    Generates images for a previously created request using Stable Diffusion
+    and returns them as HTML output
+    """
+
+    try:
+        with measure_stage("total"):
+            return _generate_html_images(context, request, job or GenerationJob())
+    finally:
+        export_metrics(context.params.metrics_file)
+
+
+def _generate_html_images(
+    context: GenerationContext, request: ImageGenerationRequest, job: GenerationJob
+) -> str | None:
+    rules = request.rules
+
+    for image_prompt in request.prompts:
+        debug_info = (
+            (
+                f"\n"
+                f"  Prompt: {image_prompt.full_prompt}\n"
+                f"  Negative Prompt: {image_prompt.full_negative_prompt}"
+            )
+            if context.params.debug_mode_enabled
+            else ""
+        )
+
+        logger.info(
+            "[SD WebUI Integration] Using stable-diffusion-webui "
+            "to generate images. %s",
+            debug_info,
+        )
+
+    attempt_vram_reallocation(VramReallocationTarget.STABLE_DIFFUSION, context)
+
+    balancer = context.sd_balancer or SdWebUIApiBalancer([context.sd_client])
+    result_cache, image_options = _get_result_cache(context, balancer)
+
+    progress_poller = (
+        ProgressPoller(
+            lambda: next((x.client for x in job.backends), None),
+            interval=context.params.progress_polling_interval,
+            session_id=get_session_id(context.state) if context.state else None,
+            on_progress=(_log_progress if context.params.debug_mode_enabled else None),
+        )
+        if context.params.progress_polling_enabled
+        else nullcontext()
     )
 
     try:
-        response = sd_client.txt2img(
-            prompt=full_prompt,
-            negative_prompt=full_negative_prompt,
-            seed=context.params.seed,
-            sampler_name=context.params.sampler_name,
-            full_quality=True,
-            enable_hr=context.params.upscaling_enabled
-            or context.params.hires_fix_enabled,
-            hr_scale=context.params.upscaling_scale,
-            hr_upscaler=context.params.upscaling_upscaler,
-            denoising_strength=context.params.hires_fix_denoising_strength,
-            hr_sampler=context.params.hires_fix_sampler,
-            hr_force=context.params.hires_fix_enabled,
-            hr_second_pass_steps=(
-                context.params.hires_fix_sampling_steps
-                if context.params.hires_fix_enabled
-                else 0
-            ),
-            steps=context.params.sampling_steps,
-            cfg_scale=context.params.cfg_scale,
-            width=context.params.width,
-            height=context.params.height,
-            restore_faces=context.params.restore_faces_enabled,
-            faceid_enabled=context.params.faceid_enabled,
-            faceid_mode=context.params.faceid_mode,
-            faceid_model=context.params.faceid_model,
-            faceid_image=context.params.faceid_source_face,
-            faceid_scale=context.params.faceid_strength,
-            faceid_structure=context.params.faceid_structure,
-            faceid_rank=context.params.faceid_rank,
-            faceid_override_sampler=context.params.faceid_override_sampler,
-            faceid_tokens=context.params.faceid_tokens,
-            faceid_cache_model=context.params.faceid_cache_model,
-            ipadapter_enabled=context.params.ipadapter_enabled,
-            ipadapter_adapter=context.params.ipadapter_adapter,
-            ipadapter_scale=context.params.ipadapter_scale,
-            ipadapter_image=context.params.ipadapter_reference_image,
-            use_async=False,
+        # different prompts are generated concurrently, but the number of prompts
+        # depends on the reply, so at most as many as the backends can take at once
+        max_workers = min(
+            len(request.prompts),
+            len(balancer.backends) * max(1, context.params.api_connection_pool_size),
         )
 
-        response = cast(WebUIApiResult, response)
+        with (
+            progress_poller,
+            ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="sd_txt2img"
+            ) as executor,
+        ):
+            futures = [
+                executor.submit(
+                    _txt2img,
+                    context,
+                    balancer,
+                    job,
+                    result_cache,
+                    image_options,
+                    rules,
+                    x,
+                )
+                for x in request.prompts
+            ]
 
-        if len(response.images) == 0:
-            logger.error("[SD WebUI Integration] Failed to generate any images.")
-            return (
-                output_text,
-                None,
-                generated_prompt,
-                generated_negative_prompt,
-                full_prompt,
-                full_negative_prompt,
+        images: list[GeneratedImage] = []
+        failures: list[tuple[ImagePrompt, Exception]] = []
+
+        # a failed prompt does not discard the images of the other prompts
+        for image_prompt, future in zip(request.prompts, futures):
+            try:
+                images.extend(future.result())
+            except Exception as e:
+                failures.append((image_prompt, e))
+
+        # images of an interrupted job are incomplete
+        if job.is_interrupted:
+            logger.info("[SD WebUI Integration] Image generation was interrupted.")
+            return None
+
+        if failures and len(images) == 0:
+            raise failures[0][1]
+
+        for image_prompt, e in failures:
+            logger.error(
+                "[SD WebUI Integration] Failed to generate images for prompt %s: %s",
+                image_prompt.full_prompt,
+                e,
+                exc_info=e,
             )
 
-        formatted_result = ""
-        style = 'style="width: 100%; max-height: 100vh;"'
+        if len(images) == 0:
+            logger.error("[SD WebUI Integration] Failed to generate any images.")
+            return None
+
+        pipeline = ImagePipeline(
+            stages=[
+                lambda x: _swap_faces(context, balancer, rules, x),
+                lambda x: _cache_image(result_cache, x),
+                lambda x: _encode_image(context, x),
+                lambda x: _format_image(context, job, x),
+            ],
+            max_workers=context.params.image_processing_workers,
+        )
 
-        from ..script import EXTENSION_DIRECTORY_NAME
+        formatted_result = "\n".join(pipeline.run(images))
 
-        image: Image.Image
-        for image in response.images:
-            if faceswaplab_force_enabled or (
-                faceswaplab_force_enabled is None and context.params.faceswaplab_enabled
-            ):
-                if context.params.debug_mode_enabled:
-                    logger.info(
-                        "[SD WebUI Integration] Using FaceSwapLab to swap faces."
-                    )
+    finally:
+        attempt_vram_reallocation(VramReallocationTarget.LLM, context)
 
-                try:
-                    response = sd_client.faceswaplab_swap_face(
-                        image,
-                        params=dataclasses.replace(
-                            context.params,
-                            faceswaplab_source_face=(
-                                faceswaplab_overwrite_source_face
-                                if faceswaplab_overwrite_source_face is not None
-                                else context.params.faceswaplab_source_face
-                            ).replace(
-                                "{STABLE_DIFFUSION_EXTENSION_DIRECTORY}",
-                                f"./extensions/{EXTENSION_DIRECTORY_NAME}",
-                            ),
-                        ),
-                        use_async=False,
-                    )
-                    image = response.image  # type: ignore
-                except Exception as e:
-                    logger.error(
-                        "[SD WebUI Integration] FaceSwapLab failed to swap faces: %s",
-                        e,
-                        exc_info=True,
-                    )
+    if result_cache is not None and context.params.debug_mode_enabled:
+        logger.info(
+            "[SD WebUI Integration] Result cache: %d hits, %d misses, %d bytes.",
+            result_cache.hits,
+            result_cache.misses,
+            result_cache.size,
+        )
 
-            if reactor_force_enabled or (
-                reactor_force_enabled is None and context.params.reactor_enabled
-            ):
-                if context.params.debug_mode_enabled:
-                    logger.info("[SD WebUI Integration] Using ReActor to swap faces.")
-
-                try:
-                    response = sd_client.reactor_swap_face(
-                        image,
-                        params=dataclasses.replace(
-                            context.params,
-                            reactor_source_face=(
-                                reactor_overwrite_source_face
-                                if reactor_overwrite_source_face is not None
-                                else context.params.reactor_source_face
-                            ).replace(
-                                "{STABLE_DIFFUSION_EXTENSION_DIRECTORY}",
-                                f"./extensions/{EXTENSION_DIRECTORY_NAME}",
-                            ),
-                        ),
-                        use_async=False,
-                    )
-                    image = response.image  # type: ignore
-                except Exception as e:
-                    logger.error(
-                        "[SD WebUI Integration] ReActor failed to swap faces: %s",
-                        e,
-                        exc_info=True,
-                    )
+    return formatted_result
+
+
+def _get_result_cache(
+    context: GenerationContext, balancer: SdWebUIApiBalancer
+) -> tuple[ResultCache | None, dict[str, Any] | None]:
+    from ..script import EXTENSION_DIRECTORY_NAME
+
+    # only generations with a fixed seed are deterministic
+    if not context.params.result_cache_enabled or (
+        int(context.params.seed) == -1 and not context.params.seed_from_prompt_enabled
+    ):
+        return None, None
+
+    # images are only cached under options (e.g. the checkpoint) all backends use
+    try:
+        backend_options = [
+            {x: options.get(x, None) for x in IMAGE_OPTIONS}
+            for options in balancer.get_options()
+        ]
+    except Exception as e:
+        logger.warning(
+            "[SD WebUI Integration] Not using the result cache, "
+            "failed to get the current checkpoint: %s",
+            e,
+        )
+        return None, None
+
+    # e.g. while no backend is reachable
+    if not backend_options:
+        return None, None
+
+    if any(x != backend_options[0] for x in backend_options):
+        logger.warning(
+            "[SD WebUI Integration] Not using the result cache, "
+            "the backends use different image options: %s",
+            backend_options,
+        )
+        return None, None
+
+    image_options = backend_options[0]
 
-            if context.params.save_images:
-                character = (
-                    context.state.get("character_menu", "Default")
-                    if context.state
-                    else "Default"
+    result_cache = get_result_cache(
+        Path("extensions") / EXTENSION_DIRECTORY_NAME / "cache" / "results",
+        max_bytes=context.params.result_cache_max_size_mb * 1024 * 1024,
+    )
+
+    return result_cache, image_options
+
+
+def _log_progress(progress: GenerationProgress) -> None:
+    if progress.is_completed or progress.progress == 0:
+        return
+
+    logger.info(
+        "[SD WebUI Integration] Image generation progress: %d%% (ETA: %.1fs)",
+        progress.progress * 100,
+        progress.eta_relative,
+    )
+
+
+def _txt2img(
+    context: GenerationContext,
+    balancer: SdWebUIApiBalancer,
+    job: GenerationJob,
+    result_cache: ResultCache | None,
+    image_options: dict[str, Any] | None,
+    rules: GenerationRulesResult,
+    image_prompt: ImagePrompt,
+) -> list[GeneratedImage]:
+    arguments = _get_txt2img_arguments(context, image_prompt)
+    cache_key = None
+
+    if result_cache is not None:
+        cache_key = create_cache_key(
+            image_options, arguments, _get_post_processing_arguments(context, rules)
+        )
+
+        images = result_cache.get(
+            cache_key, arguments["batch_size"] * arguments["n_iter"]
+        )
+
+        result_cache_lookups.inc(result="miss" if images is None else "hit")
+
+        if images is not None:
+            if context.params.debug_mode_enabled:
+                logger.info("[SD WebUI Integration] Using cached images.")
+
+            return [
+                GeneratedImage(
+                    image,
+                    cache_key=cache_key,
+                    index=index,
+                    is_cached=True,
+                    parameters=arguments,
+                    seed=arguments["seed"] + index,
                 )
+                for index, image in enumerate(images)
+            ]
+
+    if job.is_interrupted:
+        return []
+
+    start_time = time.perf_counter()
+
+    with measure_stage("txt2img"):
+        response, backend = balancer.dispatch(
+            lambda sd_client: sd_client.txt2img(**arguments, use_async=False),
+            on_dispatch=job.track,
+        )
+
+    generation_time = time.perf_counter() - start_time
+
+    if context.params.debug_mode_enabled:
+        logger.info(
+            "[SD WebUI Integration] Generated images using %s.", backend.endpoint
+        )
+
+    result = cast(WebUIApiResult, response)
+    info = result.info if isinstance(result.info, dict) else {}
+    seeds = info.get("all_seeds", [])
+
+    # some backends return a grid (and e.g. control images) along with the images
+    first_image = int(info.get("index_of_first_image", 0) or 0)
+    images = result.images[
+        first_image : first_image + arguments["batch_size"] * arguments["n_iter"]
+    ]
+
+    # face swaps of an image are done by the backend which generated it
+    return [
+        GeneratedImage(
+            image,
+            backend=backend,
+            cache_key=cache_key,
+            index=index,
+            parameters=arguments,
+            seed=seeds[index] if index < len(seeds) else arguments["seed"],
+            generation_time=generation_time,
+        )
+        for index, image in enumerate(images)
+    ]
+
+
+def _get_seed(context: GenerationContext, image_prompt: ImagePrompt) -> int:
+    seed = int(context.params.seed)
+
+    if seed == -1 and context.params.seed_from_prompt_enabled:
+        digest = hashlib.sha256(
+            f"{image_prompt.full_prompt}\n{image_prompt.full_negative_prompt}".encode()
+        ).digest()
+
+        # stable-diffusion-webui uses 32-bit seeds
+        seed = int.from_bytes(digest[:4], "big")
+
+    return seed
+
+
+def _get_post_processing_arguments(
+    context: GenerationContext, rules: GenerationRulesResult
+) -> dict[str, Any]:
+    return {
+        key: value
+        for key, value in (vars(context.params) | vars(rules)).items()
+        if key.startswith("faceswaplab_") or key.startswith("reactor_")
+    }
+
+
+def _get_txt2img_arguments(
+    context: GenerationContext, image_prompt: ImagePrompt
+) -> dict[str, Any]:
+    return dict(
+        prompt=image_prompt.full_prompt,
+        negative_prompt=image_prompt.full_negative_prompt,
+        seed=_get_seed(context, image_prompt),
+        sampler_name=context.params.sampler_name,
+        full_quality=True,
+        enable_hr=context.params.upscaling_enabled or context.params.hires_fix_enabled,
+        hr_scale=context.params.upscaling_scale,
+        hr_upscaler=context.params.upscaling_upscaler,
+        denoising_strength=context.params.hires_fix_denoising_strength,
+        hr_sampler=context.params.hires_fix_sampler,
+        hr_force=context.params.hires_fix_enabled,
+        hr_second_pass_steps=(
+            context.params.hires_fix_sampling_steps
+            if context.params.hires_fix_enabled
+            else 0
+        ),
+        steps=context.params.sampling_steps,
+        cfg_scale=context.params.cfg_scale,
+        width=context.params.width,
+        height=context.params.height,
+        batch_size=context.params.batch_size * image_prompt.count,
+        n_iter=context.params.n_iter,
+        do_not_save_grid=True,
+        restore_faces=context.params.restore_faces_enabled,
+        faceid_enabled=context.params.faceid_enabled,
+        faceid_mode=context.params.faceid_mode,
+        faceid_model=context.params.faceid_model,
+        faceid_image=context.params.faceid_source_face,
+        faceid_scale=context.params.faceid_strength,
+        faceid_structure=context.params.faceid_structure,
+        faceid_rank=context.params.faceid_rank,
+        faceid_override_sampler=context.params.faceid_override_sampler,
+        faceid_tokens=context.params.faceid_tokens,
+        faceid_cache_model=context.params.faceid_cache_model,
+        ipadapter_enabled=context.params.ipadapter_enabled,
+        ipadapter_adapter=context.params.ipadapter_adapter,
+        ipadapter_scale=context.params.ipadapter_scale,
+        ipadapter_image=context.params.ipadapter_reference_image,
+    )
 
-                file = f'{date.today().strftime("%Y_%m_%d")}/{character}_{int(time.time())}'  # noqa: E501
 
-                # todo: do not hardcode extension path
-                output_file = Path(
-                    f"extensions/{EXTENSION_DIRECTORY_NAME}/outputs/{file}.png"
+def _swap_faces(
+    context: GenerationContext,
+    balancer: SdWebUIApiBalancer,
+    rules: GenerationRulesResult,
+    generated_image: GeneratedImage,
+) -> GeneratedImage:
+    from ..script import EXTENSION_DIRECTORY_NAME
+
+    # cached images have already been post-processed
+    if generated_image.is_cached:
+        return generated_image
+
+    image = generated_image.image
+    backend = generated_image.backend
+    cache_key = generated_image.cache_key
+
+    if rules.faceswaplab_force_enabled or (
+        rules.faceswaplab_force_enabled is None and context.params.faceswaplab_enabled
+    ):
+        if context.params.debug_mode_enabled:
+            logger.info("[SD WebUI Integration] Using FaceSwapLab to swap faces.")
+
+        try:
+            params = dataclasses.replace(
+                context.params,
+                faceswaplab_source_face=(
+                    rules.faceswaplab_overwrite_source_face
+                    if rules.faceswaplab_overwrite_source_face is not None
+                    else context.params.faceswaplab_source_face
+                ).replace(
+                    "{STABLE_DIFFUSION_EXTENSION_DIRECTORY}",
+                    f"./extensions/{EXTENSION_DIRECTORY_NAME}",
+                ),
+            )
+
+            with measure_stage("faceswaplab"):
+                response, backend = balancer.dispatch(
+                    lambda sd_client: sd_client.faceswaplab_swap_face(
+                        image, params=params, use_async=False
+                    ),
+                    backend=backend,
                 )
-                output_file.parent.mkdir(parents=True, exist_ok=True)
-
-                image.save(output_file)
-                image_source = f"/file/{output_file}"
-            else:
-                # resize image to avoid huge logs
-                image.thumbnail((512, int(512 * image.height / image.width)))
-
-                buffered = io.BytesIO()
-                image.save(buffered, format="JPEG")
-                buffered.seek(0)
-                image_bytes = buffered.getvalue()
-                image_base64 = (
-                    "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode()
+
+            image = response.image  # type: ignore
+        except Exception as e:
+            logger.error(
+                "[SD WebUI Integration] FaceSwapLab failed to swap faces: %s",
+                e,
+                exc_info=True,
+            )
+
+            # do not cache images which are missing their post-processing
+            cache_key = None
+
+    if rules.reactor_force_enabled or (
+        rules.reactor_force_enabled is None and context.params.reactor_enabled
+    ):
+        if context.params.debug_mode_enabled:
+            logger.info("[SD WebUI Integration] Using ReActor to swap faces.")
+
+        try:
+            params = dataclasses.replace(
+                context.params,
+                reactor_source_face=(
+                    rules.reactor_overwrite_source_face
+                    if rules.reactor_overwrite_source_face is not None
+                    else context.params.reactor_source_face
+                ).replace(
+                    "{STABLE_DIFFUSION_EXTENSION_DIRECTORY}",
+                    f"./extensions/{EXTENSION_DIRECTORY_NAME}",
+                ),
+            )
+
+            with measure_stage("reactor"):
+                response, backend = balancer.dispatch(
+                    lambda sd_client: sd_client.reactor_swap_face(
+                        image, params=params, use_async=False
+                    ),
+                    backend=backend,
                 )
-                image_source = image_base64
 
-            formatted_result += f'<img src="{image_source}" {style}>\n'
+            image = response.image  # type: ignore
+        except Exception as e:
+            logger.error(
+                "[SD WebUI Integration] ReActor failed to swap faces: %s",
+                e,
+                exc_info=True,
+            )
 
-    finally:
-        attempt_vram_reallocation(VramReallocationTarget.LLM, context)
+            # do not cache images which are missing their post-processing
+            cache_key = None
 
-    return (
-        output_text,
-        formatted_result.rstrip("\n"),
-        generated_prompt,
-        generated_negative_prompt,
-        full_prompt,
-        full_negative_prompt,
+    return dataclasses.replace(
+        generated_image, image=image, backend=backend, cache_key=cache_key
     )
 
 
-def _combine_prompts(prompt1: str, prompt2: str) -> str:
-    if prompt1 is None and prompt2 is None:
-        return ""
+def _cache_image(
+    result_cache: ResultCache | None, generated_image: GeneratedImage
+) -> GeneratedImage:
+    if (
+        result_cache is not None
+        and generated_image.cache_key is not None
+        and not generated_image.is_cached
+    ):
+        with measure_stage("cache"):
+            result_cache.put(
+                generated_image.cache_key, generated_image.index, generated_image.image
+            )
+
+    return generated_image
+
+
+def _encode_image(
+    context: GenerationContext, generated_image: GeneratedImage
+) -> GeneratedImage:
+    # saved images are referenced by their path instead
+    if context.params.save_images:
+        return generated_image
+
+    with measure_stage("encode"):
+        encoded = encode_image(
+            generated_image.image,
+            context.params.inline_image_format,
+            quality=context.params.inline_image_quality,
+            max_dimension=context.params.inline_image_max_dimension,
+            max_bytes=context.params.inline_image_max_size_kb * 1024,
+        )
 
-    if prompt1 is None or prompt1 == "":
-        return prompt2.strip(",").strip()
+    return dataclasses.replace(generated_image, encoded=encoded)
 
-    if prompt2 is None or prompt2 == "":
-        return prompt1.strip(",").strip()
 
-    return prompt1.strip(",").strip() + ", " + prompt2.strip(",").strip()
+def _format_image(
+    context: GenerationContext, job: GenerationJob, generated_image: GeneratedImage
+) -> str:
+    style = 'style="width: 100%; max-height: 100vh;"'
+
+    if generated_image.encoded is not None:
+        image_source = generated_image.encoded.data_uri
+    else:
+        character = (
+            context.state.get("character_menu", "Default")
+            if context.state
+            else "Default"
+        )
+
+        output_directory = OUTPUTS_DIRECTORY / date.today().strftime("%Y_%m_%d")
+        metadata = _get_image_metadata(character, generated_image)
+
+        output_index = (
+            get_output_index(OUTPUTS_DIRECTORY / "index.sqlite3")
+            if context.params.output_index_enabled
+            else None
+        )
+
+        # the file is written in the background, but its path is known right away
+        output_file = output_writer.get_path(
+            generated_image.image,
+            output_directory,
+            name_prefix=character,
+            image_format=context.params.output_image_format,
+        )
+
+        job.save(
+            lambda: output_writer.submit(
+                generated_image.image,
+                output_directory,
+                name_prefix=character,
+                image_format=context.params.output_image_format,
+                png_compress_level=context.params.output_png_compress_level,
+                metadata=metadata,
+                on_written=(
+                    (lambda path: output_index.add(path, metadata))
+                    if output_index is not None
+                    else None
+                ),
+            )
+        )
+
+        image_source = f"/file/{output_file}"
+
+    return f'<img src="{image_source}" {style}>'
+
+
+def _get_image_metadata(
+    character: str, generated_image: GeneratedImage
+) -> dict[str, Any]:
+    parameters = generated_image.parameters
+
+    return {
+        "character": character,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "prompt": parameters.get("prompt", None),
+        "negative_prompt": parameters.get("negative_prompt", None),
+        "seed": generated_image.seed,
+        "generation_time": generated_image.generation_time,
+        "backend": (
+            generated_image.backend.endpoint
+            if generated_image.backend is not None
+            else None
+        ),
+        "is_cached": generated_image.is_cached,
+        # reference images are left out as they are large and not settings
+        "settings": {
+            key: value
+            for key, value in parameters.items()
+            if key
+            not in ("prompt", "negative_prompt", "faceid_image", "ipadapter_image")
+        },
+    }
@@ -0,0 +1,66 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable
+
+
+class ImagePipeline(object):
+    """
+    Runs each item through a sequence of stages, with every stage running on its
+    own worker pool. This allows e.g. the face swap of an image to overlap with
+    the encoding of the previous image. Results are returned in input order.
+    """
+
+    def __init__(
+        self, stages: list[Callable[[Any], Any]], max_workers: int = 1
+    ) -> None:
+        self.stages = stages
+        self.max_workers = max(1, max_workers)
+
+    def run(self, items: Iterable[Any]) -> list[Any]:
+        executors = [
+            ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix=f"sd_pipeline_{index}",
+            )
+            for index in range(len(self.stages))
+        ]
+
+        try:
+            results: list[Future] = []
+
+            for item in items:
+                result: Future = Future()
+                self._submit(executors, 0, item, result)
+                results.append(result)
+
+            return [x.result() for x in results]
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(
+        self,
+        executors: list[ThreadPoolExecutor],
+        stage_index: int,
+        value: Any,
+        result: Future,
+    ) -> None:
+        if stage_index == len(self.stages):
+            result.set_result(value)
+            return
+
+        try:
+            future = executors[stage_index].submit(self.stages[stage_index], value)
+        except RuntimeError as e:
+            # the pipeline has been shut down because an earlier item failed
+            result.set_exception(e)
+            return
+
+        def on_done(done: Future) -> None:
+            if done.cancelled():
+                result.cancel()
+            elif done.exception() is not None:
+                result.set_exception(done.exception())  # type: ignore
+            else:
+                self._submit(executors, stage_index + 1, done.result(), result)
+
+        future.add_done_callback(on_done)
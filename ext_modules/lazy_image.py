@@ -0,0 +1,161 @@
+import base64
+import io
+import os
+import threading
+from typing import Any
+from PIL import Image
+
+_SIGNATURES = {
+    b"\x89PNG\r\n\x1a\n": "PNG",
+    b"\xff\xd8\xff": "JPEG",
+    b"GIF87a": "GIF",
+    b"GIF89a": "GIF",
+}
+
+
+class LazyImage(object):
+    """
+    An image which keeps the encoded data it was received as and is only decoded
+    once its pixels are needed. This allows passing images from one API endpoint
+    to another (e.g. from txt2img to a face swap) without decoding and re-encoding.
+
+    Attributes which are not defined here are forwarded to the decoded PIL image,
+    so it can be used in place of one. In-place pixel operations have to be done
+    on the result of to_image() instead, as they would not update the encoded data.
+    """
+
+    def __init__(
+        self,
+        encoded: str | bytes | None = None,
+        image: Image.Image | None = None,
+    ) -> None:
+        assert encoded is not None or image is not None
+
+        if isinstance(encoded, str) and encoded.startswith("data:"):
+            encoded = encoded.split(",", 1)[1]
+
+        self._base64 = encoded if isinstance(encoded, str) else None
+        self._data = encoded if isinstance(encoded, bytes) else None
+        self._image = image
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_image(cls, image: "Image.Image | LazyImage") -> "LazyImage":
+        return image if isinstance(image, LazyImage) else cls(image=image)
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._image is not None
+
+    @property
+    def has_encoded_data(self) -> bool:
+        return self._base64 is not None or self._data is not None
+
+    @property
+    def data(self) -> bytes:
+        """
+        The encoded image, in PNG format if the image was created from pixels.
+        """
+
+        with self._lock:
+            if self._data is None:
+                if self._base64 is not None:
+                    self._data = base64.b64decode(self._base64)
+                else:
+                    assert self._image is not None
+                    buffer = io.BytesIO()
+                    self._image.save(buffer, format="PNG")
+                    self._data = buffer.getvalue()
+
+            return self._data
+
+    @property
+    def base64(self) -> str:
+        if self._base64 is None:
+            encoded = base64.b64encode(self.data).decode()
+
+            with self._lock:
+                self._base64 = encoded
+
+        return self._base64
+
+    @property
+    def format(self) -> str | None:
+        """
+        The format of the encoded image, determined without decoding it.
+        """
+
+        data = self.data
+
+        for signature, image_format in _SIGNATURES.items():
+            if data.startswith(signature):
+                return image_format
+
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            return "WEBP"
+
+        # only reads the header
+        with Image.open(io.BytesIO(data)) as image:
+            return image.format
+
+    @property
+    def image(self) -> Image.Image:
+        """
+        The decoded image.
+        """
+
+        data = self.data
+
+        with self._lock:
+            if self._image is None:
+                image = Image.open(io.BytesIO(data))
+                image.load()
+                self._image = image
+
+            return self._image
+
+    def to_image(self) -> Image.Image:
+        """
+        Returns a decoded image which can be modified in place without affecting
+        the encoded data of this image.
+        """
+
+        if not self.has_encoded_data:
+            return self.image.copy()
+
+        image = Image.open(io.BytesIO(self.data))
+        image.load()
+        return image
+
+    def save(self, fp: Any, format: str | None = None, **kwargs: Any) -> None:
+        """
+        Saves the image, writing the encoded data as-is if the format matches.
+        """
+
+        image_format = format
+
+        if image_format is None and not hasattr(fp, "write"):
+            extension = os.path.splitext(os.fspath(fp))[1].lower()
+            image_format = Image.registered_extensions().get(extension, None)
+
+        if (
+            not kwargs
+            and self.has_encoded_data
+            and image_format is not None
+            and image_format.upper() == self.format
+        ):
+            if hasattr(fp, "write"):
+                fp.write(self.data)
+            else:
+                with open(fp, "wb") as file:
+                    file.write(self.data)
+
+            return
+
+        self.image.save(fp, format=format, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        return getattr(self.image, name)
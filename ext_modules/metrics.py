@@ -0,0 +1,389 @@
+import bisect
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Iterator, TypeVar
+from modules.logging_colors import logger
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+T = TypeVar("T", bound="Metric")
+
+
+class Metric(object):
+    """
+    A metric with optional labels, rendered in the Prometheus text format.
+    """
+
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...]) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(x, "")) for x in self.labels)
+
+    def _format_labels(self, key: tuple[str, ...], **extra: str) -> str:
+        pairs = list(zip(self.labels, key)) + list(extra.items())
+
+        if not pairs:
+            return ""
+
+        return "{" + ",".join(f'{x}="{_escape(y)}"' for x, y in pairs) + "}"
+
+
+class Counter(Metric):
+    """
+    A monotonically increasing value per label set.
+    """
+
+    type_name = "counter"
+
+    def __init__(
+        self, name: str, documentation: str, labels: tuple[str, ...] = ()
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+
+        return super().render() + [
+            f"{self.name}{self._format_labels(key)} {_format_value(value)}"
+            for key, value in values
+        ]
+
+
+class Histogram(Metric):
+    """
+    Counts observed values (e.g. durations in seconds) in cumulative buckets.
+    """
+
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple[str, ...], tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def get_count(self, **labels: str) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted((x, (list(y[0]), y[1])) for x, y in self._values.items())
+
+        lines = super().render()
+
+        for key, (counts, total) in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                labels = self._format_labels(key, le=_format_value(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = self._format_labels(key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics which can be exported together.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: list[Metric] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: T) -> T:
+        with self._lock:
+            self._metrics.append(metric)
+
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+
+        return "\n".join(line for x in metrics for line in x.render()) + "\n"
+
+    def write(self, path: Path) -> None:
+        """
+        Writes the metrics to the given file, e.g. for node_exporter's textfile
+        collector. The file is replaced atomically.
+        """
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.tmp")
+        temp_path.write_text(self.render(), encoding="utf-8")
+        os.replace(temp_path, path)
+
+
+registry = MetricsRegistry()
+
+stage_duration = registry.register(
+    Histogram(
+        "sd_webui_stage_duration_seconds",
+        "Time spent in each stage of the image generation.",
+        labels=("stage",),
+    )
+)
+
+stage_errors = registry.register(
+    Counter(
+        "sd_webui_stage_errors_total",
+        "Number of failed image generation stages.",
+        labels=("stage",),
+    )
+)
+
+api_request_duration = registry.register(
+    Histogram(
+        "sd_webui_api_request_duration_seconds",
+        "Duration of the requests sent to stable-diffusion-webui.",
+        labels=("endpoint",),
+    )
+)
+
+api_requests = registry.register(
+    Counter(
+        "sd_webui_api_requests_total",
+        "Number of requests sent to stable-diffusion-webui.",
+        labels=("endpoint", "status"),
+    )
+)
+
+api_sent_bytes = registry.register(
+    Counter(
+        "sd_webui_api_sent_bytes_total",
+        "Request body bytes sent to stable-diffusion-webui.",
+        labels=("endpoint",),
+    )
+)
+
+api_received_bytes = registry.register(
+    Counter(
+        "sd_webui_api_received_bytes_total",
+        "Response body bytes received from stable-diffusion-webui.",
+        labels=("endpoint",),
+    )
+)
+
+result_cache_lookups = registry.register(
+    Counter(
+        "sd_webui_result_cache_lookups_total",
+        "Number of result cache lookups.",
+        labels=("result",),
+    )
+)
+
+early_generations = registry.register(
+    Counter(
+        "sd_webui_early_generations_total",
+        "Number of image generations started before the reply was completed.",
+        labels=("mode", "result"),
+    )
+)
+
+guide_cache_lookups = registry.register(
+    Counter(
+        "sd_webui_guide_cache_lookups_total",
+        "Number of compiled JSON schema guide lookups.",
+        labels=("result",),
+    )
+)
+
+
+@contextmanager
+def measure_stage(stage: str) -> Iterator[None]:
+    """
+    Records the duration of the enclosed stage and counts it as failed if it raises.
+    """
+
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    except BaseException:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_duration.observe(time.perf_counter() - start_time, stage=stage)
+
+
+def record_api_request(
+    endpoint: str,
+    status: int | str,
+    sent_bytes: int,
+    received_bytes: int,
+    duration: float,
+) -> None:
+    api_requests.inc(endpoint=endpoint, status=str(status))
+    api_sent_bytes.inc(sent_bytes, endpoint=endpoint)
+    api_received_bytes.inc(received_bytes, endpoint=endpoint)
+    api_request_duration.observe(duration, endpoint=endpoint)
+
+
+def export_metrics(file: str) -> None:
+    """
+    Writes the metrics to the given file, if any.
+    """
+
+    if not file:
+        return
+
+    try:
+        registry.write(Path(file))
+    except OSError as e:
+        logger.warning("[SD WebUI Integration] Failed to write metrics: %s", e)
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:  # noqa: N802
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+_server: ThreadingHTTPServer | None = None
+_server_address: tuple[str, int] | None = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(host: str, port: int) -> None:
+    """
+    Serves the metrics at http://<host>:<port>/metrics for Prometheus to scrape.
+    Restarts the server if the address has changed, a port of 0 stops it.
+    """
+
+    global _server, _server_address
+
+    with _server_lock:
+        if _server_address == (host, port):
+            return
+
+        if _server is not None:
+            _server.shutdown()
+            _server.server_close()
+            _server = None
+
+        _server_address = (host, port)
+
+        if port <= 0:
+            return
+
+        try:
+            _server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        except OSError as e:
+            logger.error(
+                "[SD WebUI Integration] Failed to start the metrics server "
+                "on %s:%d: %s",
+                host,
+                port,
+                e,
+            )
+            return
+
+        _server.daemon_threads = True
+
+        threading.Thread(
+            target=_server.serve_forever, name="sd_metrics_server", daemon=True
+        ).start()
+
+        logger.info(
+            "[SD WebUI Integration] Serving metrics on http://%s:%d/metrics.",
+            host,
+            port,
+        )
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
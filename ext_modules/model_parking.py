@@ -0,0 +1,144 @@
+import time
+from dataclasses import dataclass
+from typing import Any
+from modules.logging_colors import logger
+
+# keeps some host memory free for everything else after parking a model
+HOST_MEMORY_RESERVE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+@dataclass
+class ParkedModel:
+    """
+    A model which has been moved from its device to host memory.
+    """
+
+    model: Any
+    device: Any
+    size: int
+    park_time: float
+
+
+def park_model(
+    model: Any,
+    reserve_bytes: int = HOST_MEMORY_RESERVE_BYTES,
+    host_device: Any = "cpu",
+) -> ParkedModel | None:
+    """
+    Moves the given model to host memory, keeping the model object alive.
+    Returns None if the model can not be parked, e.g. because it is not a torch
+    model, is spread over multiple devices or does not fit into host memory.
+    The model is moved to host_device, which can be replaced e.g. for testing.
+    """
+
+    if model is None or not hasattr(model, "to") or not hasattr(model, "parameters"):
+        return None
+
+    device_map = getattr(model, "hf_device_map", None)
+
+    if isinstance(device_map, dict) and len(set(device_map.values())) > 1:
+        return None
+
+    device = get_model_device(model)
+
+    if device is None or str(device) == str(host_device):
+        return None
+
+    size = get_model_size(model)
+
+    # nothing to move, e.g. the parameters are not known to torch
+    if size == 0:
+        return None
+
+    available = get_available_host_memory()
+
+    if available is not None and size + reserve_bytes > available:
+        logger.warning(
+            "[SD WebUI Integration] Not enough host memory to park the LLM "
+            "(%d MB required, %d MB available).",
+            (size + reserve_bytes) // 2**20,
+            available // 2**20,
+        )
+        return None
+
+    start_time = time.perf_counter()
+
+    try:
+        model.to(host_device)
+    except Exception as e:
+        # e.g. quantized models can not be moved
+        logger.warning("[SD WebUI Integration] Failed to park the LLM: %s", e)
+
+        try:
+            model.to(device)
+        except Exception:
+            pass
+
+        return None
+
+    _empty_device_cache()
+    return ParkedModel(model, device, size, time.perf_counter() - start_time)
+
+
+def restore_model(parked_model: ParkedModel) -> float:
+    """
+    Moves a parked model back to its device and returns how long it took.
+    """
+
+    start_time = time.perf_counter()
+    parked_model.model.to(parked_model.device)
+    return time.perf_counter() - start_time
+
+
+def get_model_device(model: Any) -> Any | None:
+    try:
+        device = getattr(model, "device", None)
+    except Exception:
+        # e.g. transformers models raise StopIteration if they have no parameters
+        device = None
+
+    if device is not None:
+        return device
+
+    try:
+        return next(iter(model.parameters())).device
+    except (StopIteration, AttributeError, TypeError):
+        return None
+
+
+def get_model_size(model: Any) -> int:
+    tensors = list(model.parameters())
+
+    if hasattr(model, "buffers"):
+        tensors += list(model.buffers())
+
+    return sum(x.numel() * x.element_size() for x in tensors)
+
+
+def get_available_host_memory() -> int | None:
+    try:
+        import psutil
+
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+
+def _empty_device_cache() -> None:
+    try:
+        import torch
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
@@ -0,0 +1,317 @@
+import argparse
+import json
+import sqlite3
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+from modules.logging_colors import logger
+from .result_cache import create_cache_key
+
+IMAGE_SUFFIXES = (".png", ".webp", ".jpg", ".jpeg")
+
+# relative to the text-generation-webui folder, like the extension itself
+OUTPUTS_DIRECTORY = (
+    Path("extensions") / Path(__file__).resolve().parents[1].name / "outputs"
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    path TEXT PRIMARY KEY,
+    character TEXT,
+    prompt TEXT,
+    negative_prompt TEXT,
+    seed INTEGER,
+    settings_hash TEXT,
+    settings TEXT,
+    created_at TEXT,
+    generation_time REAL,
+    byte_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS outputs_character ON outputs (character, created_at);
+CREATE INDEX IF NOT EXISTS outputs_created_at ON outputs (created_at);
+CREATE INDEX IF NOT EXISTS outputs_settings_hash ON outputs (settings_hash);
+CREATE INDEX IF NOT EXISTS outputs_seed ON outputs (seed);
+"""
+
+_COLUMNS = (
+    "path",
+    "character",
+    "prompt",
+    "negative_prompt",
+    "seed",
+    "settings_hash",
+    "settings",
+    "created_at",
+    "generation_time",
+    "byte_size",
+)
+
+
+@dataclass
+class OutputRecord:
+    """
+    A generated image in the output index.
+    """
+
+    path: str
+    character: str | None = None
+    prompt: str | None = None
+    negative_prompt: str | None = None
+    seed: int | None = None
+    settings_hash: str | None = None
+    settings: dict | None = None
+    created_at: str | None = None
+    generation_time: float | None = None
+    byte_size: int | None = None
+
+    @classmethod
+    def from_metadata(cls, path: Path, metadata: dict[str, Any]) -> "OutputRecord":
+        """
+        Creates a record from the metadata sidecar of an image.
+        """
+
+        settings = metadata.get("settings", None)
+
+        return cls(
+            path=path.as_posix(),
+            character=metadata.get("character", None),
+            prompt=metadata.get("prompt", None),
+            negative_prompt=metadata.get("negative_prompt", None),
+            seed=metadata.get("seed", None),
+            settings_hash=create_cache_key(settings) if settings else None,
+            settings=settings,
+            created_at=metadata.get("created_at", None),
+            generation_time=metadata.get("generation_time", None),
+            byte_size=path.stat().st_size if path.exists() else None,
+        )
+
+
+class OutputIndex(object):
+    """
+    An SQLite index of the generated images in the outputs folder, which allows
+    looking up images without scanning the filesystem.
+    """
+
+    def __init__(self, database: Path) -> None:
+        database.parent.mkdir(parents=True, exist_ok=True)
+
+        self.database = database
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(_SCHEMA)
+
+    def add(self, path: Path, metadata: dict[str, Any]) -> None:
+        """
+        Adds or updates the record of the given image.
+        """
+
+        self._upsert([OutputRecord.from_metadata(path, metadata)])
+
+    def query(
+        self,
+        character: str | None = None,
+        prompt: str | None = None,
+        seed: int | None = None,
+        settings_hash: str | None = None,
+        since: datetime | str | None = None,
+        until: datetime | str | None = None,
+        limit: int = 100,
+        offset: int = 0,
+    ) -> list[OutputRecord]:
+        """
+        Returns the newest records matching all given filters.
+        The prompt filter matches any part of the prompt.
+        """
+
+        conditions = []
+        args: list[Any] = []
+
+        if character is not None:
+            conditions.append("character = ?")
+            args.append(character)
+
+        if prompt is not None:
+            conditions.append("prompt LIKE ? ESCAPE '\\'")
+            escaped = (
+                prompt.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            )
+            args.append(f"%{escaped}%")
+
+        if seed is not None:
+            conditions.append("seed = ?")
+            args.append(seed)
+
+        if settings_hash is not None:
+            conditions.append("settings_hash = ?")
+            args.append(settings_hash)
+
+        if since is not None:
+            conditions.append("created_at >= ?")
+            args.append(_to_timestamp(since))
+
+        if until is not None:
+            conditions.append("created_at < ?")
+            args.append(_to_timestamp(until))
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM outputs {where} "
+                "ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                (*args, limit, offset),
+            ).fetchall()
+
+        return [_to_record(row) for row in rows]
+
+    def count(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM outputs"
+            ).fetchone()
+
+        return count
+
+    def rebuild(self, outputs_directory: Path) -> int:
+        """
+        Replaces the index with the images found in the given outputs folder.
+        Images without a metadata sidecar are indexed with what can be derived
+        from their path. Returns the number of indexed images.
+        """
+
+        records = [
+            OutputRecord.from_metadata(path, _read_metadata(path))
+            for path in sorted(outputs_directory.rglob("*"))
+            if path.suffix.lower() in IMAGE_SUFFIXES and path.is_file()
+        ]
+
+        self._upsert(records, replace_all=True)
+
+        logger.info(
+            "[SD WebUI Integration] Rebuilt the output index with %d images.",
+            len(records),
+        )
+
+        return len(records)
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _upsert(self, records: list[OutputRecord], replace_all: bool = False) -> None:
+        rows = [
+            (
+                x.path,
+                x.character,
+                x.prompt,
+                x.negative_prompt,
+                x.seed,
+                x.settings_hash,
+                json.dumps(x.settings, default=str) if x.settings is not None else None,
+                x.created_at,
+                x.generation_time,
+                x.byte_size,
+            )
+            for x in records
+        ]
+
+        with self._lock, self._connection:
+            if replace_all:
+                self._connection.execute("DELETE FROM outputs")
+
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO outputs ({', '.join(_COLUMNS)}) "
+                f"VALUES ({', '.join('?' for _ in _COLUMNS)})",
+                rows,
+            )
+
+
+def _read_metadata(path: Path) -> dict[str, Any]:
+    sidecar = path.with_suffix(".json")
+
+    if sidecar.is_file():
+        try:
+            return json.loads(sidecar.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning(
+                "[SD WebUI Integration] Failed to read metadata of %s: %s", path, e
+            )
+
+    # older outputs are named "<character>_<timestamp>.png"
+    character, _, suffix = path.stem.rpartition("_")
+    created_at = None
+
+    if suffix.isdigit():
+        try:
+            created_at = datetime.fromtimestamp(int(suffix))
+        except (OverflowError, ValueError, OSError):
+            # e.g. a number in the name which is not a timestamp
+            pass
+
+    if created_at is None:
+        created_at = datetime.fromtimestamp(path.stat().st_mtime)
+
+    return {
+        "character": character or None,
+        "created_at": created_at.isoformat(timespec="seconds"),
+    }
+
+
+def _to_timestamp(value: datetime | str) -> str:
+    return value.isoformat(timespec="seconds") if isinstance(value, datetime) else value
+
+
+def _to_record(row: tuple) -> OutputRecord:
+    values = dict(zip(_COLUMNS, row))
+    values["settings"] = json.loads(values["settings"]) if values["settings"] else None
+    return OutputRecord(**values)
+
+
+_output_indexes: dict[Path, OutputIndex] = {}
+_output_indexes_lock = threading.Lock()
+
+
+def get_output_index(database: Path) -> OutputIndex:
+    """
+    Returns the shared output index stored in the given database file.
+    """
+
+    with _output_indexes_lock:
+        index = _output_indexes.get(database, None)
+
+        if index is None:
+            index = OutputIndex(database)
+            _output_indexes[database] = index
+
+        return index
+
+
+if __name__ == "__main__":
+    # e.g. python -m extensions.stable_diffusion.ext_modules.output_index rebuild
+    parser = argparse.ArgumentParser(description="Manages the output index.")
+    parser.add_argument("command", choices=["rebuild", "query"])
+    parser.add_argument("--outputs", type=Path, default=OUTPUTS_DIRECTORY)
+    parser.add_argument("--database", type=Path, default=None)
+    parser.add_argument("--character", default=None)
+    parser.add_argument("--prompt", default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--limit", type=int, default=20)
+    cli_args = parser.parse_args()
+
+    output_index = get_output_index(
+        cli_args.database or cli_args.outputs / "index.sqlite3"
+    )
+
+    if cli_args.command == "rebuild":
+        print(f"Indexed {output_index.rebuild(cli_args.outputs)} images.")
+    else:
+        for record in output_index.query(
+            character=cli_args.character,
+            prompt=cli_args.prompt,
+            seed=cli_args.seed,
+            limit=cli_args.limit,
+        ):
+            print(f"{record.created_at}  {record.seed}  {record.path}")
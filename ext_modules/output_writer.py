@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable
+from modules.logging_colors import logger
+from ..params import ImageFormat
+from .lazy_image import LazyImage
+from .metrics import measure_stage
+
+_EXTENSIONS = {
+    ImageFormat.PNG: "png",
+    ImageFormat.WEBP: "webp",
+    ImageFormat.JPEG: "jpg",
+}
+
+
+class OutputWriter(object):
+    """
+    Writes generated images and their metadata sidecars on a background thread.
+    File names are derived from the image content, so the final path is known
+    before anything has been written and images never overwrite each other.
+    """
+
+    def __init__(self, max_workers: int = 1) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="sd_output_writer"
+        )
+        self._pending: set[Future] = set()
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        image: LazyImage,
+        directory: Path,
+        name_prefix: str,
+        image_format: ImageFormat | str = ImageFormat.PNG,
+        png_compress_level: int = -1,
+        metadata: dict[str, Any] | None = None,
+        on_written: Callable[[Path], None] | None = None,
+    ) -> Path:
+        """
+        Queues the image to be written and returns the path it will be written to.
+        The callback is invoked on the writer thread once the image is on disk.
+        """
+
+        image_format = ImageFormat(str(image_format).lower())
+        path = self.get_path(image, directory, name_prefix, image_format)
+
+        future = self._executor.submit(
+            self._write,
+            image,
+            path,
+            image_format,
+            png_compress_level,
+            metadata,
+            on_written,
+        )
+
+        with self._lock:
+            self._pending.add(future)
+
+        future.add_done_callback(self._on_written)
+        return path
+
+    def get_path(
+        self,
+        image: LazyImage,
+        directory: Path,
+        name_prefix: str,
+        image_format: ImageFormat | str = ImageFormat.PNG,
+    ) -> Path:
+        """
+        Returns the path the image is written to, without writing it.
+        """
+
+        image_format = ImageFormat(str(image_format).lower())
+        content_hash = hashlib.sha256(image.data).hexdigest()[:16]
+        return directory / f"{name_prefix}_{content_hash}.{_EXTENSIONS[image_format]}"
+
+    def flush(self, timeout: float | None = None) -> None:
+        """
+        Waits until all queued images have been written.
+        """
+
+        with self._lock:
+            pending = list(self._pending)
+
+        wait(pending, timeout=timeout)
+
+    def _on_written(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+
+        if future.exception() is not None:
+            logger.error(
+                "[SD WebUI Integration] Failed to save image: %s",
+                future.exception(),
+                exc_info=future.exception(),
+            )
+
+    def _write(
+        self,
+        image: LazyImage,
+        path: Path,
+        image_format: ImageFormat,
+        png_compress_level: int,
+        metadata: dict[str, Any] | None,
+        on_written: Callable[[Path], None] | None,
+    ) -> None:
+        with measure_stage("save"):
+            self._write_files(image, path, image_format, png_compress_level, metadata)
+
+        if on_written is not None:
+            on_written(path)
+
+    def _write_files(
+        self,
+        image: LazyImage,
+        path: Path,
+        image_format: ImageFormat,
+        png_compress_level: int,
+        metadata: dict[str, Any] | None,
+    ) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(f".{path.name}.tmp")
+
+        match image_format:
+            case ImageFormat.PNG if png_compress_level < 0:
+                # written as received if stable-diffusion-webui returned a PNG
+                image.save(temp_path, format="PNG")
+            case ImageFormat.PNG:
+                image.image.save(
+                    temp_path, format="PNG", compress_level=png_compress_level
+                )
+            case ImageFormat.WEBP:
+                image.image.save(temp_path, format="WEBP", lossless=True)
+            case ImageFormat.JPEG:
+                image.image.convert("RGB").save(temp_path, format="JPEG", quality=95)
+
+        os.replace(temp_path, path)
+
+        if metadata is not None:
+            path.with_suffix(".json").write_text(
+                json.dumps(metadata, indent=2, ensure_ascii=False, default=str),
+                encoding="utf-8",
+            )
+
+
+output_writer = OutputWriter()
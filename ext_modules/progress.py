@@ -0,0 +1,132 @@
+import threading
+from dataclasses import dataclass
+from typing import Callable
+from modules.logging_colors import logger
+from ..sd_client import SdWebUIApi
+
+
+@dataclass
+class GenerationProgress:
+    """
+    The progress of the job currently running in stable-diffusion-webui.
+    """
+
+    progress: float = 0
+    eta_relative: float = 0
+    step: int = 0
+    sampling_steps: int = 0
+    current_image: str | None = None
+    is_completed: bool = False
+
+    @classmethod
+    def from_response(cls, response: dict) -> "GenerationProgress":
+        state = response.get("state", None) or {}
+
+        return cls(
+            progress=float(response.get("progress", None) or 0),
+            eta_relative=float(response.get("eta_relative", None) or 0),
+            step=int(state.get("sampling_step", None) or 0),
+            sampling_steps=int(state.get("sampling_steps", None) or 0),
+            current_image=response.get("current_image", None),
+        )
+
+
+# the progress of the running image generations by session, most recent last
+_progress: dict[str | None, GenerationProgress] = {}
+_progress_lock = threading.Lock()
+
+
+def get_current_progress(session_id: str | None = None) -> GenerationProgress | None:
+    """
+    Gets the progress of the running image generation of the given session, or of
+    the most recent one of any session if no session is given.
+    """
+
+    with _progress_lock:
+        if session_id is None:
+            return next(reversed(_progress.values()), None)
+
+        return _progress.get(session_id, None)
+
+
+class ProgressPoller(object):
+    """
+    Polls the progress endpoint of stable-diffusion-webui on a background thread
+    while being used as a context manager. The client is looked up before every
+    poll, so that the backend currently generating the images is polled.
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], SdWebUIApi | None],
+        interval: float,
+        session_id: str | None = None,
+        on_progress: Callable[[GenerationProgress], None] | None = None,
+        include_preview: bool = True,
+    ) -> None:
+        self.get_client = get_client
+        self.interval = max(0.1, interval)
+        self.session_id = session_id
+        self.on_progress = on_progress
+        self.include_preview = include_preview
+        self.latest = GenerationProgress()
+        self._stopped = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def __enter__(self) -> "ProgressPoller":
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+    def start(self) -> None:
+        self._stopped.clear()
+        self._publish(GenerationProgress())
+
+        self._thread = threading.Thread(
+            target=self._run, name="sd_progress", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+            self._thread = None
+
+        self._publish(GenerationProgress(progress=1, is_completed=True))
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            sd_client = self.get_client()
+
+            # e.g. while the images are looked up in the result cache
+            if sd_client is None:
+                continue
+
+            try:
+                response = sd_client.get_progress(
+                    skip_current_image=not self.include_preview
+                )
+            except Exception as e:
+                logger.debug("[SD WebUI Integration] Failed to poll progress: %s", e)
+                continue
+
+            self._publish(GenerationProgress.from_response(response))
+
+    def _publish(self, progress: GenerationProgress) -> None:
+        with _progress_lock:
+            # the job might have finished while the request was in flight
+            if self._stopped.is_set() and not progress.is_completed:
+                return
+
+            self.latest = progress
+            _progress.pop(self.session_id, None)
+
+            if not progress.is_completed:
+                _progress[self.session_id] = progress
+
+        if self.on_progress is not None:
+            self.on_progress(progress)
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+from PIL import Image
+from modules.logging_colors import logger
+from .lazy_image import LazyImage
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def create_cache_key(*parts: Any) -> str:
+    """
+    Creates a stable key from the canonical JSON representation of the given parts.
+    """
+
+    serialized = json.dumps(
+        parts, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str
+    )
+
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class ResultCache(object):
+    """
+    Caches generated images on disk, so that deterministic generations (i.e. ones
+    with a fixed seed) do not have to be sent to stable-diffusion-webui again.
+    Every image of a generation is stored as "<key>-<index>.png" and least recently
+    used images are evicted once the byte budget is exceeded.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load_entries()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def get(self, key: str, count: int) -> list[LazyImage] | None:
+        """
+        Returns all images of the given generation, or None if any of them is missing.
+        """
+
+        names = [f"{key}-{index}" for index in range(count)]
+
+        with self._lock:
+            if count == 0 or any(x not in self._entries for x in names):
+                self.misses += 1
+                return None
+
+            for name in names:
+                self._entries.move_to_end(name)
+
+        try:
+            images = []
+
+            for name in names:
+                # decoded only if needed, e.g. for creating a preview
+                images.append(LazyImage(self._get_path(name).read_bytes()))
+
+                # keeps the order of recently used images across restarts
+                os.utime(self._get_path(name))
+        except OSError as e:
+            logger.warning(
+                "[SD WebUI Integration] Failed to read cached image %s: %s", key, e
+            )
+
+            with self._lock:
+                self.misses += 1
+
+                for name in names:
+                    self._remove_entry(name)
+
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return images
+
+    def put(self, key: str, index: int, image: Image.Image | LazyImage) -> None:
+        """
+        Stores the image with the given index of a generation.
+        """
+
+        name = f"{key}-{index}"
+        path = self._get_path(name)
+        temp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            image = LazyImage.from_image(image)
+
+            if image.has_encoded_data and image.format == "PNG":
+                image.save(temp_path, format="PNG")
+            else:
+                image.image.save(temp_path, format="PNG", compress_level=1)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning(
+                "[SD WebUI Integration] Failed to cache image %s: %s", name, e
+            )
+            temp_path.unlink(missing_ok=True)
+            return
+
+        with self._lock:
+            self._remove_entry(name, delete_file=False)
+            self._entries[name] = path.stat().st_size
+            self._size += self._entries[name]
+
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove_entry(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            for name in list(self._entries):
+                self._remove_entry(name)
+
+    def _get_path(self, name: str) -> Path:
+        return self.directory / f"{name}.png"
+
+    def _load_entries(self) -> None:
+        if not self.directory.is_dir():
+            return
+
+        files = sorted(
+            (x for x in self.directory.glob("*.png") if x.is_file()),
+            key=lambda x: x.stat().st_mtime_ns,
+        )
+
+        for file in files:
+            self._entries[file.stem] = file.stat().st_size
+            self._size += self._entries[file.stem]
+
+        while self._size > self.max_bytes and self._entries:
+            self._remove_entry(next(iter(self._entries)))
+
+    def _remove_entry(self, name: str, delete_file: bool = True) -> None:
+        size = self._entries.pop(name, None)
+
+        if size is None:
+            return
+
+        self._size -= size
+
+        if delete_file:
+            self._get_path(name).unlink(missing_ok=True)
+
+
+_result_caches: dict[Path, ResultCache] = {}
+_result_caches_lock = threading.Lock()
+
+
+def get_result_cache(directory: Path, max_bytes: int) -> ResultCache:
+    """
+    Returns the shared result cache for the given directory.
+    """
+
+    with _result_caches_lock:
+        cache = _result_caches.get(directory, None)
+
+        if cache is None:
+            cache = ResultCache(directory, max_bytes)
+            _result_caches[directory] = cache
+
+        cache.max_bytes = max_bytes
+        return cache
@@ -0,0 +1,80 @@
+# keys holding the prompt of a generate_image tool call or the text of add_text
+PROMPT_KEYS = ("text", "prompt", "query")
+
+# llms sometimes use typographic quotes, which are replaced before parsing
+QUOTES = '"“”'
+
+
+class ToolCallStreamParser(object):
+    """
+    Consumes the reply of the LLM while it is being streamed and finds the moments
+    at which the prompt of a tool call has been completed. Only tracks the JSON
+    structure, the completed tool calls are extracted by create_generation_request.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self._closers: list[str] = []
+        self._is_in_string = False
+        self._is_escaped = False
+        self._is_key = False
+        self._string: list[str] = []
+        self._key: str | None = None
+
+    def feed(self, text: str) -> list[str]:
+        """
+        Appends the streamed text and returns the text up to every prompt completed
+        in it, with the open brackets closed, so it can be parsed as a whole.
+        """
+
+        completed = []
+        start = len(self.text)
+        self.text += text
+
+        for index in range(start, len(self.text)):
+            char = self.text[index]
+
+            if self._is_in_string:
+                if self._is_escaped:
+                    self._is_escaped = False
+
+                    if self._is_key:
+                        self._string.append(char)
+                elif char == "\\":
+                    self._is_escaped = True
+                elif char in QUOTES:
+                    self._is_in_string = False
+
+                    if self._on_string_completed():
+                        completed.append(
+                            self.text[: index + 1] + "".join(reversed(self._closers))
+                        )
+                elif self._is_key:
+                    self._string.append(char)
+            elif char in QUOTES and self._closers:
+                self._is_in_string = True
+                self._string = []
+            elif char in "{[":
+                self._closers.append("}" if char == "{" else "]")
+                self._is_key = char == "{"
+            elif char in "}]" and self._closers:
+                self._closers.pop()
+                self._is_key = False
+            elif char == ":":
+                self._is_key = False
+            elif char == ",":
+                self._is_key = bool(self._closers) and self._closers[-1] == "}"
+
+        return completed
+
+    def _on_string_completed(self) -> bool:
+        if self._is_key:
+            self._key = "".join(self._string)
+            return False
+
+        # tool parameters are nested in the object of the tool call
+        return (
+            self._key is not None
+            and self._key.strip().lower() in PROMPT_KEYS
+            and len(self._closers) >= 2
+        )
@@ -1,11 +1,16 @@
+import threading
+from dataclasses import dataclass
 from enum import Enum
+import modules.shared as shared
 from modules.logging_colors import logger
-from modules.models import load_model, unload_model, reload_model
+from modules.models import load_model, unload_model
 from ..context import GenerationContext
-import modules.shared as shared
+from .metrics import measure_stage
+from .model_parking import ParkedModel, park_model, restore_model
 
 loaded_model = "None"
 
+
 class VramReallocationTarget(Enum):
     """
     Defines the target for VRAM reallocation.
@@ -15,11 +20,50 @@ class VramReallocationTarget(Enum):
     LLM = 2
 
 
+class VramOwner(Enum):
+    """
+    Defines which model currently occupies the VRAM.
+    """
+
+    LLM = 1
+    STABLE_DIFFUSION = 2
+
+
+@dataclass
+class VramSwapStats:
+    """
+    Counts the model swaps done (and avoided) by the VRAM manager.
+    """
+
+    swaps_to_stable_diffusion: int = 0
+    swaps_to_llm: int = 0
+    avoided_swaps: int = 0
+    redundant_swaps: int = 0
+    parks: int = 0
+    park_fallbacks: int = 0
+    last_park_time: float = 0
+    last_restore_time: float = 0
+
+
+vram_owner = VramOwner.LLM
+swap_stats = VramSwapStats()
+
+_active_image_jobs = 0
+_llm_used_since_reload = True
+_llm_reload_timer: threading.Timer | None = None
+_parked_model: ParkedModel | None = None
+_condition = threading.Condition(threading.RLock())
+
+
 def attempt_vram_reallocation(
     target: VramReallocationTarget, context: GenerationContext
 ) -> None:
     """
     Reallocates VRAM for the given target if dynamic VRAM reallocations are enabled.
+
+    Stable Diffusion stays loaded once an image generation has finished. The LLM is
+    only loaded again when text is generated (see ensure_llm_loaded) or after the
+    configured reload delay has passed without any further image generations.
     """
 
     if not context.params.dynamic_vram_reallocation_enabled:
@@ -28,27 +72,215 @@ def attempt_vram_reallocation(
     _reallocate_vram_for_target(target, context)
 
 
+def ensure_llm_loaded(context: GenerationContext) -> None:
+    """
+    Loads the LLM into VRAM again if it has been swapped out for Stable Diffusion.
+    Must be called before generating text. Waits for running image generations.
+
+    Runs even if dynamic VRAM reallocations are disabled, as they may have been
+    turned off while Stable Diffusion was holding the VRAM.
+    """
+
+    global _llm_used_since_reload
+
+    with _condition:
+        _cancel_llm_reload()
+
+        while _active_image_jobs > 0:
+            _condition.wait()
+
+        _llm_used_since_reload = True
+
+        if vram_owner == VramOwner.LLM:
+            return
+
+        _swap_to_llm(context)
+
+
+def swap_to_llm(context: GenerationContext) -> None:
+    """
+    Unloads Stable Diffusion and loads the LLM right away if dynamic VRAM
+    reallocations are enabled, e.g. after the checkpoint has been changed.
+    Waits for running image generations without counting as one.
+    """
+
+    if not context.params.dynamic_vram_reallocation_enabled:
+        return
+
+    with _condition:
+        _cancel_llm_reload()
+
+        while _active_image_jobs > 0:
+            _condition.wait()
+
+        if vram_owner == VramOwner.STABLE_DIFFUSION:
+            _swap_to_llm(context)
+        else:
+            # changing the options makes stable-diffusion-webui load the checkpoint
+            logger.info("SD Extension: unloading the SD model for LLM")
+            context.sd_client.unload_checkpoint()
+
+
+def get_vram_swap_stats() -> VramSwapStats:
+    with _condition:
+        return VramSwapStats(**swap_stats.__dict__)
+
+
 def _reallocate_vram_for_target(
     target: VramReallocationTarget, context: GenerationContext
 ) -> None:
     match target:
         case VramReallocationTarget.STABLE_DIFFUSION:
-            _allocate_vram_for_stable_diffusion(context)
+            _acquire_vram_for_stable_diffusion(context)
         case VramReallocationTarget.LLM:
-            _allocate_vram_for_llm(context)
+            _release_vram_for_llm(context)
         case _:
             raise ValueError(f"Invalid VRAM reallocation target: {target}")
 
 
+def _acquire_vram_for_stable_diffusion(context: GenerationContext) -> None:
+    global vram_owner, _active_image_jobs
+
+    with _condition:
+        _cancel_llm_reload()
+        _active_image_jobs += 1
+
+        if vram_owner == VramOwner.STABLE_DIFFUSION:
+            swap_stats.avoided_swaps += 1
+            _log_swap_stats(context, "Stable Diffusion is still loaded")
+            return
+
+        # the LLM has been reloaded without generating any text in between
+        if not _llm_used_since_reload:
+            swap_stats.redundant_swaps += 1
+
+        try:
+            with measure_stage("vram_swap_to_stable_diffusion"):
+                _allocate_vram_for_stable_diffusion(context)
+        except Exception:
+            _active_image_jobs -= 1
+            _condition.notify_all()
+            raise
+
+        vram_owner = VramOwner.STABLE_DIFFUSION
+        swap_stats.swaps_to_stable_diffusion += 1
+        _log_swap_stats(context, "Swapped the LLM for Stable Diffusion")
+
+
+def _release_vram_for_llm(context: GenerationContext) -> None:
+    global _active_image_jobs, _llm_reload_timer
+
+    with _condition:
+        _active_image_jobs = max(0, _active_image_jobs - 1)
+        _condition.notify_all()
+
+        reload_delay = context.params.dynamic_vram_reallocation_llm_reload_delay
+
+        if (
+            _active_image_jobs > 0
+            or vram_owner != VramOwner.STABLE_DIFFUSION
+            or reload_delay < 0
+        ):
+            return
+
+        _cancel_llm_reload()
+        _llm_reload_timer = threading.Timer(
+            reload_delay, _reload_llm_if_idle, [context]
+        )
+        _llm_reload_timer.daemon = True
+        _llm_reload_timer.start()
+
+
+def _reload_llm_if_idle(context: GenerationContext) -> None:
+    global _llm_used_since_reload
+
+    with _condition:
+        if _active_image_jobs > 0 or vram_owner != VramOwner.STABLE_DIFFUSION:
+            return
+
+        try:
+            _swap_to_llm(context)
+        except Exception as e:
+            logger.error(
+                "[SD WebUI Integration] Failed to reload the LLM: %s", e, exc_info=True
+            )
+            return
+
+        _llm_used_since_reload = False
+
+
+def _swap_to_llm(context: GenerationContext) -> None:
+    global vram_owner
+
+    with measure_stage("vram_swap_to_llm"):
+        _allocate_vram_for_llm(context)
+
+    vram_owner = VramOwner.LLM
+    swap_stats.swaps_to_llm += 1
+    _log_swap_stats(context, "Swapped Stable Diffusion for the LLM")
+
+
+def _cancel_llm_reload() -> None:
+    global _llm_reload_timer
+
+    if _llm_reload_timer is not None:
+        _llm_reload_timer.cancel()
+        _llm_reload_timer = None
+
+
+def _log_swap_stats(context: GenerationContext, message: str) -> None:
+    if not context.params.debug_mode_enabled:
+        return
+
+    logger.info(
+        "[SD WebUI Integration] %s "
+        "(swaps to SD: %d, swaps to LLM: %d, avoided: %d, redundant: %d).",
+        message,
+        swap_stats.swaps_to_stable_diffusion,
+        swap_stats.swaps_to_llm,
+        swap_stats.avoided_swaps,
+        swap_stats.redundant_swaps,
+    )
+
+
 def _allocate_vram_for_stable_diffusion(context: GenerationContext) -> None:
-    global loaded_model
-    logger.info("SD Extension: unloading the LLM model for SD")
+    global loaded_model, _parked_model
     loaded_model = shared.model_name
-    unload_model()
+
+    if context.params.dynamic_vram_reallocation_llm_park_enabled:
+        _parked_model = park_model(shared.model)
+
+        if _parked_model is None:
+            swap_stats.park_fallbacks += 1
+
+    if _parked_model is not None:
+        swap_stats.parks += 1
+        swap_stats.last_park_time = _parked_model.park_time
+        logger.info(
+            "SD Extension: parked the LLM model (%d MB) in system RAM for SD in %.2fs",
+            _parked_model.size // 2**20,
+            _parked_model.park_time,
+        )
+    else:
+        logger.info("SD Extension: unloading the LLM model for SD")
+        unload_model()
+
     context.sd_client.reload_checkpoint()
 
 
 def _allocate_vram_for_llm(context: GenerationContext) -> None:
+    global _parked_model
     logger.info("SD Extension: unloading the SD model for LLM")
     context.sd_client.unload_checkpoint()
-    shared.model, shared.tokenizer = load_model(loaded_model)
+
+    # the host application may have loaded another model in the meantime
+    if _parked_model is not None and shared.model is _parked_model.model:
+        swap_stats.last_restore_time = restore_model(_parked_model)
+        logger.info(
+            "SD Extension: restored the parked LLM model in %.2fs",
+            swap_stats.last_restore_time,
+        )
+    else:
+        shared.model, shared.tokenizer = load_model(loaded_model)
+
+    _parked_model = None
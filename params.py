@@ -1,9 +1,8 @@
-import base64
 from dataclasses import dataclass, field, fields
 from enum import Enum
-import requests
 from typing_extensions import Self
 from modules.logging_colors import logger
+from .ext_modules.asset_cache import reference_asset_cache
 
 default_description_prompt = """
 You are now a text generator for the Stable Diffusion AI image generator. You will generate a text prompt for it.
@@ -86,6 +85,39 @@ class InteractiveModePromptGenerationMode(str, Enum):
         return self
 
 
+class GuideCompilationPolicy(str, Enum):
+    WAIT = "wait"
+    SKIP = "skip"
+
+    @classmethod
+    def index_of(cls, mode: Self) -> int:
+        return list(GuideCompilationPolicy).index(mode)
+
+    @classmethod
+    def from_index(cls, index: int) -> Self:
+        return list(GuideCompilationPolicy)[index]  # type: ignore
+
+    def __str__(self) -> str:
+        return self
+
+
+class ImageFormat(str, Enum):
+    WEBP = "webp"
+    JPEG = "jpeg"
+    PNG = "png"
+
+    @classmethod
+    def index_of(cls, mode: Self) -> int:
+        return list(ImageFormat).index(mode)
+
+    @classmethod
+    def from_index(cls, index: int) -> Self:
+        return list(ImageFormat)[index]  # type: ignore
+
+    def __str__(self) -> str:
+        return self
+
+
 class ReactorFace(int, Enum):
     NONE = 0
     FEMALE = 1
@@ -102,9 +134,13 @@ class ReactorFace(int, Enum):
 
 @dataclass
 class StableDiffusionClientParams:
-    api_endpoint: str = field(default="http://127.0.0.1:7860/sdapi/v1")
+    api_endpoint: str | list[str] = field(default="http://127.0.0.1:7860/sdapi/v1")
     api_username: str | None = field(default=None)
     api_password: str | None = field(default=None)
+    api_connect_timeout: float = field(default=5)
+    api_read_timeout: float = field(default=600)
+    api_connection_pool_size: int = field(default=4)
+    api_health_check_interval: float = field(default=30)
 
 
 @dataclass
@@ -134,6 +170,9 @@ class StableDiffusionGenerationParams:
     cfg_scale: float = field(default=6)
     clip_skip: int = field(default=1)
     seed: int = field(default=-1)
+    seed_from_prompt_enabled: bool = field(default=False)
+    batch_size: int = field(default=1)
+    n_iter: int = field(default=1)
 
 
 @dataclass
@@ -148,7 +187,6 @@ class StableDiffusionPostProcessingParams:
     restore_faces_enabled: bool = field(default=False)
 
 
-@dataclass
 class RegexGenerationRuleMatch(str, Enum):
     INPUT: str = "input"
     INPUT_SENTENCE: str = "input_sentence"
@@ -165,6 +203,10 @@ class RegexGenerationAction:
     name: str
     args: str | None
 
+    @classmethod
+    def from_dict(cls, action: dict) -> Self:
+        return cls(name=action["name"], args=action.get("args", None))  # type: ignore
+
 
 @dataclass
 class RegexGenerationRule:
@@ -173,13 +215,46 @@ class RegexGenerationRule:
     match: list[RegexGenerationRuleMatch] | None
     actions: list[RegexGenerationAction]
 
+    @classmethod
+    def from_dict(cls, rule: dict) -> Self:
+        """
+        Creates a rule from its dictionary form as used in the settings files.
+        """
+
+        return cls(
+            regex=rule.get("regex", None),
+            negative_regex=rule.get("negative_regex", None),
+            match=(
+                [
+                    RegexGenerationRuleMatch(x)
+                    for x in rule["match"]
+                    if x in RegexGenerationRuleMatch._value2member_map_
+                ]
+                if "match" in rule
+                else None
+            ),
+            actions=[
+                RegexGenerationAction.from_dict(x) for x in rule.get("actions", [])
+            ],
+        )  # type: ignore
+
 
 @dataclass
 class UserPreferencesParams:
     save_images: bool = field(default=True)
+    output_image_format: ImageFormat = field(default=ImageFormat.PNG)
+    output_png_compress_level: int = field(default=-1)
+    output_index_enabled: bool = field(default=True)
     trigger_mode: TriggerMode = field(default=TriggerMode.TOOL)
     tool_mode_force_json_output_enabled: bool = field(default=True)
     tool_mode_force_json_output_schema: str = field(default="")
+    tool_mode_guide_cache_enabled: bool = field(default=True)
+    tool_mode_guide_cache_max_size_mb: int = field(default=256)
+    tool_mode_guide_compilation_policy: GuideCompilationPolicy = field(
+        default=GuideCompilationPolicy.WAIT
+    )
+    tool_mode_guide_compilation_timeout: float = field(default=30)
+    tool_mode_early_generation_enabled: bool = field(default=False)
     interactive_mode_input_trigger_regex: str = field(
         default=".*(send|upload|add|show|attach|generate)\\b.+?\\b(image|pic(ture)?|photo|snap(shot)?|selfie|meme)(s?)"  # noqa E501
     )
@@ -197,8 +272,26 @@ class UserPreferencesParams:
     continuous_mode_prompt_generation_mode: ContinuousModePromptGenerationMode = field(
         default=ContinuousModePromptGenerationMode.GENERATED_TEXT
     )
+    speculative_generation_enabled: bool = field(default=False)
+    speculative_generation_min_length: int = field(default=300)
+    speculative_generation_similarity_threshold: float = field(default=0.8)
     dynamic_vram_reallocation_enabled: bool = field(default=False)
+    dynamic_vram_reallocation_llm_reload_delay: float = field(default=-1)
+    dynamic_vram_reallocation_llm_park_enabled: bool = field(default=False)
     dont_stream_when_generating_images: bool = field(default=True)
+    background_generation_enabled: bool = field(default=False)
+    image_processing_workers: int = field(default=2)
+    inline_image_format: ImageFormat = field(default=ImageFormat.WEBP)
+    inline_image_quality: int = field(default=80)
+    inline_image_max_dimension: int = field(default=512)
+    inline_image_max_size_kb: int = field(default=256)
+    progress_polling_enabled: bool = field(default=True)
+    progress_polling_interval: float = field(default=1.0)
+    result_cache_enabled: bool = field(default=False)
+    result_cache_max_size_mb: int = field(default=512)
+    metrics_server_host: str = field(default="127.0.0.1")
+    metrics_server_port: int = field(default=0)
+    metrics_file: str = field(default="")
     generation_rules: dict | None = field(
         default=None
     )  # list[RegexGenerationRule] | None = field(default=None)
@@ -334,17 +427,17 @@ class StableDiffusionWebUiExtensionParams(
                 ReactorFace[self.reactor_target_gender.upper()] or ReactorFace.NONE
             )
 
-        # Todo: images are redownloaded and files are reread every time a text is generated. # noqa E501
-        # This happens because normalize() is called on every generation and the downloaded values are not cached. # noqa E501
+        # Reference images are served from a cache so they do not need to be
+        # downloaded or read again on every generation.
 
         if self.faceswaplab_enabled and (
             self.faceswaplab_source_face.startswith("http://")
             or self.faceswaplab_source_face.startswith("https://")
         ):
             try:
-                self.faceswaplab_source_face = base64.b64encode(
-                    requests.get(self.faceswaplab_source_face).content
-                ).decode()
+                self.faceswaplab_source_face = "data:image;base64," + (
+                    reference_asset_cache.get_base64(self.faceswaplab_source_face)
+                )
             except Exception as e:
                 logger.exception(
                     "Failed to load FaceSwapLab source face image: %s", e, exc_info=True
@@ -356,9 +449,9 @@ class StableDiffusionWebUiExtensionParams(
             or self.reactor_source_face.startswith("https://")
         ):
             try:
-                self.reactor_source_face = base64.b64encode(
-                    requests.get(self.reactor_source_face).content
-                ).decode()
+                self.reactor_source_face = "data:image;base64," + (
+                    reference_asset_cache.get_base64(self.reactor_source_face)
+                )
             except Exception as e:
                 logger.exception(
                     "Failed to load ReActor source face image: %s", e, exc_info=True
@@ -367,18 +460,14 @@ class StableDiffusionWebUiExtensionParams(
 
         if self.faceid_enabled:
             try:
-                if self.faceid_source_face.startswith(
-                    "http://"
-                ) or self.faceid_source_face.startswith("https://"):
-                    self.faceid_source_face = base64.b64encode(
-                        requests.get(self.faceid_source_face).content
-                    ).decode()
-
-                if self.faceid_source_face.startswith("file:///"):
-                    with open(
-                        self.faceid_source_face.replace("file:///", ""), "rb"
-                    ) as f:
-                        self.faceid_source_face = base64.b64encode(f.read()).decode()
+                if (
+                    self.faceid_source_face.startswith("http://")
+                    or self.faceid_source_face.startswith("https://")
+                    or self.faceid_source_face.startswith("file:///")
+                ):
+                    self.faceid_source_face = reference_asset_cache.get_base64(
+                        self.faceid_source_face
+                    )
             except Exception as e:
                 logger.exception(
                     "Failed to load FaceID source face image: %s", e, exc_info=True
@@ -387,20 +476,14 @@ class StableDiffusionWebUiExtensionParams(
 
         if self.ipadapter_enabled:
             try:
-                if self.ipadapter_reference_image.startswith(
-                    "http://"
-                ) or self.ipadapter_reference_image.startswith("https://"):
-                    self.ipadapter_reference_image = base64.b64encode(
-                        requests.get(self.ipadapter_reference_image).content
-                    ).decode()
-
-                if self.ipadapter_reference_image.startswith("file:///"):
-                    with open(
-                        self.ipadapter_reference_image.replace("file:///", ""), "rb"
-                    ) as f:
-                        self.ipadapter_reference_image = base64.b64encode(
-                            f.read()
-                        ).decode()
+                if (
+                    self.ipadapter_reference_image.startswith("http://")
+                    or self.ipadapter_reference_image.startswith("https://")
+                    or self.ipadapter_reference_image.startswith("file:///")
+                ):
+                    self.ipadapter_reference_image = reference_asset_cache.get_base64(
+                        self.ipadapter_reference_image
+                    )
             except Exception as e:
                 logger.exception(
                     "Failed to load IP Adapter reference image: %s", e, exc_info=True
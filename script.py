@@ -6,63 +6,82 @@ from typing import Any, List
 from transformers import LogitsProcessor, PreTrainedTokenizerBase
 from modules import chat, shared
 from modules.logging_colors import logger
-from .context import GenerationContext, get_current_context, set_current_context
-from .ext_modules.image_generator import generate_html_images_for_context
+from .context import (
+    GenerationContext,
+    activate_session,
+    get_context,
+    get_current_context,
+    get_session_id,
+    set_context,
+)
+from .ext_modules.background_generator import (
+    apply_finished_generations,
+    submit_background_generation,
+)
+from .ext_modules.early_generation import (
+    create_speculative_observer,
+    create_tool_call_observer,
+    get_early_generation_images,
+    is_speculative_generation_supported,
+    take_early_generation,
+)
+from .ext_modules.guide_compiler import (
+    compile_guide_in_background,
+    get_json_logits_processor,
+)
+from .ext_modules.image_generator import (
+    create_generation_request,
+    generate_html_images,
+)
+from .ext_modules.metrics import start_metrics_server
 from .ext_modules.text_analyzer import try_get_description_prompt
+from .ext_modules.vram_manager import ensure_llm_loaded
 from .params import (
     InteractiveModePromptGenerationMode,
     StableDiffusionWebUiExtensionParams,
     TriggerMode,
 )
-from .sd_client import SdWebUIApi
-from .transformers_logits import JSONLogitsProcessor
+from .sd_client import get_sd_balancer
 from .ui import render_ui
 
 ui_params: Any = StableDiffusionWebUiExtensionParams()
 params = asdict(ui_params)
 
-context: GenerationContext | None = None
-
 picture_processing_message = "*Is sending a picture...*"
 default_processing_message = shared.processing_message
-cached_schema: str | None = None
-cached_schema_logits: LogitsProcessor | None = None
 
 EXTENSION_DIRECTORY_NAME = path.basename(path.dirname(path.realpath(__file__)))
 
 
 def get_or_create_context(state: dict | None = None) -> GenerationContext:
-    global context, params, ui_params
-
     for key in ui_params.__dict__:
         params[key] = ui_params.__dict__[key]
 
-    sd_client = SdWebUIApi(
-        baseurl=params["api_endpoint"],
-        username=params["api_username"],
-        password=params["api_password"],
-    )
+    start_metrics_server(ui_params.metrics_server_host, ui_params.metrics_server_port)
+
+    sd_balancer = get_sd_balancer(ui_params)
+    session_id = get_session_id(state)
+    context = get_context(session_id)
 
     if context is not None and not context.is_completed:
         context.state = (context.state or {}) | (state or {})
-        context.sd_client = sd_client
+        context.sd_client = sd_balancer.primary
+        context.sd_balancer = sd_balancer
+        activate_session(session_id)
         return context
 
     ext_params = StableDiffusionWebUiExtensionParams(**params)
     ext_params.normalize()
 
-    context = (
-        GenerationContext(
-            params=ext_params,
-            sd_client=sd_client,
-            input_text=None,
-            state=state or {},
-        )
-        if context is None or context.is_completed
-        else context
+    context = GenerationContext(
+        params=ext_params,
+        sd_client=sd_balancer.primary,
+        input_text=None,
+        state=state or {},
+        sd_balancer=sd_balancer,
     )
 
-    set_current_context(context)
+    set_context(session_id, context)
     return context
 
 
@@ -116,19 +135,27 @@ def state_modifier(state: dict) -> dict:
 
     context = get_or_create_context(state)
 
+    # the LLM might still be swapped out for Stable Diffusion from the last image
+    ensure_llm_loaded(context)
+
+    if context is not None:
+        # reloading the LLM may have replaced the tokenizer
+        compile_guide_in_background(context.params)
+
     if context is None or context.is_completed:
         return state
 
-    if (
-        context.params.trigger_mode == TriggerMode.TOOL
-        or context.params.dont_stream_when_generating_images
-    ):
+    # images generated in the background do not hold up the reply
+    dont_stream = (
+        context.params.dont_stream_when_generating_images
+        and not _is_background_generation_enabled(context)
+    )
+
+    if context.params.trigger_mode == TriggerMode.TOOL or dont_stream:
         state["stream"] = False
 
     shared.processing_message = (
-        picture_processing_message
-        if context.params.dont_stream_when_generating_images
-        else default_processing_message
+        picture_processing_message if dont_stream else default_processing_message
     )
 
     return state
@@ -140,6 +167,7 @@ def history_modifier(history: List[str]) -> List[str]:
     Only used in chat mode.
     """
 
+    history = apply_finished_generations(history)  # type: ignore
     context = get_current_context()
 
     if context is None or context.is_completed:
@@ -149,15 +177,15 @@ def history_modifier(history: List[str]) -> List[str]:
     return history
 
 
-def cleanup_context() -> None:
-    context = get_current_context()
+def cleanup_context(state: dict | None = None) -> None:
+    session_id = get_session_id(state)
+    context = get_context(session_id)
 
     if context is not None:
         context.is_completed = True
 
-    set_current_context(None)
+    set_context(session_id, None)
     shared.processing_message = default_processing_message
-    pass
 
 
 def output_modifier(string: str, state: dict, is_chat: bool = False) -> str:
@@ -171,10 +199,12 @@ def output_modifier(string: str, state: dict, is_chat: bool = False) -> str:
     global params
 
     if not is_chat:
-        cleanup_context()
+        cleanup_context(state)
         return string
 
-    context = get_current_context()
+    # this might run on another thread than the other hooks of the same request
+    session_id = get_session_id(state)
+    context = get_context(session_id)
 
     if context is None or context.is_completed:
         ext_params = StableDiffusionWebUiExtensionParams(**params)
@@ -188,57 +218,85 @@ def output_modifier(string: str, state: dict, is_chat: bool = False) -> str:
             if output_regex and re.match(
                 output_regex, normalized_message, re.IGNORECASE
             ):
-                sd_client = SdWebUIApi(
-                    baseurl=ext_params.api_endpoint,
-                    username=ext_params.api_username,
-                    password=ext_params.api_password,
-                )
+                sd_balancer = get_sd_balancer(ext_params)
 
                 context = GenerationContext(
                     params=ext_params,
-                    sd_client=sd_client,
+                    sd_client=sd_balancer.primary,
                     input_text=state.get("input", ""),
                     state=state,
+                    sd_balancer=sd_balancer,
                 )
 
-                set_current_context(context)
+                set_context(session_id, context)
 
     if context is None or context.is_completed:
-        cleanup_context()
+        cleanup_context(state)
         return string
 
     context.state = state
     context.output_text = string
 
     if "<img " in string:
-        cleanup_context()
+        cleanup_context(state)
         return string
 
     try:
         context.output_text = string
-        string, images_html, prompt, _, _, _ = generate_html_images_for_context(context)
-        string = html.escape(string)
+
+        request = create_generation_request(context)
+        early_generation = take_early_generation(context, request)
+
+        if not request.should_generate:
+            images_html = None
+        elif early_generation is not None:
+            # started while the rest of the reply was being generated
+            images_html = get_early_generation_images(
+                context, request, early_generation
+            )
+        elif _is_background_generation_enabled(context):
+            images_html = submit_background_generation(context, request)
+        else:
+            images_html = generate_html_images(context, request)
+
+        string = html.escape(request.output_text)
 
         if images_html:
             string = f"{string}\n\n{images_html}"
-            if prompt and (
-                context.params.trigger_mode == TriggerMode.TOOL
-                or (
-                    context.params.trigger_mode == TriggerMode.INTERACTIVE
-                    and context.params.interactive_mode_prompt_generation_mode
-                    == InteractiveModePromptGenerationMode.DYNAMIC
-                )
+            if context.params.trigger_mode == TriggerMode.TOOL or (
+                context.params.trigger_mode == TriggerMode.INTERACTIVE
+                and context.params.interactive_mode_prompt_generation_mode
+                == InteractiveModePromptGenerationMode.DYNAMIC
             ):
-                string = f"{string}\n*{html.escape(prompt).strip()}*"
+                for image_prompt in request.prompts:
+                    prompt = html.escape(image_prompt.prompt).strip()
+
+                    if prompt:
+                        string = f"{string}\n*{prompt}*"
 
     except Exception as e:
         string += "\n\n*Image generation has failed. Check logs for errors.*"
         logger.error(e, exc_info=True)
 
-    cleanup_context()
+    cleanup_context(state)
     return string
 
 
+def _is_background_generation_enabled(context: GenerationContext) -> bool:
+    return (
+        context.params.background_generation_enabled
+        and not context.params.dynamic_vram_reallocation_enabled
+    )
+
+
+def _is_early_generation_possible(context: GenerationContext) -> bool:
+    # unloading the LLM would abort the reply, background generations do not delay it
+    return (
+        not context.params.dynamic_vram_reallocation_enabled
+        and not context.params.background_generation_enabled
+    )
+
+
 def logits_processor_modifier(processor_list: List[LogitsProcessor], input_ids):
     """
     Adds logits processors to the list, allowing you to access and modify
@@ -246,37 +304,34 @@ def logits_processor_modifier(processor_list: List[LogitsProcessor], input_ids):
     Only used by loaders that use the transformers library for sampling.
     """
 
-    global cached_schema, cached_schema_logits
     context = get_current_context()
 
     if (
         context is None
         or context.is_completed
-        or context.params.trigger_mode != TriggerMode.TOOL
-        or not context.params.tool_mode_force_json_output_enabled
         or not isinstance(shared.tokenizer, PreTrainedTokenizerBase)
     ):
         return processor_list
 
-    schema = context.params.tool_mode_force_json_output_schema or ""
+    processor = get_json_logits_processor(context.params)
 
-    if len(schema.strip()) == 0:
+    if processor is not None:
+        # the processor keeps track of the FSM state, so each generation needs its own
+        processor_list.append(processor.copy())
+
+    if not _is_early_generation_possible(context):
         return processor_list
 
-    if cached_schema != schema or cached_schema_logits is None:
-        try:
-            cached_schema_logits = JSONLogitsProcessor(schema, shared.tokenizer)
-            cached_schema = schema
-        except Exception as e:
-            logger.error(
-                "Failed to parse JSON schema: %s,\nSchema: %s",
-                repr(e),
-                schema,
-                exc_info=True,
-            )
-            return processor_list
+    if (
+        context.params.trigger_mode == TriggerMode.TOOL
+        and context.params.tool_mode_early_generation_enabled
+    ):
+        processor_list.append(create_tool_call_observer(context, shared.tokenizer))
+    elif context.params.speculative_generation_enabled and (
+        is_speculative_generation_supported(context)
+    ):
+        processor_list.append(create_speculative_observer(context, shared.tokenizer))
 
-    processor_list.append(cached_schema_logits)
     return processor_list
 
 
@@ -293,3 +348,4 @@ def ui() -> None:
 
     ui_params = StableDiffusionWebUiExtensionParams(**params)
     render_ui(ui_params)
+    compile_guide_in_background(ui_params)
@@ -1,27 +1,87 @@
-import base64
 import json
+import threading
+import time
 from asyncio import Task
-from dataclasses import dataclass
-from io import BytesIO
-from typing import Any, List
+from collections import deque
+from contextlib import AbstractContextManager, nullcontext
+from dataclasses import dataclass, field
+from typing import Any, Callable, List, TypeVar
+from urllib.parse import urlsplit
+import requests
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from webuiapi import HiResUpscaler, WebUIApi, WebUIApiResult
-from .params import FaceSwapLabParams, ReactorParams
+from modules.logging_colors import logger
+from .ext_modules.asset_cache import reference_asset_cache
+from .ext_modules.lazy_image import LazyImage
+from .ext_modules.metrics import record_api_request
+from .params import FaceSwapLabParams, ReactorParams, StableDiffusionClientParams
 
 
 @dataclass
 class FaceSwapLabFaceSwapResponse:
-    images: List[Image.Image]
+    images: List[LazyImage]
     infos: List[str]
 
     @property
-    def image(self) -> Image.Image:
+    def image(self) -> LazyImage:
         return self.images[0]
 
 
 @dataclass
 class ReactorFaceSwapResponse:
-    image: Image.Image
+    image: LazyImage
+
+
+class PooledSession(requests.Session):
+    """
+    A session with a bounded pool of kept-alive connections and default timeouts.
+    Requests exceeding the pool size open additional connections instead of
+    waiting, so progress polls and health checks are never stalled by generations.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float,
+        read_timeout: float,
+        pool_size: int,
+    ) -> None:
+        super().__init__()
+        self.timeout = (connect_timeout, read_timeout)
+
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, pool_block=False
+        )
+
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(  # type: ignore
+        self, method: str | bytes, url: str | bytes, *args: Any, **kwargs: Any
+    ) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        endpoint = urlsplit(url if isinstance(url, str) else url.decode()).path
+        start_time = time.perf_counter()
+
+        try:
+            response = super().request(method, url, *args, **kwargs)
+        except requests.RequestException:
+            record_api_request(
+                endpoint, "error", 0, 0, time.perf_counter() - start_time
+            )
+            raise
+
+        body = response.request.body or b""
+
+        record_api_request(
+            endpoint,
+            response.status_code,
+            len(body),
+            len(response.content),
+            time.perf_counter() - start_time,
+        )
+
+        return response
 
 
 class SdWebUIApi(WebUIApi):
@@ -29,9 +89,56 @@ class SdWebUIApi(WebUIApi):
     This class extends the WebUIApi with some additional api endpoints.
     """
 
-    def __init__(self, *args: Any, **kwargs: Any) -> None:
+    def __init__(
+        self,
+        *args: Any,
+        connect_timeout: float = 5,
+        read_timeout: float = 600,
+        pool_size: int = 4,
+        **kwargs: Any,
+    ) -> None:
+        self.connection_settings = (connect_timeout, read_timeout, pool_size)
         super().__init__(*args, **kwargs)
 
+    def check_extensions(self) -> None:
+        # WebUIApi creates a plain session and then always checks the extensions,
+        # so this is the first chance to swap in the pooled session
+        if not isinstance(self.session, PooledSession):
+            session = PooledSession(*self.connection_settings)
+            session.auth = self.session.auth
+            self.session = session
+
+        super().check_extensions()
+
+    def _to_api_result(self, response: requests.Response) -> WebUIApiResult:
+        # same as WebUIApi._to_api_result, but images are only decoded when needed
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code, response.text)
+
+        r = response.json()
+        images = []
+        if "images" in r.keys():
+            images = [LazyImage(i) for i in r["images"]]
+        elif "image" in r.keys():
+            images = [LazyImage(r["image"])]
+
+        info: Any = ""
+        if "info" in r.keys():
+            try:
+                info = json.loads(r["info"])
+            except Exception:
+                info = r["info"]
+        elif "html_info" in r.keys():
+            info = r["html_info"]
+        elif "caption" in r.keys():
+            info = r["caption"]
+
+        parameters = ""
+        if "parameters" in r.keys():
+            parameters = r["parameters"]
+
+        return WebUIApiResult(images, parameters, info, r)  # type: ignore
+
     def unload_checkpoint(self, use_async: bool = False) -> Task[None] | None:
         """
         Unload the current checkpoint from VRAM.
@@ -49,6 +156,17 @@ class SdWebUIApi(WebUIApi):
             f"{self.baseurl}/reload-checkpoint", "", use_async
         )
 
+    def get_progress(self, skip_current_image: bool = False) -> dict:  # type: ignore
+        """
+        Gets the progress of the current job, including a preview image unless skipped.
+        """
+
+        response = self.session.get(
+            url=f"{self.baseurl}/progress",
+            params={"skip_current_image": str(skip_current_image).lower()},
+        )
+        return response.json()
+
     def txt2img(  # type: ignore
         self,
         enable_hr: bool = False,
@@ -190,16 +308,15 @@ class SdWebUIApi(WebUIApi):
 
     def reactor_swap_face(
         self,
-        target_image: Image.Image,
+        target_image: Image.Image | LazyImage,
         params: ReactorParams,
         use_async: bool = False,
     ) -> Task[ReactorFaceSwapResponse] | ReactorFaceSwapResponse:
         """
         Swaps a face in an image using the ReActor extension.
         """
-        buffer = BytesIO()
-        target_image.save(buffer, format="PNG")
-        target_image_base64 = base64.b64encode(buffer.getvalue()).decode()
+        # images received from the API are sent back without re-encoding
+        target_image_base64 = LazyImage.from_image(target_image).base64
 
         source_image_base64 = None
         source_model = None
@@ -212,12 +329,15 @@ class SdWebUIApi(WebUIApi):
             reference_face_source = 1
         elif reference_face_image_path.startswith("data:image"):
             source_image_base64 = reference_face_image_path.split(",")[1]
-        elif reference_face_image_path.startswith("file:///"):
+        elif (
+            reference_face_image_path.startswith("file:///")
+            or reference_face_image_path.startswith("http://")
+            or reference_face_image_path.startswith("https://")
+        ):
             # todo: ensure path is inside text-generation-webui folder
-            path = reference_face_image_path.replace("file:///", "")
-
-            with open(path, "rb") as image_file:
-                source_image_base64 = base64.b64encode(image_file.read()).decode()
+            source_image_base64 = reference_asset_cache.get_base64(
+                reference_face_image_path
+            )
         else:
             raise Exception(f"Failed to parse source face: {reference_face_image_path}")
 
@@ -257,7 +377,7 @@ class SdWebUIApi(WebUIApi):
 
     def faceswaplab_swap_face(
         self,
-        target_image: Image.Image,
+        target_image: Image.Image | LazyImage,
         params: FaceSwapLabParams,
         use_async: bool = False,
     ) -> Task[FaceSwapLabFaceSwapResponse] | FaceSwapLabFaceSwapResponse:
@@ -265,9 +385,8 @@ class SdWebUIApi(WebUIApi):
         Swaps a face in an image using the FaceSwapLab extension.
         """
 
-        buffer = BytesIO()
-        target_image.save(buffer, format="PNG")
-        target_image_base64 = base64.b64encode(buffer.getvalue()).decode()
+        # images received from the API are sent back without re-encoding
+        target_image_base64 = LazyImage.from_image(target_image).base64
 
         source_image_base64 = None
         source_face_checkpoint = None
@@ -280,12 +399,15 @@ class SdWebUIApi(WebUIApi):
             )
         elif reference_face_image_path.startswith("data:image"):
             source_image_base64 = reference_face_image_path.split(",")[1]
-        elif reference_face_image_path.startswith("file:///"):
+        elif (
+            reference_face_image_path.startswith("file:///")
+            or reference_face_image_path.startswith("http://")
+            or reference_face_image_path.startswith("https://")
+        ):
             # todo: ensure path is inside text-generation-webui folder
-            path = reference_face_image_path.replace("file:///", "")
-
-            with open(path, "rb") as image_file:
-                source_image_base64 = base64.b64encode(image_file.read()).decode()
+            source_image_base64 = reference_asset_cache.get_base64(
+                reference_face_image_path
+            )
         else:
             raise Exception(f"Failed to parse source face: {reference_face_image_path}")
 
@@ -371,3 +493,357 @@ class SdWebUIApi(WebUIApi):
     def refresh_vae(self) -> Any:
         response = self.session.post(url=f"{self.baseurl}/refresh-vae")
         return response.json()
+
+
+T = TypeVar("T")
+
+MAX_RECORDED_LATENCIES = 100
+
+# options changed outside of the extension are picked up after this many seconds
+OPTIONS_MAX_AGE = 30
+
+
+@dataclass
+class SdBackend:
+    """
+    A stable-diffusion-webui instance used by the balancer.
+    """
+
+    client: SdWebUIApi
+    outstanding_requests: int = 0
+    is_healthy: bool = True
+    failures: int = 0
+    latencies: deque[float] = field(
+        default_factory=lambda: deque(maxlen=MAX_RECORDED_LATENCIES)
+    )
+    options: dict[str, Any] | None = None
+    options_time: float = 0
+
+    @property
+    def endpoint(self) -> str:
+        return self.client.baseurl
+
+    @property
+    def average_latency(self) -> float | None:
+        latencies = list(self.latencies)
+        return sum(latencies) / len(latencies) if latencies else None
+
+
+class SdWebUIApiBalancer(object):
+    """
+    Dispatches jobs to the backend with the least outstanding requests and fails
+    over to the remaining backends if a request fails. Unreachable backends are
+    skipped until a periodic health check succeeds again.
+    """
+
+    def __init__(
+        self, clients: list[SdWebUIApi], health_check_interval: float = 30
+    ) -> None:
+        assert len(clients) > 0, "At least one backend is required"
+
+        self.backends = [SdBackend(client=x) for x in clients]
+        self.health_check_interval = health_check_interval
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._health_check_thread: threading.Thread | None = None
+
+    @property
+    def primary(self) -> SdWebUIApi:
+        """
+        The first configured backend, which is used for everything except image
+        generation (e.g. fetching options or VRAM reallocation).
+        """
+
+        return self.backends[0].client
+
+    def dispatch(
+        self,
+        call: Callable[[SdWebUIApi], T],
+        backend: SdBackend | None = None,
+        on_dispatch: Callable[[SdBackend], AbstractContextManager[Any]] | None = None,
+    ) -> tuple[T, SdBackend]:
+        """
+        Runs the given call on the preferred backend if it is healthy, otherwise
+        on the least busy one. Returns the result and the backend that served it.
+        The context manager returned by on_dispatch is entered while the call runs
+        on a backend, e.g. for interrupting it.
+        """
+
+        self._ensure_health_checks()
+
+        attempted: list[SdBackend] = []
+        last_error: Exception | None = None
+
+        while True:
+            selected = self._acquire(backend, attempted)
+
+            if selected is None:
+                raise last_error or RuntimeError(
+                    "No healthy stable-diffusion-webui backend is available"
+                )
+
+            attempted.append(selected)
+            start_time = time.perf_counter()
+
+            try:
+                with on_dispatch(selected) if on_dispatch else nullcontext():
+                    result = call(selected.client)
+            except (requests.RequestException, RuntimeError) as e:
+                last_error = e
+                self._release(selected, error=e)
+
+                logger.warning(
+                    "[SD WebUI Integration] Request to %s failed: %s",
+                    selected.endpoint,
+                    e,
+                )
+                continue
+
+            self._release(selected, latency=time.perf_counter() - start_time)
+            return result, selected
+
+    def get_options(self, max_age: float = OPTIONS_MAX_AGE) -> list[dict[str, Any]]:
+        """
+        Returns the options of every healthy backend. They are only requested again
+        once they are older than max_age seconds, changes made through set_options
+        are applied right away.
+        """
+
+        result = []
+
+        for backend in self.backends:
+            if not backend.is_healthy:
+                continue
+
+            with self._lock:
+                options = (
+                    backend.options
+                    if time.monotonic() - backend.options_time < max_age
+                    else None
+                )
+
+            if options is None:
+                options = backend.client.get_options()
+
+                with self._lock:
+                    backend.options = options
+                    backend.options_time = time.monotonic()
+
+            result.append(options)
+
+        return result
+
+    def set_options(self, options: dict[str, Any]) -> None:
+        """
+        Changes the options (e.g. the checkpoint) of every backend, so that the
+        images do not depend on the backend generating them. Only failures of the
+        primary backend are raised.
+        """
+
+        for backend in self.backends:
+            try:
+                backend.client.set_options(options)
+            except Exception as e:
+                # the options of the backend are unknown now
+                with self._lock:
+                    backend.options = None
+
+                if backend is self.backends[0]:
+                    raise
+
+                logger.warning(
+                    "[SD WebUI Integration] Failed to change the options of %s: %s",
+                    backend.endpoint,
+                    e,
+                )
+                continue
+
+            with self._lock:
+                if backend.options is not None:
+                    backend.options = {**backend.options, **options}
+
+    def close(self) -> None:
+        self._closed.set()
+
+    def _acquire(
+        self, preferred: SdBackend | None, attempted: list[SdBackend]
+    ) -> SdBackend | None:
+        with self._lock:
+            remaining = [
+                x for x in self.backends if not any(x is y for y in attempted)
+            ]
+
+            if not remaining:
+                return None
+
+            candidates = [x for x in remaining if x.is_healthy]
+
+            # rather than failing every request until a health check succeeds, e.g.
+            # with a single backend, which is not health checked at all
+            if not candidates:
+                candidates = [min(remaining, key=lambda x: x.failures)]
+
+            selected = (
+                preferred
+                if any(x is preferred for x in candidates)
+                else min(candidates, key=lambda x: x.outstanding_requests)
+            )
+
+            assert selected is not None
+            selected.outstanding_requests += 1
+            return selected
+
+    def _release(
+        self,
+        backend: SdBackend,
+        latency: float | None = None,
+        error: Exception | None = None,
+    ) -> None:
+        with self._lock:
+            backend.outstanding_requests -= 1
+
+            if latency is not None:
+                backend.latencies.append(latency)
+
+                if not backend.is_healthy:
+                    logger.info(
+                        "[SD WebUI Integration] Backend %s is healthy again.",
+                        backend.endpoint,
+                    )
+
+                backend.is_healthy = True
+
+            if error is not None:
+                backend.failures += 1
+
+                # http errors are reported as RuntimeError by webuiapi, so the
+                # backend itself is still reachable
+                if isinstance(error, requests.RequestException):
+                    backend.is_healthy = False
+
+    def _ensure_health_checks(self) -> None:
+        if len(self.backends) < 2 or self._health_check_thread is not None:
+            return
+
+        with self._lock:
+            if self._health_check_thread is None:
+                self._health_check_thread = threading.Thread(
+                    target=self._run_health_checks,
+                    name="sd_health_check",
+                    daemon=True,
+                )
+                self._health_check_thread.start()
+
+    def _run_health_checks(self) -> None:
+        while not self._closed.wait(max(1, self.health_check_interval)):
+            for backend in self.backends:
+                try:
+                    backend.client.get_progress(skip_current_image=True)
+                    is_healthy = True
+                except Exception:
+                    is_healthy = False
+
+                if is_healthy != backend.is_healthy:
+                    logger.info(
+                        "[SD WebUI Integration] Backend %s is %s.",
+                        backend.endpoint,
+                        "healthy again" if is_healthy else "unreachable",
+                    )
+
+                with self._lock:
+                    backend.is_healthy = is_healthy
+
+
+def get_api_endpoints(api_endpoint: str | list[str]) -> list[str]:
+    """
+    Gets the backend endpoints from either a list or a comma separated string.
+    """
+
+    endpoints = (
+        api_endpoint.replace("\n", ",").split(",")
+        if isinstance(api_endpoint, str)
+        else api_endpoint
+    )
+
+    return [x.strip() for x in endpoints if x and x.strip()]
+
+
+_clients: dict[tuple[str, str | None, str | None], SdWebUIApi] = {}
+_balancers: dict[
+    tuple[tuple[str, ...], str | None, str | None], SdWebUIApiBalancer
+] = {}
+_clients_lock = threading.Lock()
+
+
+def get_sd_client(params: StableDiffusionClientParams) -> SdWebUIApi:
+    """
+    Returns the shared client for the primary backend of the given connection details.
+    A new client is only created if the connection details have changed.
+    """
+
+    return get_sd_balancer(params).primary
+
+
+def get_sd_balancer(params: StableDiffusionClientParams) -> SdWebUIApiBalancer:
+    """
+    Returns the shared balancer for all backends of the given connection details.
+    """
+
+    endpoints = tuple(get_api_endpoints(params.api_endpoint))
+    username = params.api_username or None
+    password = params.api_password or None
+
+    if not endpoints:
+        raise ValueError("No stable-diffusion-webui API endpoint has been set")
+
+    connection_settings = (
+        params.api_connect_timeout,
+        params.api_read_timeout,
+        params.api_connection_pool_size,
+    )
+
+    with _clients_lock:
+        clients = [
+            _get_client((x, username, password), connection_settings)
+            for x in endpoints
+        ]
+
+        key = (endpoints, username, password)
+        balancer = _balancers.get(key, None)
+
+        if (
+            balancer is None
+            or balancer.health_check_interval != params.api_health_check_interval
+            or any(x.client is not y for x, y in zip(balancer.backends, clients))
+        ):
+            if balancer is not None:
+                balancer.close()
+
+            balancer = SdWebUIApiBalancer(
+                clients, health_check_interval=params.api_health_check_interval
+            )
+
+            _balancers[key] = balancer
+
+        return balancer
+
+
+def _get_client(
+    key: tuple[str, str | None, str | None],
+    connection_settings: tuple[float, float, int],
+) -> SdWebUIApi:
+    client = _clients.get(key, None)
+
+    if client is None or client.connection_settings != connection_settings:
+        client = SdWebUIApi(
+            baseurl=key[0],
+            username=key[1],
+            password=key[2],
+            connect_timeout=connection_settings[0],
+            read_timeout=connection_settings[1],
+            pool_size=connection_settings[2],
+        )
+
+        _clients[key] = client
+
+    return client
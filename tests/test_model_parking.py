@@ -0,0 +1,88 @@
+"""
+Tests parking the LLM in host memory with fake models, so they run without torch
+or a GPU.
+
+Usage:
+  python -m pytest tests
+"""
+
+import sys
+from pathlib import Path
+from typing import Any
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+
+from simulated_host import install_simulated_modules, load_extension  # noqa: E402
+
+install_simulated_modules()
+load_extension()
+
+from stable_diffusion.ext_modules.model_parking import (  # noqa: E402
+    park_model,
+    restore_model,
+)
+
+
+class FakeTensor(object):
+    def __init__(self, size: int) -> None:
+        self.size = size
+
+    def numel(self) -> int:
+        return self.size
+
+    def element_size(self) -> int:
+        return 2
+
+
+class FakeModel(object):
+    def __init__(self, device: str, sizes: list[int]) -> None:
+        self.device = device
+        self.tensors = [FakeTensor(x) for x in sizes]
+
+    def to(self, device: str) -> "FakeModel":
+        self.device = device
+        return self
+
+    def parameters(self) -> list[FakeTensor]:
+        return self.tensors
+
+
+class EmptyModel(FakeModel):
+    @property
+    def device(self) -> Any:
+        # like transformers models without parameters
+        raise StopIteration
+
+    @device.setter
+    def device(self, value: Any) -> None:
+        pass
+
+
+def test_park_and_restore_model() -> None:
+    model = FakeModel("gpu", [512, 1024])
+    parked_model = park_model(model, reserve_bytes=0, host_device="host")
+
+    assert parked_model is not None
+    assert parked_model.size == 3072
+    assert model.device == "host"
+
+    restore_model(parked_model)
+    assert model.device == "gpu"
+
+
+def test_model_already_on_host_is_not_parked() -> None:
+    model = FakeModel("host", [512])
+
+    assert park_model(model, reserve_bytes=0, host_device="host") is None
+    assert model.device == "host"
+
+
+def test_model_without_parameters_is_not_parked() -> None:
+    model = FakeModel("gpu", [])
+
+    assert park_model(model, reserve_bytes=0, host_device="host") is None
+    assert model.device == "gpu"
+
+
+def test_model_with_failing_device_lookup_is_not_parked() -> None:
+    assert park_model(EmptyModel("gpu", []), host_device="host") is None
@@ -4,7 +4,9 @@
 # License: Apache License 2.0:
 # https://github.com/outlines-dev/outlines/blob/68b71ae810e0d6815a83df525da6d707cd4e971a/LICENSE
 
-from typing import Optional, Type, Union
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Type, Union
 import torch
 from outlines.fsm.guide import Guide, RegexGuide
 from outlines.fsm.json_schema import build_regex_from_schema
@@ -12,45 +14,152 @@ from outlines.integrations.utils import adapt_tokenizer, convert_json_schema_to_
 from pydantic import BaseModel
 from transformers import LogitsProcessor, PreTrainedTokenizerBase
 from typing_extensions import override
+from .ext_modules.guide_cache import GuideCache
+
+# a mask takes one byte per token, e.g. 128 KB for a vocabulary of 128k tokens
+MASK_CACHE_SIZE = 256
+
+
+class TokenMaskCache(object):
+    """
+    An LRU cache of the tokens disallowed in each FSM state as boolean masks over
+    the vocabulary, so they do not have to be rebuilt on every decoding step.
+    Shared between all copies of a logits processor.
+    """
+
+    def __init__(self, fsm: Guide, max_entries: int = MASK_CACHE_SIZE):
+        self.fsm = fsm
+        self.max_entries = max_entries
+        self._masks: OrderedDict[tuple, torch.Tensor] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, state: int, vocab_size: int, device: torch.device) -> torch.Tensor:
+        key = (state, vocab_size, device)
+
+        with self._lock:
+            mask = self._masks.get(key, None)
+
+            if mask is not None:
+                self._masks.move_to_end(key)
+                return mask
+
+        allowed_tokens = self.fsm.get_next_instruction(state).tokens
+        mask = torch.ones(vocab_size, dtype=torch.bool, device=device)
+        mask[torch.as_tensor(allowed_tokens, dtype=torch.long, device=device)] = False
+
+        with self._lock:
+            self._masks[key] = mask
+
+            if len(self._masks) > self.max_entries:
+                self._masks.popitem(last=False)
+
+        return mask
 
 
 class FsmLogitsProcessor(LogitsProcessor):
-    def __init__(self, tokenizer: PreTrainedTokenizerBase, fsm: Guide):
+    """
+    Masks all tokens not allowed by the FSM. Every row of the batch has its own FSM
+    state, which is looked up by the tokens generated so far. Thus rows may belong
+    to different sequences and may be reordered between steps, e.g. by beam search.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        fsm: Guide,
+        mask_cache: TokenMaskCache | None = None,
+    ):
         self.fsm = fsm
         self._tokenizer = tokenizer
-        self._fsm_state = 0
-        self._is_first_token = True
+        self._mask_cache = mask_cache or TokenMaskCache(fsm)
+        self._prompt_length: int | None = None
+        # the FSM states of the previous step keyed by the generated tokens
+        self._fsm_states: dict[bytes, int] = {}
 
     @override
     def __call__(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor
     ) -> torch.FloatTensor:
-        is_first_token = self._is_first_token
-        if self._is_first_token:
-            self._is_first_token = False
+        if self._prompt_length is None or input_ids.shape[1] < self._prompt_length:
+            self._prompt_length = input_ids.shape[1]
+            self._fsm_states = {}
 
-        mask = torch.full_like(scores, -float("inf"))
+        # a single device sync for all rows instead of one per row
+        generated_tokens = input_ids[:, self._prompt_length :].cpu().numpy()
+        fsm_states: dict[bytes, int] = {}
+        states = []
 
-        for i in range(len(input_ids)):
-            if not is_first_token:
-                last_token = int(input_ids[i][-1].item())
-                self._fsm_state = self.fsm.get_next_state(self._fsm_state, last_token)
+        for tokens in generated_tokens:
+            key = tokens.tobytes()
+            state = fsm_states.get(key, None)
 
-            allowed_tokens = self.fsm.get_next_instruction(self._fsm_state).tokens
-            mask[i][allowed_tokens] = 0
+            if state is None:
+                state = self._get_fsm_state(tokens, key)
+                fsm_states[key] = state
 
-        biased_scores = scores + mask
-        return biased_scores  # type: ignore
+            states.append(state)
+
+        self._fsm_states = fsm_states
+
+        scores.masked_fill_(self._get_masks(states, scores), -float("inf"))
+        return scores
 
     def copy(self) -> "FsmLogitsProcessor":
-        return FsmLogitsProcessor(tokenizer=self._tokenizer, fsm=self.fsm.copy())
+        return FsmLogitsProcessor(
+            tokenizer=self._tokenizer, fsm=self.fsm.copy(), mask_cache=self._mask_cache
+        )
+
+    def _get_fsm_state(self, tokens: Any, key: bytes) -> int:
+        initial_state = getattr(self.fsm, "initial_state", 0)
+
+        if len(tokens) == 0:
+            return initial_state
+
+        # the sequence without its last token has been seen in the previous step
+        previous_state = self._fsm_states.get(key[: -tokens.itemsize], None)
+
+        if previous_state is not None:
+            return self.fsm.get_next_state(previous_state, int(tokens[-1]))
+
+        # e.g. a sequence which has joined the batch later on
+        state = initial_state
+
+        for token in tokens.tolist():
+            state = self.fsm.get_next_state(state, token)
+
+        return state
+
+    def _get_masks(self, states: list[int], scores: torch.Tensor) -> torch.Tensor:
+        vocab_size = scores.shape[-1]
+        unique_states = list(dict.fromkeys(states))
+        masks = [
+            self._mask_cache.get(x, vocab_size, scores.device) for x in unique_states
+        ]
+
+        if len(unique_states) == 1:
+            return masks[0].expand(len(states), vocab_size)
+
+        # gathers the masks of all rows at once
+        indices = torch.as_tensor(
+            [unique_states.index(x) for x in states], device=scores.device
+        )
+        return torch.stack(masks)[indices]
 
 
 class RegexLogitsProcessor(FsmLogitsProcessor):
-    def __init__(self, regex_string: str, tokenizer: PreTrainedTokenizerBase):
+    def __init__(
+        self,
+        regex_string: str,
+        tokenizer: PreTrainedTokenizerBase,
+        guide_cache: GuideCache | None = None,
+    ):
         assert isinstance(tokenizer, PreTrainedTokenizerBase)
 
-        fsm = RegexGuide(regex_string, tokenizer)
+        fsm = (
+            guide_cache.get_or_compile(regex_string, tokenizer)
+            if guide_cache is not None
+            else RegexGuide(regex_string, tokenizer)
+        )
         super().__init__(tokenizer=tokenizer, fsm=fsm)
 
 
@@ -60,8 +169,11 @@ class JSONLogitsProcessor(RegexLogitsProcessor):
         schema: Union[dict, Type[BaseModel], str],
         tokenizer: PreTrainedTokenizerBase,
         whitespace_pattern: Optional[str] = None,
+        guide_cache: GuideCache | None = None,
     ):
         schema_str = convert_json_schema_to_str(json_schema=schema)
         regex_string = build_regex_from_schema(schema_str, whitespace_pattern)
         tokenizer = adapt_tokenizer(tokenizer=tokenizer)
-        super().__init__(regex_string=regex_string, tokenizer=tokenizer)
+        super().__init__(
+            regex_string=regex_string, tokenizer=tokenizer, guide_cache=guide_cache
+        )
@@ -1,10 +1,16 @@
 from typing import Any, List
 import gradio as gr
 from stringcase import sentencecase
+from modules import shared
 from modules.logging_colors import logger
 from modules.ui import refresh_symbol
-from .context import GenerationContext
-from .ext_modules.vram_manager import VramReallocationTarget, attempt_vram_reallocation
+from .context import GenerationContext, get_session_id
+from .ext_modules.guide_compiler import (
+    compile_guide_in_background,
+    get_guide_compilation_status,
+)
+from .ext_modules.progress import get_current_progress
+from .ext_modules.vram_manager import swap_to_llm
 from .params import (
     ContinuousModePromptGenerationMode,
     InteractiveModePromptGenerationMode,
@@ -12,7 +18,7 @@ from .params import (
 )
 from .params import StableDiffusionWebUiExtensionParams as Params
 from .params import TriggerMode
-from .sd_client import SdWebUIApi
+from .sd_client import SdWebUIApi, get_api_endpoints, get_sd_balancer, get_sd_client
 
 STATUS_SUCCESS = "#00FF00"
 STATUS_PROGRESS = "#FFFF00"
@@ -40,6 +46,7 @@ sd_options: Any = None
 
 def render_ui(params: Params) -> None:
     _render_status()
+    _render_progress(params)
     _refresh_sd_data(params)
 
     _render_connection_details(params)
@@ -93,8 +100,8 @@ def _render_connection_details(params: Params) -> None:
             with gr.Column():
                 api_endpoint = gr.Textbox(
                     label="API Endpoint",
-                    placeholder=params.api_endpoint,
-                    value=lambda: params.api_endpoint,
+                    placeholder="Separate multiple endpoints with commas",
+                    value=lambda: ", ".join(get_api_endpoints(params.api_endpoint)),
                 )
                 api_endpoint.change(
                     lambda new_api_endpoint: params.update(
@@ -260,6 +267,18 @@ def _render_generation_parameters(params: Params) -> None:
             )
             seed.change(lambda new_seed: params.update({"seed": new_seed}), seed, None)
 
+            seed_from_prompt_enabled = gr.Checkbox(
+                label="Derive random seed from prompt",
+                value=lambda: params.seed_from_prompt_enabled,
+            )
+            seed_from_prompt_enabled.change(
+                lambda new_enabled: params.update(
+                    {"seed_from_prompt_enabled": new_enabled}
+                ),
+                seed_from_prompt_enabled,
+                None,
+            )
+
             cfg_scale = gr.Slider(
                 label="CFG Scale",
                 value=lambda: params.cfg_scale,
@@ -274,6 +293,32 @@ def _render_generation_parameters(params: Params) -> None:
                 None,
             )
 
+            batch_size = gr.Slider(
+                label="Batch size",
+                value=lambda: params.batch_size,
+                minimum=1,
+                maximum=8,
+                step=1,
+            )
+            batch_size.change(
+                lambda new_batch_size: params.update({"batch_size": new_batch_size}),
+                batch_size,
+                None,
+            )
+
+            n_iter = gr.Slider(
+                label="Batch count",
+                value=lambda: params.n_iter,
+                minimum=1,
+                maximum=8,
+                step=1,
+            )
+            n_iter.change(
+                lambda new_n_iter: params.update({"n_iter": new_n_iter}),
+                n_iter,
+                None,
+            )
+
             with gr.Column() as hr_options:
                 restore_faces = gr.Checkbox(
                     label="Restore faces", value=lambda: params.restore_faces_enabled
@@ -623,6 +668,31 @@ def _render_chat_config(params: Params) -> None:
                 None,
             )
 
+            force_json_output_schema = gr.Code(
+                label="Tool mode JSON schema",
+                language="json",
+                value=lambda: params.tool_mode_force_json_output_schema,
+            )
+
+            # compiling on every keystroke would only cancel the previous compilation
+            force_json_output_schema.blur(
+                lambda new_schema: _update_json_schema(new_schema, params),
+                force_json_output_schema,
+                None,
+            )
+
+            gr.Markdown(
+                lambda: get_guide_compilation_status(params),
+                every=params.progress_polling_interval,
+            )
+
+
+def _update_json_schema(schema: str, params: Params) -> None:
+    params.update({"tool_mode_force_json_output_schema": schema})
+
+    # compiles it before it is needed for the next reply
+    compile_guide_in_background(params)
+
 
 def _render_status() -> None:
     global status
@@ -630,14 +700,47 @@ def _render_status() -> None:
     _set_status("Ready.", STATUS_SUCCESS)
 
 
+def _render_progress(params: Params) -> None:
+    # the id of the selected chat, so that only the progress of its images is shown
+    unique_id = shared.gradio.get("unique_id", None)
+
+    with gr.Accordion(
+        "Image generation progress",
+        open=False,
+        visible=params.progress_polling_enabled,
+    ):
+        gr.HTML(
+            _get_progress_html,
+            inputs=[unique_id] if unique_id is not None else None,
+            every=params.progress_polling_interval,
+        )
+
+
+def _get_progress_html(unique_id: str | None = None) -> str:
+    progress = get_current_progress(
+        get_session_id({"unique_id": unique_id}) if unique_id else None
+    )
+
+    if progress is None or progress.is_completed:
+        return "<p>No image is being generated.</p>"
+
+    preview = (
+        f'<img src="data:image/png;base64,{progress.current_image}" '
+        'style="max-width: 256px;">'
+        if progress.current_image
+        else ""
+    )
+
+    return (
+        f"<p>Generating image: {progress.progress:.0%} "
+        f"(ETA: {progress.eta_relative:.0f}s)</p>{preview}"
+    )
+
+
 def _refresh_sd_data(params: Params, force_refetch: bool = False) -> None:
     global sd_client, sd_connected, refresh_button
 
-    sd_client = SdWebUIApi(
-        baseurl=params.api_endpoint,
-        username=params.api_username,
-        password=params.api_password,
-    )
+    sd_client = get_sd_client(params)
 
     sd_connected = True
     _set_status("Connecting to Stable Diffusion WebUI...", STATUS_PROGRESS)
@@ -745,7 +848,7 @@ def _load_checkpoint(checkpoint: str, params: Params) -> None:
     sd_current_checkpoint = checkpoint
 
     assert sd_client is not None
-    sd_client.set_options({"sd_model_checkpoint": checkpoint})
+    get_sd_balancer(params).set_options({"sd_model_checkpoint": checkpoint})
 
     # apply changes if dynamic VRAM allocation is not enabled
     # todo: check if model is loaded in VRAM via SD API instead of relying on vram reallocation check # noqa: E501
@@ -757,10 +860,7 @@ def _load_checkpoint(checkpoint: str, params: Params) -> None:
 
     _set_status("Reloading LLM model:...", STATUS_PROGRESS)
 
-    attempt_vram_reallocation(
-        VramReallocationTarget.LLM,
-        GenerationContext(params=params, sd_client=sd_client),
-    )
+    swap_to_llm(GenerationContext(params=params, sd_client=sd_client))
 
     _set_status(f"Stable Diffusion checkpoint ready: {checkpoint}.", STATUS_SUCCESS)
 
@@ -770,7 +870,7 @@ def _load_vae(vae: str, params: Params) -> None:
     sd_current_vae = vae
 
     assert sd_client is not None
-    sd_client.set_options({"sd_vae": vae})
+    get_sd_balancer(params).set_options({"sd_vae": vae})
 
     # apply changes if dynamic VRAM allocation is not enabled
     # todo: check if model is loaded in VRAM via SD API instead of relying on vram reallocation check # noqa: E501
@@ -778,10 +878,7 @@ def _load_vae(vae: str, params: Params) -> None:
         _set_status(f"Loading Stable Diffusion VAE: {vae}...", STATUS_PROGRESS)
         sd_client.reload_checkpoint()
 
-    attempt_vram_reallocation(
-        VramReallocationTarget.LLM,
-        GenerationContext(params=params, sd_client=sd_client),
-    )
+    swap_to_llm(GenerationContext(params=params, sd_client=sd_client))
 
     _set_status(f"Stable Diffusion VAE ready: {vae}.", STATUS_SUCCESS)
 